@@ -0,0 +1,204 @@
+"""
+A binary index of the files of each branch's latest commit.
+
+Committing, resetting and comparing a branch all start by asking what its
+files looked like when it was last committed, and that commit's JSON
+manifest takes seconds to parse once a volume has millions of files.  Each
+branch therefore also keeps the stat entries of its latest commit in
+C{<volume>/indexes/<branch>.index}, in a form which is mapped into memory and looked
+up in place rather than parsed:
+
+    header    magic, entry count, slot count, metadata and path lengths
+    metadata  JSON: the commit the index describes, and its dirty path mark
+    slots     an open-addressing hash table of entry numbers, keyed on the
+              CRC-32 of each path
+    entries   fixed-size records of inode, size, modification and change
+              times and object key, in the order the tree is walked
+    paths     the relative paths the entries point at
+
+The index is only a cache of the manifest, and is ignored unless it
+describes the branch's latest commit, so it is replaced without being
+synced.
+"""
+
+import binascii
+import json
+import mmap
+import os
+import struct
+import sys
+import zlib
+from array import array
+
+INDEXES_DIRECTORY = "indexes"
+
+MAGIC = "dvolidx1"
+
+_HEADER = struct.Struct(">8sQQIQ")
+_SLOT = struct.Struct(">I")
+_ENTRY = struct.Struct(">QIQQdd20s")
+
+
+class CorruptIndex(Exception):
+    """
+    An index file is truncated or isn't an index.
+    """
+
+
+def indexPath(volumePath, branch):
+    return volumePath.child(INDEXES_DIRECTORY).child("%s.index" % (branch,))
+
+
+def _hash(relative):
+    return zlib.crc32(relative) & 0xffffffff
+
+
+def _walkOrder(relative):
+    # A directory's entries come right after it, as L{objectstore._walk}
+    # finds them: NUL sorts before anything else a name can hold.
+    return relative.replace(os.sep, "\0")
+
+
+def writeIndex(path, files, metadata):
+    """
+    Replace the index at ``path``.
+
+    @type path: L{FilePath}
+    @param files: A manifest mapping relative paths to L{statEntry}s.
+    @param metadata: A L{dict} to record alongside, serializable as JSON.
+    """
+    paths = sorted(files, key=_walkOrder)
+    meta = json.dumps(metadata)
+    # At most half full, so that probes stay short.
+    slotCount = max(1, len(paths) * 2)
+    slots = array("I", [0]) * slotCount
+    entries = []
+    offset = 0
+    for number, relative in enumerate(paths, 1):
+        ino, fileSize, mtime, ctime, key = files[relative]
+        entries.append(_ENTRY.pack(offset, len(relative), ino, fileSize, mtime,
+                                   ctime, binascii.unhexlify(key)))
+        offset += len(relative)
+        slot = _hash(relative) % slotCount
+        while slots[slot]:
+            slot = (slot + 1) % slotCount
+        slots[slot] = number
+    if sys.byteorder == "little":
+        slots.byteswap()
+    if not path.parent().exists():
+        path.parent().makedirs()
+    temporary = path.temporarySibling(".tmp")
+    with temporary.open("w") as f:
+        f.write(_HEADER.pack(MAGIC, len(paths), len(slots), len(meta),
+                             offset))
+        f.write(meta)
+        f.write(slots.tostring())
+        f.write("".join(entries))
+        f.write("".join(paths))
+    os.rename(temporary.path, path.path)
+
+
+class BranchIndex(object):
+    """
+    An index written by L{writeIndex}, which can be used wherever a manifest
+    is only looked up in.  It must be closed, directly or by using it as a
+    context manager, to unmap it.
+
+    @ivar metadata: The metadata recorded with the index.
+    """
+    def __init__(self, data):
+        self._data = data
+        if len(data) < _HEADER.size:
+            raise CorruptIndex()
+        (magic, self._count, self._slots, metaLength,
+         pathsLength) = _HEADER.unpack_from(data)
+        self._slotsOffset = _HEADER.size + metaLength
+        self._entriesOffset = self._slotsOffset + self._slots * _SLOT.size
+        self._pathsOffset = self._entriesOffset + self._count * _ENTRY.size
+        if (magic != MAGIC
+                or len(data) != self._pathsOffset + pathsLength):
+            raise CorruptIndex()
+        self.metadata = json.loads(data[_HEADER.size:self._slotsOffset])
+
+    @classmethod
+    def open(cls, path):
+        """
+        Map the index at ``path`` into memory.
+
+        @type path: L{FilePath}
+        @return: The L{BranchIndex}, or C{None} if there is no usable index
+            there.
+        """
+        try:
+            f = path.open()
+        except IOError:
+            return None
+        with f:
+            try:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, EnvironmentError):
+                # An empty file.
+                return None
+        try:
+            return cls(data)
+        except (CorruptIndex, ValueError, struct.error):
+            data.close()
+            return None
+
+    def close(self):
+        """
+        Unmap the index.  It can't be looked up in afterwards.
+        """
+        self._data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self._count
+
+    def _entry(self, number):
+        """
+        Return the relative path and L{statEntry} of an entry.
+        """
+        offset, length, ino, size, mtime, ctime, key = _ENTRY.unpack_from(
+            self._data, self._entriesOffset + number * _ENTRY.size)
+        start = self._pathsOffset + offset
+        return (self._data[start:start + length],
+                [ino, size, mtime, ctime, binascii.hexlify(key)])
+
+    def get(self, relative, default=None):
+        slot = _hash(relative) % self._slots
+        while True:
+            number, = _SLOT.unpack_from(
+                self._data, self._slotsOffset + slot * _SLOT.size)
+            if not number:
+                return default
+            path, entry = self._entry(number - 1)
+            if path == relative:
+                return entry
+            slot = (slot + 1) % self._slots
+
+    def __getitem__(self, relative):
+        entry = self.get(relative)
+        if entry is None:
+            raise KeyError(relative)
+        return entry
+
+    def __contains__(self, relative):
+        return self.get(relative) is not None
+
+    def iteritems(self):
+        """
+        Yield the relative path and L{statEntry} of every file, in the order
+        the tree is walked.
+        """
+        for number in xrange(self._count):
+            yield self._entry(number)
+
+    def __iter__(self):
+        for relative, _ in self.iteritems():
+            yield relative
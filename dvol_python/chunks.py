@@ -0,0 +1,238 @@
+"""
+Storing large files as fixed-size chunks.
+
+Database files are large and only a few of their pages change between
+commits, so storing each version of them as a whole object writes and keeps
+mostly the same data again.  A volume can instead store files above a size
+threshold as chunks: each chunk is an object of its own, and the object
+linked into the commit directory is a recipe listing the keys of the chunks
+the file is made of.  A commit then only writes the chunks which changed,
+and resetting a branch whose file is still the one from its last commit only
+rewrites the chunks which differ.
+
+Each recipe has a directory of hard links to its chunks, so that chunks stay
+linked for as long as any recipe needs them and can be pruned the same way
+as other objects.
+"""
+
+import errno
+import hashlib
+import mmap
+import os
+
+from objectstore import (
+    ObjectStore, SourceChanged, _objectHeader, _unchangedSince, copyMetadata,
+)
+
+CHUNKS_DIRECTORY = ".chunks"
+
+# The size of each chunk; a multiple of the block size of every filesystem
+# dvol is likely to be used on, so that chunks can be cloned into place.
+CHUNK_SIZE = 1024 * 1024
+
+# Files smaller than this are stored whole.
+CHUNKED_THRESHOLD = 64 * 1024 * 1024
+
+_RECIPE_HEADER = "dvol-chunks"
+
+
+def _chunkKey(chunk):
+    return hashlib.sha1("chunk %d\0" % (len(chunk),) + chunk).hexdigest()
+
+
+def _recipe(chunkSize, size, keys):
+    return "%s %d %d\n%s" % (
+        _RECIPE_HEADER, chunkSize, size, "".join(key + "\n" for key in keys))
+
+
+def _recipeKey(recipe, st):
+    return hashlib.sha1("chunked " + _objectHeader(st) + recipe).hexdigest()
+
+
+class ChunkStore(object):
+    """
+    Chunks of large files, and recipes for reassembling them.
+
+    @ivar path: The L{FilePath} of the store, normally
+        C{<volume>/commits/.chunks}.
+    @ivar objects: The L{ObjectStore} holding the recipes, the one the
+        volume's other files are stored in.
+    @ivar chunks: The L{ObjectStore} holding the chunks.
+    """
+    def __init__(self, path, objects, chunkSize=None, threshold=None):
+        self.path = path
+        self.objects = objects
+        self.chunks = ObjectStore(path.child("objects"),
+                                  compressed=objects.compressed)
+        self._recipes = path.child("recipes")
+        self.chunkSize = chunkSize or CHUNK_SIZE
+        self.threshold = threshold or CHUNKED_THRESHOLD
+
+    def wanted(self, st):
+        """
+        Return whether the regular file with stat result ``st`` should be
+        stored as chunks.
+        """
+        return st.st_size >= self.threshold
+
+    def isRecipe(self, key):
+        return self._recipes.child(key).isdir()
+
+    def readRecipe(self, key):
+        """
+        Return the chunk size, file size and chunk keys of a recipe.
+        """
+        lines = self.objects.read(key).splitlines()
+        header, chunkSize, size = lines[0].split()
+        if header != _RECIPE_HEADER:
+            raise ValueError("Object %s is not a recipe" % (key,))
+        return int(chunkSize), int(size), lines[1:]
+
+    def store(self, source, st, verify=False):
+        """
+        Store the regular file ``source`` as chunks, writing the ones which
+        aren't stored yet.
+
+        @param verify: Whether to check that ``source`` still has the stat
+            result ``st`` once it has been read, as for L{ObjectStore.store}.
+
+        @return: The key of the recipe object.
+        """
+        keys = []
+        written = []
+        with open(source, "rb") as f:
+            try:
+                data = mmap.mmap(f.fileno(), st.st_size,
+                                 access=mmap.ACCESS_READ)
+            except (ValueError, EnvironmentError):
+                # The file shrank since it was found.
+                if verify:
+                    raise SourceChanged(source)
+                raise
+            try:
+                for offset in xrange(0, st.st_size, self.chunkSize):
+                    chunk = data[offset:offset + self.chunkSize]
+                    key = _chunkKey(chunk)
+                    if self.chunks.storeData(chunk, key)[1]:
+                        written.append(key)
+                    keys.append(key)
+            finally:
+                data.close()
+        recipe = _recipe(self.chunkSize, st.st_size, keys)
+        if verify and not _unchangedSince(source, st):
+            self.chunks.prune(written)
+            raise SourceChanged(source)
+        key = _recipeKey(recipe, st)
+        if not self.objects.objectPath(key).exists():
+            self._link(key, keys)
+            self.objects.storeData(recipe, key, st)
+        return key
+
+    def hashFile(self, source, st, chunkSize=None):
+        """
+        Compute the key of the recipe L{store} would make of the regular file
+        ``source``, without storing anything.
+
+        @param chunkSize: The size of the chunks to split the file into, or
+            C{None} for L{chunkSize}.
+        """
+        chunkSize = chunkSize or self.chunkSize
+        keys = []
+        with open(source, "rb") as f:
+            for chunk in iter(lambda: f.read(chunkSize), ""):
+                keys.append(_chunkKey(chunk))
+        return _recipeKey(_recipe(chunkSize, st.st_size, keys), st)
+
+    def _link(self, key, keys):
+        """
+        Make the directory of hard links to the chunks of a recipe.
+        """
+        links = self._recipes.child(key)
+        if links.exists():
+            return
+        temporary = links.temporarySibling()
+        temporary.makedirs()
+        for chunk in set(keys):
+            os.link(self.chunks.objectPath(chunk).path,
+                    temporary.child(chunk).path)
+        try:
+            os.rename(temporary.path, links.path)
+        except OSError, e:
+            # Another thread storing an identical file got there first.
+            if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise
+            temporary.remove()
+
+    def assemble(self, key, destination, st, base=None):
+        """
+        Write the file described by a recipe to ``destination``.
+
+        @param st: The stat result of the recipe object, whose mode,
+            ownership and times the file is given.
+        @param base: The key of the recipe ``destination`` already holds, if
+            it exists, in which case only the chunks which differ are
+            written.
+
+        @return: The number of bytes written.
+        """
+        chunkSize, size, keys = self.readRecipe(key)
+        existing = []
+        if base is not None:
+            baseChunkSize, _, existing = self.readRecipe(base)
+            if baseChunkSize != chunkSize:
+                existing = []
+        clone = None
+        if not self.chunks.compressed:
+            clone = getattr(self.objects.copier, "cloneInto", None)
+        written = 0
+        fd = os.open(destination, os.O_RDWR | os.O_CREAT, 0600)
+        with os.fdopen(fd, "r+b") as f:
+            f.truncate(size)
+            data = None
+            try:
+                for index, chunk in enumerate(keys):
+                    if index < len(existing) and existing[index] == chunk:
+                        continue
+                    offset = index * chunkSize
+                    if clone is not None:
+                        with self.chunks.objectPath(chunk).open() as c:
+                            try:
+                                clone(c, f, offset)
+                                written += os.fstat(c.fileno()).st_size
+                                continue
+                            except IOError:
+                                clone = None
+                    content = self.chunks.read(chunk)
+                    if data is None:
+                        data = mmap.mmap(f.fileno(), size)
+                    data[offset:offset + len(content)] = content
+                    written += len(content)
+            finally:
+                if data is not None:
+                    data.close()
+        copyMetadata(destination, st)
+        return written
+
+    def prune(self, keys=None):
+        """
+        Remove the chunk links of recipes which have been pruned from
+        L{objects}, and then the chunks no longer linked from any recipe.
+
+        @param keys: The keys of the recipes which may have been pruned, or
+            C{None} to check every recipe.
+
+        @return: The number of chunks removed.
+        """
+        if not self._recipes.exists():
+            return 0
+        if keys is None:
+            candidates = self._recipes.children()
+        else:
+            candidates = [self._recipes.child(key) for key in set(keys)
+                          if self.isRecipe(key)]
+        chunks = set()
+        for links in candidates:
+            if not self.objects.objectPath(links.basename()).exists():
+                chunks.update(links.listdir())
+                links.remove()
+        return self.chunks.prune(None if keys is None else chunks)
@@ -0,0 +1,588 @@
+"""
+Databases of the commits on each branch of a volume.
+
+Each branch has an ordered list of commits, oldest first, which every
+implementation here exposes through the same C{read}/C{write} surface plus
+cheaper operations for the common cases of appending a commit, looking one
+up relative to HEAD and discarding the newest commits.
+"""
+
+import json
+import os
+import sqlite3
+import struct
+import threading
+
+import durable
+
+DATABASE_FILENAME = "dvol.sqlite"
+
+# Number of bytes of log which may be appended before the index is brought
+# up to date; bounds how much of the log a lookup has to scan.
+INDEX_INTERVAL = 64 * 1024
+
+_OFFSET = struct.Struct("<Q")
+
+
+class JsonCommitDatabase(object):
+    """
+    Store the commits of each branch as a JSON list in
+    C{<volume>/branches/<branch>.json}, rewriting the whole list on every
+    change.
+    """
+    name = "json"
+
+    def __init__(self, directory):
+        self._directory = directory
+
+    def _getCommitDB(self, volume, branch):
+        volume = self._directory.child(volume).child("branches")
+        commits = volume.child("%s.json" % (branch,))
+        return commits
+
+    def read(self, volume, branch):
+        commits = self._getCommitDB(volume, branch)
+        if not commits.exists():
+            return []
+        commitData = json.loads(commits.getContent())
+        return commitData
+
+    def _store(self, volume, branch, commitData):
+        serialized = json.dumps(commitData)
+        commits = self._getCommitDB(volume, branch)
+        durable.setContent(commits, serialized)
+
+    def _remove(self, volume, branch):
+        commits = self._getCommitDB(volume, branch)
+        if commits.exists():
+            commits.remove()
+
+    def write(self, volume, branch, commitData):
+        self._ensureReferences(volume)
+        previous = self.read(volume, branch)
+        self._store(volume, branch, commitData)
+        self._changeReferences(volume, previous, commitData)
+
+    def append(self, volume, branch, commit):
+        commitData = self.read(volume, branch)
+        commitData.append(commit)
+        self.write(volume, branch, commitData)
+
+    def commitFromHead(self, volume, branch, offset):
+        """
+        Return the commit ``offset`` commits before the latest one on a
+        branch, raising L{IndexError} if there isn't one.
+        """
+        return self.read(volume, branch)[-1 - offset]
+
+    def discard(self, volume, branch, count):
+        """
+        Remove the newest ``count`` commits from a branch.
+
+        @return: The removed commits, oldest first.
+        """
+        commits = self.read(volume, branch)
+        remaining = commits[:max(len(commits) - count, 0)]
+        self.write(volume, branch, remaining)
+        return commits[len(remaining):]
+
+    def _getReferences(self, volume):
+        return self._directory.child(volume).child("references.json")
+
+    def _readReferences(self, volume):
+        self._ensureReferences(volume)
+        return json.loads(self._getReferences(volume).getContent())
+
+    def referenceCount(self, volume, commitId):
+        """
+        Return the number of branches whose history includes a commit.
+
+        The counts are kept up to date as commits are recorded and discarded,
+        in a JSON mapping from commit id to count in
+        C{<volume>/references.json}, so this doesn't read any branch's
+        history.
+        """
+        return self._readReferences(volume).get(commitId, 0)
+
+    def _ensureReferences(self, volume):
+        if not self._getReferences(volume).exists():
+            self.rebuildReferences(volume)
+
+    def rebuildReferences(self, volume):
+        """
+        Recount the references to the commits of a volume from the history of
+        every branch, for volumes which predate reference counts or whose
+        counts were left inaccurate by an interrupted command.
+        """
+        counts = {}
+        for branch in self._branchNames(volume):
+            for commit in self.read(volume, branch):
+                counts[commit["id"]] = counts.get(commit["id"], 0) + 1
+        durable.setContent(self._getReferences(volume), json.dumps(counts))
+        # counts were once kept in a file per commit
+        legacy = self._directory.child(volume).child("references")
+        if legacy.exists():
+            legacy.remove()
+
+    def _changeReferences(self, volume, removed, added):
+        """
+        Update the reference counts for commits having been removed from and
+        added to a branch, with a single write however many commits changed.
+        """
+        changes = {}
+        for commit in removed:
+            changes[commit["id"]] = changes.get(commit["id"], 0) - 1
+        for commit in added:
+            changes[commit["id"]] = changes.get(commit["id"], 0) + 1
+        if not any(changes.itervalues()):
+            return
+        counts = self._readReferences(volume)
+        for commitId, change in changes.iteritems():
+            count = counts.get(commitId, 0) + change
+            if count > 0:
+                counts[commitId] = count
+            else:
+                counts.pop(commitId, None)
+        durable.setContent(self._getReferences(volume), json.dumps(counts))
+
+    def branchesReferencing(self, volume, commitId):
+        """
+        Return the names of the branches of a volume whose history includes
+        a commit.
+        """
+        return sorted(
+            branch for branch in self._branchNames(volume)
+            if commitId in [c["id"] for c in self.read(volume, branch)])
+
+    def _branchNames(self, volume):
+        """
+        Return the names of the branches of a volume which have commits
+        recorded in files.
+        """
+        branches = self._directory.child(volume).child("branches")
+        if not branches.exists():
+            return set()
+        names = set()
+        for path in branches.children():
+            name, extension = os.path.splitext(path.basename())
+            if extension in (".json", ".log"):
+                names.add(name)
+        return names
+
+    def deleteBranch(self, volume, branch):
+        self._ensureReferences(volume)
+        previous = self.read(volume, branch)
+        self._remove(volume, branch)
+        self._changeReferences(volume, previous, [])
+
+    def deleteVolume(self, volume):
+        # The commits are removed along with the volume's directory.
+        pass
+
+    def _getManifest(self, volume, commitId):
+        return self._directory.child(volume).child("manifests").child(
+            "%s.json" % (commitId,))
+
+    def readManifest(self, volume, commitId):
+        """
+        Return the stat manifest recorded for a commit, or C{None} for commits
+        made before manifests were recorded.
+        """
+        manifest = self._getManifest(volume, commitId)
+        if not manifest.exists():
+            return None
+        return json.loads(manifest.getContent())
+
+    def writeManifest(self, volume, commitId, manifest):
+        path = self._getManifest(volume, commitId)
+        if not path.parent().exists():
+            path.parent().makedirs()
+        durable.setContent(path, json.dumps(manifest))
+
+    def _getTree(self, volume, commitId):
+        return self._directory.child(volume).child("manifests").child(
+            "%s.tree.json" % (commitId,))
+
+    def readTree(self, volume, commitId):
+        """
+        Return the hash of each directory of a commit, or C{None} for commits
+        made before tree hashes were recorded.
+        """
+        tree = self._getTree(volume, commitId)
+        if not tree.exists():
+            return None
+        return json.loads(tree.getContent())
+
+    def writeTree(self, volume, commitId, tree):
+        path = self._getTree(volume, commitId)
+        if not path.parent().exists():
+            path.parent().makedirs()
+        durable.setContent(path, json.dumps(tree))
+
+    def removeManifest(self, volume, commitId):
+        for path in (self._getManifest(volume, commitId),
+                     self._getTree(volume, commitId)):
+            if path.exists():
+                path.remove()
+
+
+class LogCommitDatabase(JsonCommitDatabase):
+    """
+    Store the commits of each branch as an append-only log of one JSON object
+    per line in C{<volume>/branches/<branch>.log}, so that recording a commit
+    doesn't rewrite the branch's history.
+
+    C{<branch>.idx} holds the byte offset of the end of each line in the log,
+    as little-endian 64-bit integers, which lets a commit be found by its
+    position without parsing the lines before it.  Appending only writes to
+    the log; once more than L{INDEX_INTERVAL} bytes of it are not covered by
+    the index, the index is extended to cover them.
+
+    Branches whose commits were written by L{JsonCommitDatabase} are read
+    from their JSON file until they are next changed, at which point they are
+    converted to a log.
+    """
+    name = "log"
+
+    def _getLog(self, volume, branch):
+        return self._directory.child(volume).child("branches").child(
+            "%s.log" % (branch,))
+
+    def _getIndex(self, volume, branch):
+        return self._directory.child(volume).child("branches").child(
+            "%s.idx" % (branch,))
+
+    def _migrate(self, volume, branch):
+        """
+        Convert a branch from the JSON format to a log if it hasn't been
+        already.
+        """
+        if not self._getLog(volume, branch).exists():
+            self._store(volume, branch, JsonCommitDatabase.read(
+                self, volume, branch))
+
+    def _indexedEnd(self, volume, branch):
+        """
+        Return the offset in the log up to which lines are indexed, and how
+        many lines that is, without reading the whole index.
+        """
+        index = self._getIndex(volume, branch)
+        if not index.exists():
+            return 0, 0
+        with index.open("r") as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if size < _OFFSET.size:
+                return 0, 0
+            f.seek(size - _OFFSET.size)
+            return _OFFSET.unpack(f.read(_OFFSET.size))[0], size // _OFFSET.size
+
+    def _tail(self, volume, branch, start):
+        """
+        Return the end offsets and contents of the complete lines of the log
+        from ``start``.  A final line without a newline, left by an append
+        which was interrupted, is ignored.
+        """
+        with self._getLog(volume, branch).open("r") as f:
+            f.seek(start)
+            data = f.read()
+        lines = []
+        position = start
+        for line in data.split("\n")[:-1]:
+            position += len(line) + 1
+            lines.append((position, line))
+        return lines
+
+    def _updateIndex(self, volume, branch):
+        end, _ = self._indexedEnd(volume, branch)
+        tail = self._tail(volume, branch, end)
+        if tail:
+            with self._getIndex(volume, branch).open("a") as f:
+                f.write("".join(_OFFSET.pack(offset) for offset, _ in tail))
+
+    def read(self, volume, branch):
+        if not self._getLog(volume, branch).exists():
+            return JsonCommitDatabase.read(self, volume, branch)
+        return [json.loads(line) for _, line in self._tail(volume, branch, 0)]
+
+    def _store(self, volume, branch, commitData):
+        log = self._getLog(volume, branch)
+        index = self._getIndex(volume, branch)
+        lines = [json.dumps(commit) + "\n" for commit in commitData]
+        offsets = []
+        position = 0
+        for line in lines:
+            position += len(line)
+            offsets.append(_OFFSET.pack(position))
+        durable.setContent(index, "".join(offsets))
+        durable.setContent(log, "".join(lines))
+        legacy = self._getCommitDB(volume, branch)
+        if legacy.exists():
+            legacy.remove()
+
+    def append(self, volume, branch, commit):
+        self._ensureReferences(volume)
+        self._migrate(volume, branch)
+        with self._getLog(volume, branch).open("a") as f:
+            f.write(json.dumps(commit) + "\n")
+            size = f.tell()
+            durable.appended(f)
+        end, _ = self._indexedEnd(volume, branch)
+        if size - end > INDEX_INTERVAL:
+            self._updateIndex(volume, branch)
+        self._changeReferences(volume, [], [commit])
+
+    def commitFromHead(self, volume, branch, offset):
+        if offset < 0:
+            raise IndexError(offset)
+        if not self._getLog(volume, branch).exists():
+            return JsonCommitDatabase.commitFromHead(
+                self, volume, branch, offset)
+        end, count = self._indexedEnd(volume, branch)
+        tail = self._tail(volume, branch, end)
+        if offset < len(tail):
+            return json.loads(tail[-1 - offset][1])
+        position = count - 1 - (offset - len(tail))
+        if position < 0:
+            raise IndexError(offset)
+        with self._getIndex(volume, branch).open("r") as f:
+            if position == 0:
+                start = 0
+            else:
+                f.seek((position - 1) * _OFFSET.size)
+                start = _OFFSET.unpack(f.read(_OFFSET.size))[0]
+            f.seek(position * _OFFSET.size)
+            stop = _OFFSET.unpack(f.read(_OFFSET.size))[0]
+        with self._getLog(volume, branch).open("r") as f:
+            f.seek(start)
+            return json.loads(f.read(stop - start - 1))
+
+    def discard(self, volume, branch, count):
+        self._ensureReferences(volume)
+        self._migrate(volume, branch)
+        self._updateIndex(volume, branch)
+        _, total = self._indexedEnd(volume, branch)
+        length = max(total - count, 0)
+        with self._getIndex(volume, branch).open("r+") as f:
+            end = 0
+            if length:
+                f.seek((length - 1) * _OFFSET.size)
+                end = _OFFSET.unpack(f.read(_OFFSET.size))[0]
+            f.truncate(length * _OFFSET.size)
+        discarded = [json.loads(line)
+                     for offset, line in self._tail(volume, branch, end)]
+        with self._getLog(volume, branch).open("r+") as f:
+            f.truncate(end)
+        self._changeReferences(volume, discarded, [])
+        return discarded
+
+    def _remove(self, volume, branch):
+        JsonCommitDatabase._remove(self, volume, branch)
+        for path in (self._getLog(volume, branch),
+                     self._getIndex(volume, branch)):
+            if path.exists():
+                path.remove()
+
+
+class SQLiteCommitDatabase(JsonCommitDatabase):
+    """
+    Store the commits of every volume in the pool in one SQLite database,
+    C{<pool>/dvol.sqlite}, indexed by commit id, branch position and creation
+    time, so that no command has to parse a whole branch's history and the
+    branches referring to a commit can be found without reading every branch.
+
+    Stat manifests and tree hashes are still stored as files alongside the
+    commits they describe.
+
+    The C{created} column is the time a commit was originally made, taken
+    from the commit's C{created} field, and is unknown for commits recorded
+    before commits had one.  Commits are read back with their C{created}
+    field, so rewriting a branch keeps their times.
+    """
+    name = "sqlite"
+
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS commits (
+            volume TEXT NOT NULL,
+            branch TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            id TEXT NOT NULL,
+            created REAL,
+            data TEXT NOT NULL,
+            PRIMARY KEY (volume, branch, position)
+        );
+        CREATE INDEX IF NOT EXISTS commits_by_id ON commits (volume, id);
+        CREATE INDEX IF NOT EXISTS commits_by_created
+            ON commits (volume, created);
+    """
+
+    def __init__(self, directory):
+        JsonCommitDatabase.__init__(self, directory)
+        self._connection = None
+        self._connectionLock = threading.Lock()
+
+    def _connect(self):
+        with self._connectionLock:
+            if self._connection is None:
+                connection = sqlite3.connect(
+                    self._directory.child(DATABASE_FILENAME).path,
+                    check_same_thread=False)
+                connection.executescript(self._SCHEMA)
+                self._connection = connection
+        return self._connection
+
+    def _execute(self, query, *parameters):
+        connection = self._connect()
+        with self._connectionLock, connection:
+            return connection.execute(query, parameters).fetchall()
+
+    def _insert(self, connection, volume, branch, position, commit):
+        connection.execute(
+            "INSERT INTO commits (volume, branch, position, id, created, data) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (volume, branch, position, commit["id"], commit.get("created"),
+             json.dumps(commit)))
+
+    def _commit(self, data, created):
+        """
+        Load a commit stored as ``data``, with the C{created} column as its
+        C{created} field if it doesn't have one.
+        """
+        commit = json.loads(data)
+        if created is not None:
+            commit.setdefault("created", created)
+        return commit
+
+    def read(self, volume, branch):
+        return [self._commit(data, created) for (data, created)
+                in self._execute(
+                    "SELECT data, created FROM commits "
+                    "WHERE volume = ? AND branch = ? ORDER BY position",
+                    volume, branch)]
+
+    def write(self, volume, branch, commitData):
+        connection = self._connect()
+        with self._connectionLock, connection:
+            connection.execute(
+                "DELETE FROM commits WHERE volume = ? AND branch = ?",
+                (volume, branch))
+            for position, commit in enumerate(commitData):
+                self._insert(connection, volume, branch, position, commit)
+
+    def append(self, volume, branch, commit):
+        connection = self._connect()
+        with self._connectionLock, connection:
+            (position,), = connection.execute(
+                "SELECT COALESCE(MAX(position) + 1, 0) FROM commits "
+                "WHERE volume = ? AND branch = ?", (volume, branch))
+            self._insert(connection, volume, branch, position, commit)
+
+    def commitFromHead(self, volume, branch, offset):
+        if offset < 0:
+            raise IndexError(offset)
+        rows = self._execute(
+            "SELECT data, created FROM commits "
+            "WHERE volume = ? AND branch = ? "
+            "ORDER BY position DESC LIMIT 1 OFFSET ?", volume, branch, offset)
+        if not rows:
+            raise IndexError(offset)
+        return self._commit(*rows[0])
+
+    def discard(self, volume, branch, count):
+        connection = self._connect()
+        with self._connectionLock, connection:
+            rows = connection.execute(
+                "SELECT position, data, created FROM commits "
+                "WHERE volume = ? AND branch = ? "
+                "ORDER BY position DESC LIMIT ?",
+                (volume, branch, count)).fetchall()
+            if rows:
+                connection.execute(
+                    "DELETE FROM commits WHERE volume = ? AND branch = ? "
+                    "AND position >= ?", (volume, branch, rows[-1][0]))
+        return [self._commit(data, created)
+                for _, data, created in reversed(rows)]
+
+    def referenceCount(self, volume, commitId):
+        # The commits_by_id index makes this a lookup rather than a scan.
+        (count,), = self._execute(
+            "SELECT COUNT(*) FROM commits WHERE volume = ? AND id = ?",
+            volume, commitId)
+        return count
+
+    def rebuildReferences(self, volume):
+        # References are counted from the commits table when asked for, so
+        # there is nothing to rebuild.
+        pass
+
+    def branchesReferencing(self, volume, commitId):
+        return [branch for (branch,) in self._execute(
+            "SELECT DISTINCT branch FROM commits WHERE volume = ? AND id = ? "
+            "ORDER BY branch", volume, commitId)]
+
+    def deleteBranch(self, volume, branch):
+        self._execute("DELETE FROM commits WHERE volume = ? AND branch = ?",
+                      volume, branch)
+
+    def deleteVolume(self, volume):
+        self._execute("DELETE FROM commits WHERE volume = ?", volume)
+
+    def migrate(self, source):
+        """
+        Copy the commits of every volume in the pool out of the files written
+        by ``source``, then remove those files.
+
+        The database is written under a temporary name and renamed into
+        place once it holds every branch, which is what switches the pool
+        over, so that a crash part of the way through leaves the pool using
+        ``source``.  The caller must hold the exclusive lock of every volume.
+
+        @type source: L{JsonCommitDatabase}
+        @return: The number of branches migrated.
+        """
+        database = self._directory.child(DATABASE_FILENAME)
+        temporary = database.siblingExtension(".migrating")
+        if temporary.exists():
+            # Left behind by an interrupted migration.
+            temporary.remove()
+        migrated = []
+        connection = sqlite3.connect(temporary.path)
+        try:
+            connection.executescript(self._SCHEMA)
+            with connection:
+                for volumePath in self._directory.children():
+                    if not volumePath.child("branches").isdir():
+                        continue
+                    volume = volumePath.basename()
+                    for branch in source._branchNames(volume):
+                        for position, commit in enumerate(
+                                source.read(volume, branch)):
+                            self._insert(connection, volume, branch,
+                                         position, commit)
+                        migrated.append((volume, branch))
+        finally:
+            connection.close()
+        os.rename(temporary.path, database.path)
+        # Only remove the files once the database has them.
+        durable.syncFilesystem(self._directory)
+        for volume, branch in migrated:
+            source._remove(volume, branch)
+        for volume in set(volume for volume, _ in migrated):
+            for references in (source._getReferences(volume),
+                               self._directory.child(volume).child(
+                                   "references")):
+                if references.exists():
+                    references.remove()
+        return len(migrated)
+
+
+def commitDatabaseForPool(directory):
+    """
+    Return the commit database used by the pool at ``directory``: the SQLite
+    database if the pool has been migrated to one, otherwise commit logs.
+
+    @type directory: L{FilePath}
+    """
+    if directory.child(DATABASE_FILENAME).exists():
+        return SQLiteCommitDatabase(directory)
+    return LogCommitDatabase(directory)
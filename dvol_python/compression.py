@@ -0,0 +1,110 @@
+"""
+Compressing stored objects.
+
+A compressed object is a header followed by frames, each holding one block
+of the original file compressed on its own, or stored as it is if it
+doesn't compress.  Independent blocks let the blocks of a large file be
+compressed by several threads at once, since zlib doesn't hold the GIL while
+it works, and let objects be decompressed a block at a time straight into
+the file being restored.
+"""
+
+import struct
+import zlib
+from multiprocessing.pool import ThreadPool
+
+from copiers import BUFFER_SIZE, defaultWorkers
+
+MAGIC = "dvol-zlib\n"
+
+BLOCK_SIZE = BUFFER_SIZE
+
+LEVEL = 6
+
+# Files of at least this many blocks have their blocks compressed by
+# several threads.
+PARALLEL_BLOCKS = 8
+
+_FRAME = struct.Struct(">BI")
+_STORED = 0
+_DEFLATED = 1
+
+
+class CorruptObject(Exception):
+    """
+    A compressed object couldn't be read.
+    """
+
+
+def _compressBlock(block):
+    compressed = zlib.compress(block, LEVEL)
+    if len(compressed) < len(block):
+        return _FRAME.pack(_DEFLATED, len(compressed)) + compressed
+    return _FRAME.pack(_STORED, len(block)) + block
+
+
+def compressData(data):
+    """
+    Return the compressed object holding ``data``.
+    """
+    return MAGIC + "".join(
+        _compressBlock(data[offset:offset + BLOCK_SIZE])
+        for offset in xrange(0, len(data), BLOCK_SIZE))
+
+
+def compressFile(source, destination, size, workers=None):
+    """
+    Write the compressed object holding the contents of the file ``source``
+    to ``destination``.
+
+    @param size: The size of ``source``, which decides whether its blocks
+        are worth compressing in parallel.
+    @param workers: The number of threads compressing the blocks of a large
+        file, or C{None} for one per core.
+    """
+    if workers is None:
+        workers = defaultWorkers()
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        dst.write(MAGIC)
+        if workers <= 1 or size < BLOCK_SIZE * PARALLEL_BLOCKS:
+            for block in iter(lambda: src.read(BLOCK_SIZE), ""):
+                dst.write(_compressBlock(block))
+            return
+        # Read a few blocks per thread at a time, so that only those are
+        # held in memory however large the file is.
+        pool = ThreadPool(workers)
+        try:
+            while True:
+                blocks = [block for block in
+                          (src.read(BLOCK_SIZE) for _ in xrange(workers * 2))
+                          if block]
+                if not blocks:
+                    break
+                for frame in pool.map(_compressBlock, blocks):
+                    dst.write(frame)
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+def decompressedBlocks(path):
+    """
+    Yield the blocks of the original file from the compressed object at
+    ``path``.
+    """
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise CorruptObject(path)
+        while True:
+            header = f.read(_FRAME.size)
+            if not header:
+                return
+            if len(header) != _FRAME.size:
+                raise CorruptObject(path)
+            kind, length = _FRAME.unpack(header)
+            data = f.read(length)
+            if len(data) != length:
+                raise CorruptObject(path)
+            if kind == _DEFLATED:
+                data = zlib.decompress(data)
+            yield data
@@ -0,0 +1,239 @@
+"""
+Ways of copying file data within a dvol pool.
+
+Which one is used is decided once per pool, by checking whether the
+filesystem the pool lives on can clone files (e.g. btrfs or XFS with reflink
+support), in which case copies share data blocks and take near-constant time.
+"""
+
+import errno
+import fcntl
+import json
+import multiprocessing
+import os
+import struct
+import time
+import uuid
+from multiprocessing.pool import ThreadPool
+
+BUFFER_SIZE = 1024 * 1024
+
+# _IOW(0x94, 9, int) from linux/fs.h
+FICLONE = 0x40049409
+
+# _IOW(0x94, 13, struct file_clone_range) from linux/fs.h
+FICLONERANGE = 0x4020940d
+_FILE_CLONE_RANGE = struct.Struct("=qQQQ")
+
+COPIER_FILENAME = "copy_backend.json"
+
+# Minimum number of seconds between progress reports.
+PROGRESS_INTERVAL = 0.5
+
+
+class PlainCopier(object):
+    """
+    Copy file data by reading and writing it.
+    """
+    name = "copy"
+
+    def copyFile(self, source, destination):
+        """
+        Copy the contents of the regular file ``source`` to a new file at
+        ``destination``.
+        """
+        with open(source, "rb") as src, open(destination, "wb") as dst:
+            while True:
+                data = src.read(BUFFER_SIZE)
+                if not data:
+                    break
+                dst.write(data)
+
+
+class ReflinkCopier(object):
+    """
+    Copy file data by cloning it with the C{FICLONE} ioctl, so that the copy
+    shares its data blocks with the original until either is written to.
+    """
+    name = "reflink"
+
+    def copyFile(self, source, destination):
+        with open(source, "rb") as src, open(destination, "wb") as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+    def cloneInto(self, source, destination, offset):
+        """
+        Clone all of the open file ``source`` into the open file
+        ``destination`` at ``offset``, which must be a multiple of the
+        filesystem's block size.
+        """
+        fcntl.ioctl(destination.fileno(), FICLONERANGE,
+                    _FILE_CLONE_RANGE.pack(source.fileno(), 0, 0, offset))
+
+
+def defaultWorkers():
+    """
+    Return the number of threads to copy files with when none is configured:
+    one per core.
+    """
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def runInThreads(function, tasks, workers=None):
+    """
+    Call ``function`` with each of ``tasks`` on a pool of at most ``workers``
+    threads, yielding the results in the order they complete.  File copies
+    and hashing spend most of their time outside the GIL, so several of them
+    can make progress at once.
+
+    @param tasks: A L{list} of arguments for ``function``.
+    @param workers: The number of threads, or C{None} for
+        L{defaultWorkers}.
+    """
+    if workers is None:
+        workers = defaultWorkers()
+    workers = min(workers, len(tasks))
+    if workers <= 1:
+        for task in tasks:
+            yield function(task)
+        return
+    # Hand out several small files at a time so that trees of millions of
+    # them aren't dominated by queueing overhead.
+    chunksize = max(1, min(64, len(tasks) // (workers * 4)))
+    pool = ThreadPool(workers)
+    try:
+        for result in pool.imap_unordered(function, tasks, chunksize):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+class CopyStatistics(object):
+    """
+    Count the files and bytes processed by a tree operation, for reporting
+    its throughput.
+
+    @ivar totalFiles: The number of files the operation will process, once
+        it has found them.
+    @ivar totalBytes: Their total size.
+    @ivar progress: A callable taking the statistics and whether the
+        operation has finished, called at most every L{PROGRESS_INTERVAL}
+        seconds while files are processed and once when it finishes, or
+        C{None}.
+    @ivar reported: Whether progress has been reported before the operation
+        finished, which only happens if it took a while.
+    """
+    def __init__(self, clock=time.time, progress=None):
+        self._clock = clock
+        self.started = clock()
+        self.files = 0
+        self.bytes = 0
+        self.totalFiles = 0
+        self.totalBytes = 0
+        self.progress = progress
+        self.reported = False
+        self._lastProgress = self.started
+
+    def expect(self, files, size):
+        self.totalFiles += files
+        self.totalBytes += size
+
+    def add(self, size):
+        self.files += 1
+        self.bytes += size
+        if self.progress is not None:
+            now = self._clock()
+            if now - self._lastProgress >= PROGRESS_INTERVAL:
+                self._lastProgress = now
+                self.reported = True
+                self.progress(self, False)
+
+    def finish(self):
+        if self.progress is not None:
+            self.progress(self, True)
+
+    def elapsed(self):
+        return self._clock() - self.started
+
+    def rate(self):
+        """
+        Return the number of bytes processed per second so far.
+        """
+        elapsed = self.elapsed()
+        if elapsed <= 0:
+            return 0.0
+        return self.bytes / elapsed
+
+    def eta(self):
+        """
+        Return the estimated number of seconds until the expected bytes have
+        been processed, or C{None} if there is no rate to estimate from yet.
+        """
+        rate = self.rate()
+        if not rate:
+            return None
+        return max(self.totalBytes - self.bytes, 0) / rate
+
+    def describe(self):
+        return "%d files, %s in %.1fs (%s/s)" % (
+            self.files, formatSize(self.bytes), self.elapsed(),
+            formatSize(self.rate()))
+
+
+def formatSize(size):
+    """
+    Format a number of bytes for people to read.
+    """
+    if size < 1024:
+        return "%d B" % (size,)
+    for unit in ("KiB", "MiB", "GiB", "TiB"):
+        size /= 1024.0
+        if size < 1024 or unit == "TiB":
+            return "%.1f %s" % (size, unit)
+
+
+def _supportsReflink(directory):
+    """
+    Determine whether files in ``directory`` can be cloned, by trying it.
+    """
+    probe = directory.child(".reflink-probe-%s" % (uuid.uuid4(),))
+    clone = probe.siblingExtension(".clone")
+    try:
+        probe.setContent("dvol")
+        try:
+            ReflinkCopier().copyFile(probe.path, clone.path)
+        except (IOError, OSError):
+            return False
+        return clone.getContent() == "dvol"
+    finally:
+        for path in (probe, clone):
+            try:
+                os.remove(path.path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+
+COPIERS = dict((copier.name, copier) for copier in [PlainCopier, ReflinkCopier])
+
+
+def copierForPool(directory):
+    """
+    Return the copier to use for the pool at ``directory``, detecting which
+    one the pool's filesystem supports the first time and recording the
+    result in the pool.
+
+    @type directory: L{FilePath}
+    """
+    record = directory.child(COPIER_FILENAME)
+    if record.exists():
+        name = json.loads(record.getContent())["copy_backend"]
+    else:
+        name = (ReflinkCopier.name if _supportsReflink(directory)
+                else PlainCopier.name)
+        record.setContent(json.dumps(dict(copy_backend=name)))
+    return COPIERS[name]()
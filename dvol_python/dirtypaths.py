@@ -0,0 +1,417 @@
+"""
+Tracking which paths of a branch change between commits.
+
+While containers use a branch, the plugin watches its directory with
+inotify and appends the relative path of everything that changes to a log
+beside it, C{branches/<branch>.dirty}.  A commit then only needs to look at
+the paths logged since the branch's previous commit, and can copy the rest
+of that commit as it is, rather than walking and comparing the whole branch.
+
+A commit finds its place in the log by writing a fence token to
+C{branches/<branch>.fence}, which the watcher also watches.  inotify reports
+the events of a watcher in the order they happened, so once the token shows
+up in the log every change made before the commit started is logged before
+it.  The commit's manifest records the token, and the next commit collects
+the paths logged after it.  Once the manifest is written the commit writes
+C{recorded <token>} to the fence file, and the watcher replaces its log with
+one which starts at that fence, so the log only grows with what changed
+since the latest commit.
+
+The log can't be used, and commits fall back to looking at every file, when
+no watcher is running (the watcher holds a shared lock on the log while it
+runs), when the watcher was restarted since the previous commit, or when
+inotify dropped events because its queue overflowed.
+
+inotify reports no event for writes made through a shared memory mapping,
+so a file is only logged if it is also written, or opened for writing and
+closed, in the usual way.  A file which is changed through a mapping after
+the descriptor it was mapped from was closed is not logged at all, so a
+commit which uses the log keeps the previous commit's version of it.  This
+is a limitation of inotify which the log can't detect.
+"""
+
+import ctypes
+import errno
+import fcntl
+import os
+import select
+import struct
+import threading
+import time
+import uuid
+
+from twisted.python import log
+
+from durable import _getLibc
+
+DIRTY_EXTENSION = ".dirty"
+FENCE_EXTENSION = ".fence"
+
+# Seconds a commit waits for the watcher to log its fence before it looks
+# at every file instead.
+FENCE_TIMEOUT = 2
+
+# Written to the fence file with a fence a commit recorded.
+RECORDED = "recorded"
+
+POLL_INTERVAL = 0.01
+
+# From <sys/inotify.h>.
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_UNMOUNT = 0x00002000
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0x00080000
+
+_DIRECTORY_MASK = (
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+    | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+    | IN_DONT_FOLLOW)
+
+_EVENT = struct.Struct("=iIII")
+
+
+def _check(result, path=None):
+    if result < 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error), path)
+    return result
+
+
+def dirtyLogPath(branchPath):
+    return branchPath.siblingExtension(DIRTY_EXTENSION)
+
+
+def fencePath(branchPath):
+    return branchPath.siblingExtension(FENCE_EXTENSION)
+
+
+class BranchWatcher(object):
+    """
+    Log the paths which change in a branch directory, from a thread, for as
+    long as the directory exists.
+
+    @ivar branchPath: The L{FilePath} of the branch directory.
+    """
+    def __init__(self, branchPath):
+        self.branchPath = branchPath
+        self._directories = {}
+        self._recorded = set()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.isAlive()
+
+    def start(self):
+        """
+        Start logging the changes to the branch, unless it is being watched
+        already.
+
+        @return: Whether the watcher started.
+        """
+        logFD = os.open(dirtyLogPath(self.branchPath).path,
+                        os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            fcntl.flock(logFD, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            os.close(logFD)
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return False
+        os.ftruncate(logFD, 0)
+        self._log = os.fdopen(logFD, "w")
+        fence = fencePath(self.branchPath)
+        libc = _getLibc()
+        try:
+            self._fd = _check(libc.inotify_init1(IN_CLOEXEC))
+        except:
+            self._log.close()
+            raise
+        self._stopRead, self._stopWrite = os.pipe()
+        try:
+            if not fence.exists():
+                fence.setContent("")
+            self._write("start", uuid.uuid4().hex)
+            # Watch the fence first, so that a commit's fence which arrives
+            # while the tree is still being watched is logged after all of
+            # it is.
+            self._fenceWatch = _check(libc.inotify_add_watch(
+                self._fd, fence.path, IN_CLOSE_WRITE | IN_DELETE_SELF),
+                fence.path)
+            if not self._watchTree(""):
+                raise OSError(errno.ENOENT, "Branch disappeared",
+                              self.branchPath.path)
+        except:
+            self._close()
+            raise
+        fcntl.flock(logFD, fcntl.LOCK_SH)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        return True
+
+    def stop(self):
+        """
+        Stop watching, waiting for the thread to finish.
+        """
+        if self.running:
+            os.write(self._stopWrite, "x")
+            self._thread.join()
+
+    def _close(self):
+        for fd in (self._fd, self._stopRead, self._stopWrite):
+            os.close(fd)
+        # Releases the lock, telling commits that nothing is watching.
+        self._log.close()
+
+    def _write(self, kind, value=None):
+        if value is None:
+            self._log.write(kind + "\n")
+        else:
+            self._log.write("%s %s\n" % (kind, value))
+        self._log.flush()
+
+    def _record(self, relative):
+        if relative not in self._recorded:
+            self._recorded.add(relative)
+            self._write("path", relative.encode("string_escape"))
+
+    def _compact(self, fence):
+        """
+        Replace the log with one holding only its first line and what was
+        logged from ``fence`` on, which is all a commit after the one that
+        recorded ``fence`` looks at.
+        """
+        logPath = dirtyLogPath(self.branchPath)
+        lines = logPath.getContent().split("\n")[:-1]
+        try:
+            start = lines.index("fence " + fence)
+        except ValueError:
+            # logged before this watcher started
+            return
+        temporary = logPath.temporarySibling(".tmp")
+        compacted = temporary.open("w")
+        try:
+            # Locked before it replaces the log, so the branch never looks
+            # unwatched.
+            fcntl.flock(compacted.fileno(), fcntl.LOCK_SH)
+            compacted.write("".join(
+                line + "\n" for line in lines[:1] + lines[start:]))
+            compacted.flush()
+            os.rename(temporary.path, logPath.path)
+        except:
+            compacted.close()
+            temporary.remove()
+            raise
+        self._log.close()
+        self._log = compacted
+
+    def _watchTree(self, relative):
+        """
+        Watch a directory and every directory below it.
+
+        @return: Whether ``relative`` was still there to watch.
+        """
+        libc = _getLibc()
+        top = os.path.join(self.branchPath.path, relative)
+        if relative and not os.path.isdir(top):
+            return False
+        for directory, names, _ in os.walk(top):
+            try:
+                wd = _check(libc.inotify_add_watch(
+                    self._fd, directory, _DIRECTORY_MASK), directory)
+            except OSError, e:
+                if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                    raise
+                # It was removed before it could be watched, which its
+                # parent reports.
+                names[:] = []
+                if directory == top:
+                    return False
+                continue
+            directory = os.path.relpath(directory, self.branchPath.path)
+            self._directories[wd] = "" if directory == os.curdir else directory
+        return True
+
+    def _unwatchTree(self, relative):
+        libc = _getLibc()
+        for wd, directory in self._directories.items():
+            if directory == relative or directory.startswith(relative + "/"):
+                libc.inotify_rm_watch(self._fd, wd)
+                del self._directories[wd]
+
+    def _run(self):
+        try:
+            while True:
+                readable = select.select([self._fd, self._stopRead], [], [])[0]
+                if self._stopRead in readable:
+                    return
+                data = os.read(self._fd, 65536)
+                offset = 0
+                while offset < len(data):
+                    wd, mask, _, length = _EVENT.unpack_from(data, offset)
+                    offset += _EVENT.size
+                    name = data[offset:offset + length].rstrip("\0")
+                    offset += length
+                    if not self._handle(wd, mask, name):
+                        return
+        except:
+            log.err(None, "while watching %s" % (self.branchPath.path,))
+        finally:
+            self._write("stopped")
+            self._close()
+
+    def _handle(self, wd, mask, name):
+        """
+        Log an event.
+
+        @return: Whether to carry on watching.
+        """
+        if mask & IN_Q_OVERFLOW:
+            self._write("overflow")
+            return True
+        if wd == self._fenceWatch:
+            if mask & IN_CLOSE_WRITE:
+                fence = fencePath(self.branchPath).getContent().strip()
+                if fence.startswith(RECORDED + " "):
+                    self._compact(fence[len(RECORDED) + 1:])
+                elif fence:
+                    self._write("fence", fence)
+                    self._recorded = set()
+                return True
+            # The branch is being deleted.
+            return False
+        directory = self._directories.get(wd)
+        if directory is None:
+            # A directory which has since been moved or removed.
+            return True
+        if not name:
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_UNMOUNT
+                       | IN_IGNORED):
+                if not directory:
+                    return False
+                # Its parent reports the change.
+                self._directories.pop(wd, None)
+                return True
+            self._record(directory)
+            return True
+        relative = os.path.join(directory, name)
+        if mask & IN_ISDIR:
+            if mask & IN_MOVED_FROM:
+                self._unwatchTree(relative)
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                try:
+                    self._watchTree(relative)
+                except OSError:
+                    # Out of watches, most likely: changes below here would
+                    # go unnoticed from now on.
+                    log.err(None, "while watching %s" % (relative,))
+                    return False
+        self._record(relative)
+        return True
+
+
+def _watched(branchPath):
+    """
+    Return whether a L{BranchWatcher} is logging the changes to a branch.
+    """
+    logPath = dirtyLogPath(branchPath)
+    try:
+        fd = os.open(logPath.path, os.O_RDONLY)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError, e:
+        if e.errno not in (errno.EAGAIN, errno.EACCES):
+            raise
+        return True
+    finally:
+        os.close(fd)
+    return False
+
+
+def _readLog(branchPath):
+    """
+    Return the complete lines of a branch's log, each split into its kind
+    and value.
+    """
+    content = dirtyLogPath(branchPath).getContent()
+    return [line.partition(" ")[::2]
+            for line in content.split("\n")[:content.count("\n")]]
+
+
+def recorded(branchPath, mark):
+    """
+    Tell the watcher of a branch that a commit has recorded ``mark``, so that
+    it can forget what it logged before the mark's fence.
+
+    @param mark: The mark returned by L{changedPaths}, or C{None}.
+    """
+    if mark is None:
+        return
+    # Written in place, like a fence.
+    with fencePath(branchPath).open("w") as f:
+        f.write("%s %s" % (RECORDED, mark["fence"]))
+
+
+def changedPaths(branchPath, since, timeout=FENCE_TIMEOUT, clock=time.time,
+                 sleep=time.sleep):
+    """
+    Ask the watcher of a branch, if one is running, which paths have changed
+    since an earlier commit.
+
+    @param since: The mark returned for the earlier commit, or C{None}.
+
+    @return: A 2-tuple of the mark to record with a commit taken now, or
+        C{None} if the branch isn't being watched, and the L{set} of the
+        relative paths which changed since ``since``, or C{None} if they
+        aren't known.  Everything below a changed directory may have
+        changed too.
+    """
+    if not _watched(branchPath):
+        return None, None
+    fence = uuid.uuid4().hex
+    # Written in place rather than atomically replaced, so that the watcher
+    # sees the file it is watching closed.
+    with fencePath(branchPath).open("w") as f:
+        f.write(fence)
+    deadline = clock() + timeout
+    while True:
+        lines = _readLog(branchPath)
+        if ("fence", fence) in lines:
+            break
+        if (lines and lines[-1][0] == "stopped") or clock() >= deadline:
+            return None, None
+        sleep(POLL_INTERVAL)
+    mark = dict(token=lines[0][1], fence=fence)
+    if since is None or since.get("token") != mark["token"]:
+        return mark, None
+    paths = None
+    for kind, value in lines:
+        if kind == "fence" and value == since["fence"]:
+            paths = set()
+        elif kind == "fence" and value == fence:
+            break
+        elif paths is None:
+            continue
+        elif kind == "path":
+            paths.add(value.decode("string_escape"))
+        elif kind == "overflow":
+            paths = None
+            break
+    return mark, paths
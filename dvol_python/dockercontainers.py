@@ -1,14 +1,186 @@
-import docker
+import errno
+import fcntl
+import json
+import os
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
 from twisted.python import log
+from twisted.python.filepath import FilePath
 
 RETRIES = 5
 
+# How many containers are stopped or started at once by default.
+CONCURRENCY = 8
+
+# Where dvol volumes are mounted from.
+VOLUMES_PATH = "/var/lib/dvol/volumes"
+
+# The version of the Docker API dvol speaks.
+DOCKER_API_VERSION = "1.20"
+
+# The URL every request to the Docker socket is pooled under.
+SOCKET_POOL_URL = "http+docker://localunixsocket"
+
+# Where the plugin persists its index of the containers using each volume.
+INDEX_PATH = "/var/lib/dvol/containers.json"
+
 class NeverLocked(Exception):
     pass
 
 class AlreadyLocked(Exception):
     pass
 
+def _plugin_holds(path):
+    """
+    Return whether a running plugin holds the lock on the index at ``path``.
+    The lock is released by the kernel when the plugin exits, so unlike its
+    pid it can't be mistaken for an unrelated process.
+    """
+    try:
+        fd = os.open(path.siblingExtension(".lock").path, os.O_RDONLY)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+    except IOError, e:
+        if e.errno != errno.EWOULDBLOCK:
+            raise
+        return True
+    finally:
+        os.close(fd)
+    return False
+
+
+def read_index(path):
+    """
+    Read the index persisted by L{ContainerIndex}.
+
+    @type path: L{FilePath}
+    @return: mapping from volume name to mapping from the id to the name of
+        each running container using it, or C{None} if no running plugin is
+        keeping the index up to date.
+    """
+    if not _plugin_holds(path):
+        return None
+    try:
+        index = json.loads(path.getContent())
+    except (IOError, ValueError):
+        return None
+    return index["volumes"]
+
+
+class ContainerIndex(object):
+    """
+    The running containers using each dvol volume, kept up to date by the
+    plugin as Docker mounts volumes and starts and stops containers, and
+    persisted so that the CLI can look them up rather than asking Docker.
+
+    @ivar volumes: mapping from volume name to mapping from the id to the
+        name of each running container using it.
+    @ivar mounts: mapping from volume name to the set of ids of the mounts
+        Docker has asked for and not yet unmounted.
+    """
+    def __init__(self, path=FilePath(INDEX_PATH)):
+        self.path = path
+        self.volumes = dict()
+        self.mounts = dict()
+        self._lock = None
+
+    def hold(self):
+        """
+        Lock the index file's C{.lock} sibling for as long as this process
+        runs, so that L{read_index} knows the index is being kept up to date.
+
+        @raise IOError: if another plugin already holds it.
+        """
+        if self._lock is not None:
+            return
+        if not self.path.parent().exists():
+            self.path.parent().makedirs()
+        lock = open(self.path.siblingExtension(".lock").path, "a")
+        try:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except:
+            lock.close()
+            raise
+        self._lock = lock
+
+    def save(self):
+        self.hold()
+        self.path.setContent(json.dumps(dict(
+            volumes=self.volumes,
+            mounts=dict((volume, sorted(mounts))
+                        for volume, mounts in self.mounts.items() if mounts))))
+
+    def replace(self, scan):
+        """
+        Replace the index with the running containers in a L{Containers.scan}.
+        """
+        self.volumes = dict()
+        for volume, containers in scan.items():
+            running = dict((c['Id'], c['Name']) for c in containers
+                           if c['State']['Running'])
+            if running:
+                self.volumes[volume] = running
+        self.save()
+
+    def container_started(self, cid, name, volumes):
+        for volume in volumes:
+            self.volumes.setdefault(volume, dict())[cid] = name
+        self.save()
+
+    def container_stopped(self, cid):
+        for volume, containers in self.volumes.items():
+            containers.pop(cid, None)
+            if not containers:
+                del self.volumes[volume]
+        self.save()
+
+    def mounted(self, volume, mount_id):
+        self.mounts.setdefault(volume, set()).add(mount_id)
+        self.save()
+
+    def unmounted(self, volume, mount_id):
+        self.mounts.get(volume, set()).discard(mount_id)
+        self.save()
+
+
+_shared_client = []
+_client_lock = threading.Lock()
+
+
+def shared_client():
+    """
+    Return the Docker client shared by everything in this process, creating
+    it the first time.
+
+    docker-py's adapter for the unix socket keeps a separate pool of
+    connections for every URL, so the requests about each container would
+    otherwise open a connection of their own.  Every request goes to the
+    same socket, so they are all given one pool, and keep-alive connections
+    are reused from one request to the next.
+    """
+    with _client_lock:
+        if not _shared_client:
+            # docker-py takes a while to import; only commands which talk to
+            # Docker load it
+            import docker
+            client = docker.client.Client(version=DOCKER_API_VERSION)
+            adapter = getattr(client, "_custom_adapter", None)
+            if adapter is not None:
+                get_connection = adapter.get_connection
+
+                def one_pool(url, proxies=None):
+                    return get_connection(SOCKET_POOL_URL, proxies)
+                adapter.get_connection = one_pool
+            _shared_client.append(client)
+        return _shared_client[0]
+
+
 class Containers(object):
     """
     Operations on the set of containers which pertain to dvol.  Also maintain
@@ -16,48 +188,126 @@ class Containers(object):
 
     @ivar stopped: mapping from volume name for which we stopped containers to
         set of container ids, so that we can attempt to start them again.
+    @ivar concurrency: how many containers to stop or start at once.
+    @ivar timings: mapping from volume name to a mapping from container id to
+        the seconds taken to stop it, the number of attempts that took and
+        the seconds taken to start it again, for diagnostics.
+    @ivar index_path: where to read the plugin's L{ContainerIndex} from.
     """
-    def __init__(self, volume_driver_name):
+    def __init__(self, volume_driver_name, concurrency=CONCURRENCY,
+                 index_path=FilePath(INDEX_PATH)):
         self.volume_driver_name = volume_driver_name
         self.stopped = dict()
-        self.client = docker.client.Client(version="1.20")
+        self.concurrency = concurrency
+        self.index_path = index_path
+        self.timings = dict()
+
+    _client = None
 
-    def get_related_containers(self, volume):
+    @property
+    def client(self):
         """
-        Find running containers using the dvol plugin that are using the given
-        volume.
+        The Docker client, which is only created when the first request is
+        made so that commands which don't need Docker don't pay for it.
+        """
+        if self._client is None:
+            self._client = shared_client()
+        return self._client
+
+    @client.setter
+    def client(self, client):
+        self._client = client
+
+    def _in_parallel(self, function, items):
+        """
+        Call function with each of items, at most ``concurrency`` at a time.
+        """
+        items = list(items)
+        if len(items) <= 1 or self.concurrency <= 1:
+            for item in items:
+                function(item)
+            return
+        pool = ThreadPool(min(self.concurrency, len(items)))
+        try:
+            pool.map(function, items)
+        finally:
+            pool.close()
+            pool.join()
+
+    def scan(self, all=False, indexed=True):
         """
-        all_containers = self.client.containers()
-        containers = []
-        for container in all_containers:
+        Inspect the containers using the dvol plugin, once each.
+
+        Containers which the listing shows don't mount any dvol volume are not
+        inspected; listings from Docker versions which don't include mounts
+        can't rule any container out.
+
+        While the plugin is running, the running containers are looked up in
+        its index instead, without asking Docker; the containers returned
+        then only have an C{Id}, C{Name} and C{State}.
+
+        @param all: whether to include containers which aren't running.
+        @param indexed: whether the plugin's index may be used.
+        @return: mapping from volume name to list of inspected containers
+            using that volume.
+        """
+        if indexed and not all:
+            index = read_index(self.index_path)
+            if index is not None:
+                return dict(
+                    (volume, [dict(Id=cid, Name=name, State=dict(Running=True))
+                              for cid, name in sorted(containers.items())])
+                    for volume, containers in index.items())
+        volumes = dict()
+        for container in self.client.containers(all=all):
+            if not self._may_be_related(container):
+                continue
             # race condition: a container is deleted during the following
             # iteration; catch and log exceptions but otherwise ignore; this is
             # a best-effort snapshot of current docker state
             try:
                 container = self.client.inspect_container(container['Id'])
-                running = container['State']['Running']
-                if self._is_container_related(container, volume) and running:
-                    containers.append(container)
             except:
                 log.err(None, "while fetching container state %s, "
                               "maybe it was deleted" % (container['Id'],))
-        return containers
+                continue
+            for volume in self.related_volumes(container):
+                volumes.setdefault(volume, []).append(container)
+        return volumes
+
+    def get_related_containers(self, volume, scan=None):
+        """
+        Find running containers using the dvol plugin that are using the given
+        volume.
+
+        @param scan: the result of L{scan} to look the volume up in, or
+            C{None} to scan the running containers.
+        """
+        if scan is None:
+            scan = self.scan()
+        return [container for container in scan.get(volume, [])
+                if container['State']['Running']]
 
-    def stop(self, volume):
+    def stop(self, volume, scan=None):
         """
         Stop containers which are using this volume, and remember which
         containers were stopped.
+
+        @param scan: the result of L{scan} to find the containers in, or
+            C{None} to scan the running containers.
         """
         if volume in self.stopped:
             raise AlreadyLocked("already locked %s, can't lock it" % (volume,))
-        containers = self.get_related_containers(volume)
+        containers = self.get_related_containers(volume, scan)
         self.stopped[volume] = set()
+        timings = self.timings[volume] = dict()
 
         def attempt_stop(container):
+            started = time.time()
             for attempt in range(RETRIES):
                 try:
                     self.client.stop(container['Id'])
-                    return
+                    break
                 except:
                     if attempt < RETRIES - 1:
                         log.msg(
@@ -66,44 +316,63 @@ class Containers(object):
                     else:
                         log.err(
                             None, "while trying to stop container %s" % (container,))
+            timings[container['Id']] = dict(
+                stop=time.time() - started, attempts=attempt + 1)
 
-        for container in containers:
-            attempt_stop(container)
+        self._in_parallel(attempt_stop, containers)
 
         self.stopped[volume] = set(c['Id'] for c in containers)
 
     def start(self, volume):
         if volume not in self.stopped:
             raise NeverLocked("never locked %s, can't unlock it" % (volume,))
-        for cid in self.stopped[volume]:
+        timings = self.timings.setdefault(volume, dict())
+
+        def attempt_start(cid):
+            started = time.time()
             try:
                 self.client.start(cid)
             except:
                 log.err(None, "while trying to start container %s" % (cid,))
+            timings.setdefault(cid, dict())["start"] = time.time() - started
+
+        self._in_parallel(attempt_start, self.stopped[volume])
+        for cid, timing in sorted(timings.items()):
+            log.msg("Container %s: %s" % (cid, ", ".join(
+                "%s=%s" % (key, value) for key, value in sorted(timing.items()))))
         del self.stopped[volume]
 
-    def remove_related_containers(self, volume):
+    def remove_related_containers(self, volume, scan=None):
         """
         Remove containers using the dvol plugin that are using the given
         volume.
-        """
-        all_containers = self.client.containers(all=True)
 
-        for container in all_containers:
-            # race condition: a container is deleted during the following
-            # iteration; catch and log exceptions but otherwise ignore; this is
-            # a best-effort snapshot of current docker state
-            try:
-                container = self.client.inspect_container(container['Id'])
-            except:
-                log.err(None, "while fetching container state %s, "
-                              "maybe it was deleted" % (container['Id']))
+        @param scan: the result of L{scan} with C{all=True} to look the volume
+            up in, or C{None} to scan all containers.
+        """
+        if scan is None:
+            scan = self.scan(all=True)
+        for container in scan.get(volume, []):
+            log.msg(None, "Deleting container %s" % (container['Id']))
+            self.client.remove_container(container['Id'], v=True)
 
-            if self._is_container_related(container, volume):
-                log.msg(None, "Deleting container %s" % (container['Id']))
-                self.client.remove_container(container['Id'], v=True)
+    def _may_be_related(self, container):
+        """
+        Decide from a container listing whether a container might use a dvol
+        volume, so that it's worth inspecting.
+        """
+        if 'Mounts' not in container:
+            # Docker before API version 1.23 doesn't list mounts.
+            return True
+        return any(
+            mount.get('Driver') == self.volume_driver_name
+            or mount.get('Source', '').startswith(VOLUMES_PATH)
+            for mount in container['Mounts'] or [])
 
-    def _is_container_related(self, container, volume):
+    def related_volumes(self, container):
+        """
+        Return the names of the dvol volumes an inspected container uses.
+        """
         volume_driver_matches = (
             container['Config'].get('VolumeDriver') == self.volume_driver_name
             or
@@ -111,22 +380,19 @@ class Containers(object):
         )
 
         if not volume_driver_matches:
-            return False
+            return set()
 
-        using_volume = False
         aggregated_volumes = container.get('Volumes', {}).values()
         # docker 1.8.2 seems to have new Mounts attribute, list of
         # objects.
         aggregated_volumes += [mount['Source'] for mount in container.get('Mounts', {})]
-        # e.g. {u'/data': u'/var/lib/dvol/volumes/frob_mysql/branches/master'}
+        # e.g. {u'/data': u'/var/lib/dvol/volumes/frob_mysql/running_point'}
+        volumes = set()
         for volume_path in aggregated_volumes:
             # XXX implementation detail-y, will need refactoring when
             # we support multiple backends
-            if volume_path.startswith("/var/lib/dvol/volumes"):
+            if volume_path.startswith(VOLUMES_PATH):
                 parts = volume_path.split("/")
-                volume_name = parts[-2]
-                if volume_name == volume:
-                    using_volume = True
-                    break
+                volumes.add(parts[-2])
 
-        return using_volume
+        return volumes
@@ -0,0 +1,122 @@
+"""
+Writing metadata so that it survives a crash.
+
+Every file is replaced atomically, by writing a temporary sibling, syncing
+it and renaming it over the original, so that readers and a crash only ever
+see the old or the new content.  Outside a batch the rename is made durable
+on its own, with an C{fsync} of the directory.  A command which writes
+several files (a commit's data, its branch log, reference counts and the
+active branch) opens a L{batch} instead, and the renames and appends it made
+are flushed together by one C{syncfs} of the pool's filesystem when it ends,
+so the directories cost a fixed number of syncs however many files change.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import threading
+from contextlib import contextmanager
+
+_local = threading.local()
+
+_libc = []
+
+
+def _getLibc():
+    if not _libc:
+        _libc.append(ctypes.CDLL(ctypes.util.find_library("c"),
+                                 use_errno=True))
+    return _libc[0]
+
+
+def syncFilesystem(path):
+    """
+    Flush everything written to the filesystem holding ``path`` to disk,
+    falling back to flushing every filesystem where C{syncfs} isn't
+    available.
+
+    @type path: L{FilePath}
+    """
+    libc = _getLibc()
+    if not hasattr(libc, "syncfs"):
+        libc.sync()
+        return
+    fd = os.open(path.path, os.O_RDONLY)
+    try:
+        if libc.syncfs(fd) != 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path.path)
+    finally:
+        os.close(fd)
+
+
+def _fsyncDirectory(path):
+    fd = os.open(path.path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _current():
+    return getattr(_local, "batch", None)
+
+
+def setContent(path, content):
+    """
+    Atomically replace the content of the file at ``path``, durably unless a
+    batch is open in this thread, in which case it becomes durable when the
+    batch ends.  The new content is always synced before the rename, so a
+    crash never leaves the file renamed into place but empty.
+
+    @type path: L{FilePath}
+    """
+    temporary = path.temporarySibling(".tmp")
+    with temporary.open("w") as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(temporary.path, path.path)
+    if _current() is None:
+        _fsyncDirectory(path.parent())
+
+
+def appended(f):
+    """
+    Note that data has been appended to the open file ``f`` in place, syncing
+    it unless a batch is open in this thread.
+    """
+    if _current() is None:
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def barrier():
+    """
+    Make everything written so far in this thread's batch durable before
+    anything that follows, for data which later metadata refers to.
+    """
+    current = _current()
+    if current is not None:
+        syncFilesystem(current)
+
+
+@contextmanager
+def batch(directory):
+    """
+    Defer making the writes made in this thread durable until the end of a
+    C{with} block, then sync the filesystem holding ``directory`` once.
+    Nested batches join the outermost one.  If the block raises, nothing is
+    synced: the writes it made remain visible but carry no promise.
+
+    @type directory: L{FilePath}
+    """
+    if _current() is not None:
+        yield
+        return
+    _local.batch = directory
+    try:
+        yield
+    finally:
+        _local.batch = None
+    syncFilesystem(directory)
@@ -6,38 +6,38 @@ directly.
 """
 
 from twisted.python.usage import Options, UsageError
-from twisted.internet import defer
 from twisted.python.filepath import (
     FilePath,
     InsecurePath,
 )
 from twisted.python import log
-from twisted.internet.task import react
+import os
 import sys
+import time
+from contextlib import contextmanager
 import uuid
+from datetime import datetime
 import texttable
 import json
-import yaml
-import os
-import subprocess
-from dockercontainers import Containers
+from dockercontainers import CONCURRENCY, Containers
+from commitdb import (
+    DATABASE_FILENAME, LogCommitDatabase, SQLiteCommitDatabase,
+    commitDatabaseForPool,
+)
+from copiers import CopyStatistics, copierForPool, formatSize
+import durable
+from locks import DEFAULT_TIMEOUT, LockTimeout, VolumeLocks
+from metadatacache import MetadataCache
+from storage import (
+    DirectoryBackend, OverlayBackend, ZFSBackend, backendForVolume,
+    recordBackend,
+)
+from treediff import DIRECTORY
 
 DEFAULT_BRANCH = "master"
 VOLUME_DRIVER_NAME = "dvol"
 PWD_PATH = FilePath("/pwd")
-
-def copyTo(fromPath, toPath):
-    """
-    Copy the contents of fromPath to toPath, assuming a quiesced filesystem,
-    and that toPath doesn't exist, in a way that doesn't fail to copy special
-    files like FIFOs.
-    """
-    if toPath.exists():
-        raise Exception(
-            "Cannot copy %(fromPath)s to %(toPath)s because it exists" %
-            dict(toPath=toPath.path, fromPath=fromPath.path))
-    subprocess.check_call(["cp", "-a", fromPath.path, toPath.path])
-    os.chmod(toPath.path, 0777) # TODO add tests
+PROGRESS_MODES = ("auto", "human", "json", "none")
 
 class VolumeAlreadyExists(Exception):
     pass
@@ -51,6 +51,10 @@ class NoSuchCommit(Exception):
     pass
 
 
+def _timestamp(when):
+    return datetime.utcfromtimestamp(when).isoformat() + "Z"
+
+
 def get_table():
     table = texttable.Texttable(max_width=140)
     table.set_deco(0)
@@ -58,10 +62,13 @@ def get_table():
 
 
 class EmptyContainers(object):
-    def get_related_containers(self, volume):
+    def scan(self, all=False):
+        return {}
+
+    def get_related_containers(self, volume, scan=None):
         return []
 
-    def remove_related_containers(self, volume):
+    def remove_related_containers(self, volume, scan=None):
         pass
 
 class NullLock(object):
@@ -73,8 +80,24 @@ class NullLock(object):
 
 
 class DockerLock(object):
-    def __init__(self):
-        self.containers = Containers(VOLUME_DRIVER_NAME)
+    """
+    Stop the containers using a volume while it is changed.  Most commands
+    never touch the containers, so they are only looked up, and the Docker
+    client library loaded, when first needed.
+
+    @ivar concurrency: How many containers to stop or start at once.
+    """
+    _containers = None
+
+    def __init__(self, concurrency=CONCURRENCY):
+        self.concurrency = concurrency
+
+    @property
+    def containers(self):
+        if self._containers is None:
+            self._containers = Containers(VOLUME_DRIVER_NAME,
+                                          concurrency=self.concurrency)
+        return self._containers
 
     def acquire(self, volume):
         self.containers.stop(volume)
@@ -83,34 +106,19 @@ class DockerLock(object):
         self.containers.start(volume)
 
 
-class JsonCommitDatabase(object):
-    def __init__(self, directory):
-        self._directory = directory
-
-    def _getCommitDB(self, volume, branch):
-        volume = self._directory.child(volume).child("branches")
-        commits = volume.child("%s.json" % (branch,))
-        return commits
-
-    def read(self, volume, branch):
-        commits = self._getCommitDB(volume, branch)
-        if not commits.exists():
-            return []
-        commitData = json.loads(commits.getContent())
-        return commitData
-
-    def write(self, volume, branch, commitData):
-        serialized = json.dumps(commitData)
-        commits = self._getCommitDB(volume, branch)
-        commits.setContent(serialized)
-
-
 class Voluminous(object):
-    def __init__(self, directory, lockFactory=DockerLock):
+    def __init__(self, directory, lockFactory=DockerLock, workers=None,
+                 progress=None, lockTimeout=DEFAULT_TIMEOUT):
         self._directory = FilePath(directory)
+        self.locks = VolumeLocks(self._directory, lockTimeout)
+        self.metadata = MetadataCache()
+        self._workers = workers
+        self._progress = progress
         self._output = []
         self.lock = lockFactory()
-        self.commitDatabase = JsonCommitDatabase(self._directory)
+        self.commitDatabase = commitDatabaseForPool(self._directory)
+        self._copier = None
+        self._backends = {}
 
     def output(self, s):
         self._output.append(s)
@@ -121,6 +129,64 @@ class Voluminous(object):
         self._output = []
         return result
 
+    def copier(self):
+        """
+        Return the copier for this pool, detecting it the first time it is
+        needed.
+        """
+        if self._copier is None:
+            self._copier = copierForPool(self._directory)
+        return self._copier
+
+    def backend(self, volume):
+        """
+        Return the storage backend which holds the data of a volume.
+        """
+        if volume not in self._backends:
+            self._backends[volume] = backendForVolume(
+                self._directory, volume, self.commitDatabase, self.copier,
+                self._workers)
+        return self._backends[volume]
+
+    def showInfo(self):
+        table = get_table()
+        table.set_cols_align(["l", "l"])
+        table.add_rows([
+            ["Pool:", self._directory.path],
+            ["Copy backend:", self.copier().name],
+            ["Commit database:", self.commitDatabase.name],
+            ["Metadata cache:", self.metadata.describe()],
+            ], header=False)
+        self.output(table.draw())
+
+    def migrateCommitDatabase(self):
+        """
+        Move the commits of every volume in the pool into a SQLite database.
+        """
+        volumes = sorted(path.basename() for path in self._directory.children()
+                         if path.child("branches").isdir())
+        # no command may change a volume's commits while they are moved
+        with self._changingAll(volumes):
+            if isinstance(self.commitDatabase, SQLiteCommitDatabase):
+                self.output("Commits are already stored in a SQLite database")
+                return
+            database = SQLiteCommitDatabase(self._directory)
+            migrated = database.migrate(LogCommitDatabase(self._directory))
+            self.commitDatabase = database
+            self._backends = {}
+        self.output("Migrated %d branches to a SQLite database" % (migrated,))
+
+    def _refreshCommitDatabase(self):
+        """
+        Switch to the SQLite database if the pool has been migrated to one
+        since this command started, as it may have been while the command
+        waited for a volume's lock.
+        """
+        if (not isinstance(self.commitDatabase, SQLiteCommitDatabase)
+                and self._directory.child(DATABASE_FILENAME).exists()):
+            self.commitDatabase = SQLiteCommitDatabase(self._directory)
+            self._backends = {}
+
     def allBranches(self, volume):
         volumePath = self._directory.child(volume)
         branches = volumePath.child("branches").children()
@@ -128,11 +194,12 @@ class Voluminous(object):
 
     def listBranches(self):
         volume = self.volume()
-        branches = self.allBranches(volume)
-        currentBranch = self.getActiveBranch(volume)
-        self.output("\n".join(sorted(
-            ("*" if b == currentBranch else " ")
-            + " " + b for b in branches)))
+        with self.locks.shared(volume):
+            branches = self.allBranches(volume)
+            currentBranch = self.getActiveBranch(volume)
+            self.output("\n".join(sorted(
+                ("*" if b == currentBranch else " ")
+                + " " + b for b in branches)))
 
     def checkoutBranch(self, branch, create):
         """
@@ -140,101 +207,117 @@ class Voluminous(object):
         from current branch HEAD if requested.
         """
         volume = self.volume()
-        volumePath = self._directory.child(volume)
-        # this raises an exception if branch is not a valid path segment
-        branchPath = volumePath.child("branches").child(branch)
-        if create:
-            if branchPath.exists():
-                self.output("Cannot create existing branch %s" % (branch,))
-                return
+        with self._changing(volume):
+            volumePath = self._directory.child(volume)
+            # this raises an exception if branch is not a valid path segment
+            branchPath = volumePath.child("branches").child(branch)
+            if create:
+                if branchPath.exists():
+                    self.output("Cannot create existing branch %s" % (branch,))
+                    return
+                else:
+                    try:
+                        HEAD = self._resolveNamedCommitCurrentBranch("HEAD", volume)
+                    except IndexError:
+                        self.output("You must commit ('dvol commit') before you can "
+                                    "branch ('dvol checkout -b')")
+                        return
+                    # Copy metadata
+                    meta = self.commitDatabase.read(volume,
+                            self.getActiveBranch(volume))
+                    self.commitDatabase.write(volume, branch, meta)
+                    # Then copy latest HEAD of branch into new branch data
+                    # directory
+                    statistics = self._copyStatistics("branch")
+                    self.backend(volume).createBranchFromCommit(
+                            volume, branch, HEAD, statistics)
+                    self._finishCopy("branch", statistics)
             else:
-                try:
-                    HEAD = self._resolveNamedCommitCurrentBranch("HEAD", volume)
-                except IndexError:
-                    self.output("You must commit ('dvol commit') before you can "
-                                "branch ('dvol checkout -b')")
+                if not branchPath.exists():
+                    self.output("Cannot switch to non-existing branch %s" % (branch,))
                     return
-                # Copy metadata
-                meta = self.commitDatabase.read(volume,
-                        self.getActiveBranch(volume))
-                self.commitDatabase.write(volume, branch, meta)
-                # Then copy latest HEAD of branch into new branch data
-                # directory
-                copyTo(volumePath.child("commits").child(HEAD), branchPath)
-        else:
-            if not branchPath.exists():
-                self.output("Cannot switch to non-existing branch %s" % (branch,))
-                return
-        # Got here, so switch to the (maybe new branch)
-        self.setActiveBranch(volume, branch)
+            # Got here, so switch to the (maybe new branch)
+            self.setActiveBranch(volume, branch)
 
     def createBranch(self, volume, branch):
-        branchDir = self._directory.child(volume).child("branches").child(branch)
-        branchDir.makedirs()
-        # This branchDir is the one which will be bind-mounted into running
-        # containers, via a symlink, but with symlinks and docker bind-mounts
-        # it seems that it's the permissions of the target which affects the
-        # (e.g.) writeability of the resulting mount.
-        # Because some containers have processes which run as non-root users,
-        # make the volume world-writeable so that it can still be useful to
-        # those processes. In the future, it might be better to have options
-        # for which uid, gid and perms the volume should have. This is
-        # effectively the same as `chmod a=rwx branchDir.path`.
-        os.chmod(branchDir.path, 0777)
+        self.backend(volume).createBranch(volume, branch)
         self.output("Created branch %s/%s" % (volume, branch))
 
-    def createVolume(self, name):
+    def createVolume(self, name, zfsDataset=None, overlay=False,
+                     chunked=False, compressed=False):
         try:
             # XXX: Behaviour around names with relative path identifiers
             # such as '..' and '.' is largely undefined, these should
             # probably be rejected outright.
-            if self._directory.child(name).exists():
-                self.output("Error: volume %s already exists" % (name,))
-                return
+            volumePath = self._directory.child(name)
         except InsecurePath:
             self.output("Error: %s is not a valid name" % (name,))
             return
-        self._directory.child(name).makedirs()
-        self.setActiveVolume(name)
-        self.output("Created volume %s" % (name,))
-        self.createBranch(name, DEFAULT_BRANCH)
+        with self._changing(name):
+            if volumePath.exists():
+                self.output("Error: volume %s already exists" % (name,))
+                return
+            volumePath.makedirs()
+            if zfsDataset is not None:
+                backend = ZFSBackend(self._directory, "%s/%s" % (zfsDataset, name))
+            elif overlay:
+                backend = OverlayBackend(
+                    self._directory, self.commitDatabase, self.copier,
+                    self._workers)
+            else:
+                backend = DirectoryBackend(
+                    self._directory, self.commitDatabase, self.copier,
+                    self._workers, chunked, compressed)
+            backend.createVolume(name)
+            recordBackend(self._directory, name, backend)
+            self._backends[name] = backend
+            self.setActiveVolume(name)
+            self.output("Created volume %s" % (name,))
+            self.createBranch(name, DEFAULT_BRANCH)
 
     def removeVolume(self, volume, force=False):
         try:
-            if not self._directory.child(volume).exists():
-                self.output("Volume %r does not exist, cannot remove it" %
-                        (volume,))
-                return
+            volumePath = self._directory.child(volume)
         except InsecurePath:
             self.output("Error: %s is not a valid name" % (volume,))
             return
-        containers = self.lock.containers.get_related_containers(volume)
-        if containers:
-            raise UsageError("Cannot remove %r while it is in use by '%s'" %
-                    (volume, (",".join(c['Name'] for c in containers))))
-        if force or self._userIsSure("This will remove all containers using the volume"):
-            self.output("Deleting volume %r" % (volume,))
-            # Remove related containers
-            self.lock.containers.remove_related_containers(volume)
-            self._directory.child(volume).remove()
+        with self._changing(volume):
+            if not volumePath.exists():
+                self.output("Volume %r does not exist, cannot remove it" %
+                        (volume,))
+                return
+            # one scan of all containers serves both finding the running ones and
+            # removing them all
+            scan = self.lock.containers.scan(all=True)
+            containers = self.lock.containers.get_related_containers(volume, scan)
+            if containers:
+                raise UsageError("Cannot remove %r while it is in use by '%s'" %
+                        (volume, (",".join(c['Name'] for c in containers))))
+            if force or self._userIsSure("This will remove all containers using the volume"):
+                self.output("Deleting volume %r" % (volume,))
+                # Remove related containers
+                self.lock.containers.remove_related_containers(volume, scan)
+                self.backend(volume).deleteVolume(volume)
+                self.commitDatabase.deleteVolume(volume)
+                self._directory.child(volume).remove()
 
-        else:
-            self.output("Aborting.")
+            else:
+                self.output("Aborting.")
 
     def deleteBranch(self, branch):
         volume = self.volume()
-        if branch == self.getActiveBranch(volume):
-            raise UsageError("Cannot delete active branch, use "
-                             "'dvol checkout' to switch branches first")
-        if branch not in self.allBranches(volume):
-            raise UsageError("Branch %r does not exist" % (branch,))
-        if self._userIsSure():
-            self.output("Deleting branch %r" % (branch,))
-            volumePath = self._directory.child(volume)
-            branchPath = volumePath.child("branches").child(branch)
-            branchPath.remove()
-        else:
-            self.output("Aborting.")
+        with self._changing(volume):
+            if branch == self.getActiveBranch(volume):
+                raise UsageError("Cannot delete active branch, use "
+                                 "'dvol checkout' to switch branches first")
+            if branch not in self.allBranches(volume):
+                raise UsageError("Branch %r does not exist" % (branch,))
+            if self._userIsSure():
+                self.output("Deleting branch %r" % (branch,))
+                self.backend(volume).deleteBranch(volume, branch)
+                self.commitDatabase.deleteBranch(volume, branch)
+            else:
+                self.output("Aborting.")
 
     def _userIsSure(self, extraMessage=None):
         message = "Are you sure? "
@@ -245,15 +328,45 @@ class Voluminous(object):
         sys.stdout.flush()
         return raw_input().lower() in ("y", "yes")
 
+    @contextmanager
+    def _changing(self, volume):
+        """
+        Hold the exclusive lock of a volume while changing it, and make the
+        changes durable together at the end.
+        """
+        with self.locks.exclusive(volume):
+            self._refreshCommitDatabase()
+            with durable.batch(self._directory):
+                yield
+
+    @contextmanager
+    def _changingAll(self, volumes):
+        """
+        Hold the exclusive locks of several volumes, taken in the order
+        given, as for L{_changing}.
+        """
+        held = []
+        try:
+            for volume in volumes:
+                lock = self.locks.exclusive(volume)
+                lock.__enter__()
+                held.append(lock)
+            self._refreshCommitDatabase()
+            with durable.batch(self._directory):
+                yield
+        finally:
+            for lock in reversed(held):
+                lock.__exit__(None, None, None)
+
     def setActiveVolume(self, volume):
-         self._directory.child(
-            "current_volume.json").setContent(
-                json.dumps(dict(current_volume=volume)))
+        durable.setContent(self._directory.child("current_volume.json"),
+                           json.dumps(dict(current_volume=volume)))
 
     def volume(self):
-        currentVolume = self._directory.child("current_volume.json")
-        if currentVolume.exists():
-            volume = json.loads(currentVolume.getContent())["current_volume"]
+        currentVolume = self.metadata.readJSON(
+            self._directory.child("current_volume.json"))
+        if currentVolume is not None:
+            volume = currentVolume["current_volume"]
         else:
             raise UsageError("No active volume: use dvol switch to choose one")
         if not self._directory.child(volume).exists():
@@ -262,9 +375,9 @@ class Voluminous(object):
         return volume
 
     def setActiveBranch(self, volume, branch):
-        self._directory.child(volume).child(
-            "current_branch.json").setContent(
-                json.dumps(dict(current_branch=branch)))
+        durable.setContent(
+            self._directory.child(volume).child("current_branch.json"),
+            json.dumps(dict(current_branch=branch)))
         self.lock.acquire(volume)
         try:
             self.updateRunningPoint(volume)
@@ -272,9 +385,10 @@ class Voluminous(object):
             self.lock.release(volume)
 
     def getActiveBranch(self, volume):
-        currentBranch = self._directory.child(volume).child("current_branch.json")
-        if currentBranch.exists():
-            return json.loads(currentBranch.getContent())["current_branch"]
+        currentBranch = self.metadata.readJSON(
+            self._directory.child(volume).child("current_branch.json"))
+        if currentBranch is not None:
+            return currentBranch["current_branch"]
         else:
             return DEFAULT_BRANCH
 
@@ -283,41 +397,144 @@ class Voluminous(object):
         construct a stable (wrt switching branches) path with symlinks
         """
         volumePath = self._directory.child(volume)
-        branchName = self.getActiveBranch(volume)
-        branchPath = volumePath.child("branches").child(branchName)
+        with self.locks.exclusive(volume):
+            branchName = self.getActiveBranch(volume)
+            branchPath = self.backend(volume).pathForMount(volume, branchName)
+            stablePath = volumePath.child("running_point")
+            if stablePath.exists():
+                stablePath.remove()
+            branchPath.linkTo(stablePath)
+        return stablePath.path
+
+    def currentRunningPoint(self, volume):
+        """
+        Return the path of a volume's running point if it already points at
+        the active branch and the branch can be mounted as it is, or
+        C{None}.
+
+        Takes no lock: after a commit, reset or checkout dvol restarts the
+        volume's containers with its lock still held, and each container
+        asks the plugin to mount the volume as it starts.
+        """
+        try:
+            volumePath = self._directory.child(volume)
+        except InsecurePath:
+            return None
         stablePath = volumePath.child("running_point")
-        if stablePath.exists():
-            stablePath.remove()
-        branchPath.linkTo(stablePath)
+        try:
+            target = os.readlink(stablePath.path)
+        except OSError:
+            return None
+        backend = self.backend(volume)
+        branchPath = backend.mountedPath(volume, self.getActiveBranch(volume))
+        if branchPath is None or branchPath.path != target:
+            return None
         return stablePath.path
 
-    def commitVolume(self, message):
+    def commitVolume(self, message, precopy=False):
+        """
+        Commit the data of the active branch.
+
+        @param precopy: Whether to store the branch's data while its
+            containers keep running first, so that they only need to be
+            stopped while the files written in the meantime are stored.
+        """
         volume = self.volume()
-        commitId = (str(uuid.uuid4()) + str(uuid.uuid4())).replace("-", "")[:40]
-        self.output(commitId)
-        volumePath = self._directory.child(volume)
-        branchName = self.getActiveBranch(volume)
-        branchPath = volumePath.child("branches").child(branchName)
-        commitPath = volumePath.child("commits").child(commitId)
-        if commitPath.exists():
-            raise Exception("woah, random uuid collision. try again!")
-        # Make the commits directory if necessary
-        if not commitPath.parent().exists():
-            commitPath.parent().makedirs()
-        # acquire lock (read: stop containers) to ensure consistent snapshot
-        # with file-copy based backend
-        # XXX tests for acquire/release
+        with self._changing(volume):
+            commitId = (str(uuid.uuid4()) + str(uuid.uuid4())).replace("-", "")[:40]
+            self.output(commitId)
+            branchName = self.getActiveBranch(volume)
+            backend = self.backend(volume)
+            if backend.commitExists(volume, commitId):
+                raise Exception("woah, random uuid collision. try again!")
+            # acquire lock (read: stop containers) to ensure consistent snapshot
+            # with file-copy based backend
+            # XXX tests for acquire/release
+            precopied = None
+            if precopy:
+                statistics = self._copyStatistics("precopy")
+                precopied = backend.precopy(volume, branchName, statistics)
+                self._finishCopy("precopy", statistics)
+            statistics = self._copyStatistics("commit")
+            self._whileStopped(volume, "commit", precopy, backend.commit,
+                               volume, branchName, commitId, statistics, precopied)
+            self._finishCopy("commit", statistics)
+            # the commit's data must be on disk before the log refers to it
+            durable.barrier()
+            self._recordCommit(volume, branchName, commitId, message)
+
+    def _whileStopped(self, volume, operation, report, function, *args):
+        """
+        Call ``function`` with the containers using a volume stopped, timing
+        how long they were stopped for.  The times are reported as a JSON
+        event with C{--progress=json}, or otherwise if ``report`` is true.
+        """
+        stopping = time.time()
         self.lock.acquire(volume)
+        stopped = time.time()
         try:
-            copyTo(branchPath, commitPath)
+            function(*args)
         finally:
+            starting = time.time()
             self.lock.release(volume)
-        self._recordCommit(volume, branchName, commitId, message)
+            started = time.time()
+            if self._progress == "json":
+                self.output(json.dumps(dict(
+                    event="downtime", operation=operation,
+                    stopping=stopping, stopped=stopped, starting=starting,
+                    started=started, seconds=started - stopping)))
+            elif report:
+                self.output(
+                    "Containers stopped at %s, started at %s (%.3fs)" % (
+                        _timestamp(stopping), _timestamp(started),
+                        started - stopping))
+
+    def _copyStatistics(self, operation):
+        """
+        Return the statistics to count the files copied by an operation in,
+        reporting its progress if that was asked for.
+        """
+        progress = None
+        if self._progress is not None:
+            def progress(statistics, finished):
+                self._reportProgress(operation, statistics, finished)
+        return CopyStatistics(progress=progress)
+
+    def _finishCopy(self, operation, statistics):
+        if statistics.files:
+            log.msg("%s: %s" % (operation, statistics.describe()))
+        statistics.finish()
+
+    def _reportProgress(self, operation, statistics, finished):
+        eta = statistics.eta()
+        if self._progress == "json":
+            self.output(json.dumps(dict(
+                event="finished" if finished else "progress",
+                operation=operation,
+                files=statistics.files,
+                total_files=statistics.totalFiles,
+                bytes=statistics.bytes,
+                total_bytes=statistics.totalBytes,
+                elapsed=statistics.elapsed(),
+                rate=statistics.rate(),
+                eta=None if finished else eta)))
+        elif finished:
+            # Quick operations finish without having shown any progress, and
+            # aren't worth a summary either.
+            if statistics.reported:
+                self.output("%s: done, %s" % (
+                    operation, statistics.describe()))
+        else:
+            self.output("%s: %d/%d files, %s of %s, %s/s, ETA %s" % (
+                operation, statistics.files, statistics.totalFiles,
+                formatSize(statistics.bytes),
+                formatSize(statistics.totalBytes),
+                formatSize(statistics.rate()),
+                "unknown" if eta is None else "%ds" % (eta,)))
 
     def _recordCommit(self, volume, branch, commitId, message):
-        commitData = self.commitDatabase.read(volume, branch)
-        commitData.append(dict(id=commitId, message=message))
-        self.commitDatabase.write(volume, branch, commitData)
+        self.commitDatabase.append(volume, branch,
+                dict(id=commitId, message=message, created=time.time()))
 
     def exists(self, volume):
         volumePath = self._directory.child(volume)
@@ -327,6 +544,7 @@ class Voluminous(object):
         table = get_table()
         table.set_cols_align(["l", "l", "l"])
         dc = self.lock.containers # XXX ugly
+        scan = dc.scan()
         volumes = [v for v in self._directory.children() if v.isdir()]
         activeVolume = None
         if volumes:
@@ -339,17 +557,19 @@ class Voluminous(object):
                 ["  VOLUME", "BRANCH", "CONTAINERS"]] + [
                 [("*" if v.basename() == activeVolume else " ") + " " + v.basename(),
                     self.getActiveBranch(v.basename()),
-                    ",".join(c['Name'] for c in dc.get_related_containers(v.basename()))]
+                    ",".join(c['Name'] for c in dc.get_related_containers(v.basename(), scan))]
                     for v in sorted(volumes)]
         table.add_rows(rows)
         self.output(table.draw())
 
     def listCommits(self, branch=None):
-        if branch is None:
-            branch = self.getActiveBranch(self.volume())
         volume = self.volume()
+        with self.locks.shared(volume):
+            if branch is None:
+                branch = self.getActiveBranch(volume)
+            commits = self.commitDatabase.read(volume, branch)
         aggregate = []
-        for commit in reversed(self.commitDatabase.read(volume, branch)):
+        for commit in reversed(commits):
             # TODO fill in author/date
             aggregate.append(
                 "commit %(id)s\n"
@@ -359,6 +579,60 @@ class Voluminous(object):
                 "    %(message)s\n" % commit)
         self.output("\n".join(aggregate))
 
+    def _outputChanges(self, changes, asJSON):
+        """
+        Output each difference found by L{treediff.compareTrees} as soon as
+        it is found, as a line of text or a JSON object.
+        """
+        for change, path, kind in changes:
+            if asJSON:
+                self.output(json.dumps(dict(
+                    change=change, path=path.decode("utf-8", "replace"),
+                    kind=kind)))
+            else:
+                if kind == DIRECTORY:
+                    path += "/"
+                self.output("%-8s %s" % (change, path))
+
+    def statusVolume(self, asJSON=False):
+        """
+        Show what has changed in the active branch since its latest commit.
+        """
+        volume = self.volume()
+        with self.locks.shared(volume):
+            backend = self.backend(volume)
+            if not hasattr(backend, "status"):
+                raise UsageError("dvol status is not supported by the %s "
+                                 "backend" % (backend.name,))
+            branch = self.getActiveBranch(volume)
+            self._outputChanges(backend.status(volume, branch), asJSON)
+
+    def diffCommits(self, old, new, asJSON=False):
+        """
+        Show what changed between two commits of the active volume.
+        """
+        volume = self.volume()
+        with self.locks.shared(volume):
+            backend = self.backend(volume)
+            if not hasattr(backend, "diff"):
+                raise UsageError("dvol diff is not supported by the %s "
+                                 "backend" % (backend.name,))
+            commits = []
+            for commit in (old, new):
+                if commit.startswith("HEAD"):
+                    try:
+                        commit = self._resolveNamedCommitCurrentBranch(
+                            commit, volume)
+                    except IndexError:
+                        self.output(
+                            "Referenced commit does not exist; check dvol log")
+                        return
+                if not backend.commitExists(volume, commit):
+                    raise NoSuchCommit("commit '%s' does not exist" % (
+                        commit,))
+                commits.append(commit)
+            self._outputChanges(backend.diff(volume, *commits), asJSON)
+
     def _resolveNamedCommitCurrentBranch(self, commit, volume):
         branch = self.getActiveBranch(volume)
         remainder = commit[len("HEAD"):]
@@ -366,36 +640,49 @@ class Voluminous(object):
             offset = len(remainder)
         else:
             raise UsageError("Malformed commit identifier %r" % (commit,))
-        commits = self.commitDatabase.read(volume, branch)
         # commits are appended to, so the last one is the latest
-        return commits[-1 - offset]["id"]
+        return self.commitDatabase.commitFromHead(volume, branch, offset)["id"]
 
     def _destroyNewerCommits(self, commit, volume):
         # TODO in the future, we'll care more about the following being an
         # atomic operation
         branch = self.getActiveBranch(volume)
-        commits = self.commitDatabase.read(volume, branch)
-        commitIndex = [c["id"] for c in commits].index(commit) + 1
-        remainingCommits = commits[:commitIndex]
-        destroyCommits = commits[commitIndex:]
-        # look in all branches for commit references before removing them
-        totalCommits = set()
-        for otherBranch in self.allBranches(volume):
-            if otherBranch == branch:
-                # skip this branch, otherwise we'll never destroy any commits
-                continue
-            commits = self.commitDatabase.read(volume, branch)
-            totalCommits.update(commit["id"] for commit in commits)
-        for commit in destroyCommits:
-            commitId = commit["id"]
-            if commitId in totalCommits:
-                # skip destroying this commit; it is still actively referred to
-                # in another branch
+        # walk back from HEAD rather than reading the branch's whole history
+        newer = 0
+        while self.commitDatabase.commitFromHead(
+                volume, branch, newer)["id"] != commit:
+            newer += 1
+        destroyCommits = self.commitDatabase.discard(volume, branch, newer)
+        # skip destroying commits which are still actively referred to in
+        # another branch
+        unreferenced = [c["id"] for c in destroyCommits
+                        if not self.commitDatabase.referenceCount(
+                            volume, c["id"])]
+        # the log must no longer refer to the commits before they go
+        durable.barrier()
+        self.backend(volume).deleteCommits(volume, unreferenced)
+
+    def collectGarbage(self):
+        """
+        Remove the commits of every volume which are no longer part of any
+        branch's history, such as those left behind by deleted branches.
+        """
+        for volumePath in sorted(self._directory.children()):
+            if not volumePath.child("branches").isdir():
                 continue
-            volumePath = self._directory.child(volume)
-            commitPath = volumePath.child("commits").child(commitId)
-            commitPath.remove()
-        self.commitDatabase.write(volume, branch, remainingCommits)
+            volume = volumePath.basename()
+            with self._changing(volume):
+                self.commitDatabase.rebuildReferences(volume)
+                backend = self.backend(volume)
+                unreferenced = [
+                    commitId for commitId in backend.listCommits(volume)
+                    if not self.commitDatabase.referenceCount(
+                        volume, commitId)]
+                if unreferenced:
+                    backend.deleteCommits(volume, unreferenced)
+            if unreferenced:
+                self.output("Removed %d unreferenced commits from %s" % (
+                    len(unreferenced), volume))
 
     def resetVolume(self, commit):
         """
@@ -403,27 +690,27 @@ class Voluminous(object):
         destroying any later commits.
         """
         volume = self.volume()
-        volumePath = self._directory.child(volume)
-        branchName = self.getActiveBranch(volume)
-        branchPath = volumePath.child("branches").child(branchName)
-        if commit.startswith("HEAD"):
-            try:
-                commit = self._resolveNamedCommitCurrentBranch(commit, volume)
-            except IndexError:
-                self.output("Referenced commit does not exist; check dvol log")
-                return
-        commitPath = volumePath.child("commits").child(commit)
-        if not commitPath.exists():
-            raise NoSuchCommit("commit '%s' does not exist" % (commit,))
-        self.lock.acquire(volume)
-        try:
-            branchPath.remove()
-            copyTo(commitPath, branchPath)
-            self._destroyNewerCommits(commit, volume)
-        finally:
-            self.lock.release(volume)
+        with self._changing(volume):
+            branchName = self.getActiveBranch(volume)
+            if commit.startswith("HEAD"):
+                try:
+                    commit = self._resolveNamedCommitCurrentBranch(commit, volume)
+                except IndexError:
+                    self.output("Referenced commit does not exist; check dvol log")
+                    return
+            backend = self.backend(volume)
+            if not backend.commitExists(volume, commit):
+                raise NoSuchCommit("commit '%s' does not exist" % (commit,))
+            statistics = self._copyStatistics("reset")
+
+            def reset():
+                backend.reset(volume, branchName, commit, statistics)
+                self._destroyNewerCommits(commit, volume)
+            self._whileStopped(volume, "reset", False, reset)
+            self._finishCopy("reset", statistics)
 
     def seedVolumes(self, compose_file):
+        import yaml
         # XXX: does not work with absolute paths, but should
         compose = yaml.load(PWD_PATH.child(compose_file).open())
         valid_volumes = []
@@ -455,18 +742,75 @@ class LogOptions(Options):
         voluminous.listCommits()
 
 
+class StatusOptions(Options):
+    """
+    Show changes since the latest commit.
+    """
+    optFlags = [
+        ["json", None, "Output each change as a JSON object"],
+        ]
+
+    def run(self, voluminous):
+        voluminous.statusVolume(asJSON=self["json"])
+
+
+class DiffOptions(Options):
+    """
+    Show changes between two commits.
+    """
+    optFlags = [
+        ["json", None, "Output each change as a JSON object"],
+        ]
+
+    synopsis = "<commit-id-or-HEAD[^*]> <commit-id-or-HEAD[^*]>"
+
+    def parseArgs(self, old, new):
+        self.old = old
+        self.new = new
+
+    def run(self, voluminous):
+        voluminous.diffCommits(self.old, self.new, asJSON=self["json"])
+
+
 class InitOptions(Options):
     """
     Create a volume.
     """
+    optFlags = [
+        ["overlay", None,
+            "Make branches overlays on the commit they were created from or "
+            "reset to, rather than copies of it"],
+        ["chunked", None,
+            "Store large files as chunks, so that commits only store the "
+            "parts of them which changed"],
+        ["compressed", None,
+            "Store commits compressed"],
+        ]
+
+    optParameters = [
+        ["zfs-dataset", None, None,
+            "Store the volume's branches and commits as datasets and "
+            "snapshots under this ZFS dataset"],
+        ]
 
     synopsis = "<volume>"
 
     def parseArgs(self, name):
         self.name = name
 
+    def postOptions(self):
+        if self["overlay"] and self["zfs-dataset"]:
+            raise UsageError("Only one of --overlay and --zfs-dataset can "
+                             "be used")
+        if ((self["overlay"] or self["zfs-dataset"])
+                and (self["chunked"] or self["compressed"])):
+            raise UsageError("--chunked and --compressed can't be used with "
+                             "--overlay or --zfs-dataset")
+
     def run(self, voluminous):
-        voluminous.createVolume(self.name)
+        voluminous.createVolume(self.name, zfsDataset=self["zfs-dataset"],
+                overlay=self["overlay"], chunked=self["chunked"],
+                compressed=self["compressed"])
 
 
 class SeedOptions(Options):
@@ -487,6 +831,12 @@ class CommitOptions(Options):
     """
     Create a commit.
     """
+    optFlags = [
+        ["pre-copy", None,
+            "Copy the data while containers keep running, then stop them "
+            "only to copy what changed in the meantime"],
+        ]
+
     optParameters = [
         ["message", "m", None, "Commit message"],
         ]
@@ -496,7 +846,7 @@ class CommitOptions(Options):
             raise UsageError("You must provide a commit message")
 
     def run(self, voluminous):
-        voluminous.commitVolume(self["message"])
+        voluminous.commitVolume(self["message"], precopy=self["pre-copy"])
 
 
 class ResetOptions(Options):
@@ -522,6 +872,30 @@ class ResetOptions(Options):
         voluminous.resetVolume(self.commit)
 
 
+class InfoOptions(Options):
+    """
+    Show how the pool stores its data.
+    """
+    def run(self, voluminous):
+        voluminous.showInfo()
+
+
+class GarbageCollectOptions(Options):
+    """
+    Remove commits which no branch refers to.
+    """
+    def run(self, voluminous):
+        voluminous.collectGarbage()
+
+
+class MigrateOptions(Options):
+    """
+    Move commit metadata into a SQLite database.
+    """
+    def run(self, voluminous):
+        voluminous.migrateCommitDatabase()
+
+
 class ListVolumesOptions(Options):
     """
     List volumes.
@@ -599,6 +973,17 @@ class VoluminousOptions(Options):
 
     optParameters = [
         ["pool", "p", None, "The name of the directory to use"],
+        ["workers", None, None,
+            "Number of threads copying files (default: one per core)", int],
+        ["progress", None, "auto",
+            "How to report the progress of copying data: human, json, none, "
+            "or auto for human when the output is a terminal"],
+        ["lock-timeout", None, DEFAULT_TIMEOUT,
+            "Seconds to wait for another dvol command using the same volume "
+            "to finish", float],
+        ["container-concurrency", None, CONCURRENCY,
+            "Number of containers using a volume to stop or start at once",
+            int],
         ]
 
     subCommands = [
@@ -606,6 +991,12 @@ class VoluminousOptions(Options):
             "List all dvol volumes"],
         ["ls", None, ListVolumesOptions,
             "Same as 'list'"],
+        ["info", None, InfoOptions,
+            "Show how dvol stores data in the pool"],
+        ["gc", None, GarbageCollectOptions,
+            "Remove commits which are no longer part of any branch"],
+        ["migrate", None, MigrateOptions,
+            "Move commit metadata of every volume into a SQLite database"],
         ["init", None, InitOptions,
             "Create a volume and its default master branch, then switch to it"],
         ["seed", None, SeedOptions,
@@ -618,6 +1009,10 @@ class VoluminousOptions(Options):
             "Create a commit on the active volume and branch"],
         ["log", None, LogOptions,
             "List commits on the active volume and branch"],
+        ["status", None, StatusOptions,
+            "Show what changed on the active branch since its latest commit"],
+        ["diff", None, DiffOptions,
+            "Show what changed between two commits on the active volume"],
         ["reset", None, ResetOptions,
             "Reset active branch to a commit, destroying later unreferenced commits"],
         ["branch", None, BranchOptions,
@@ -630,6 +1025,14 @@ class VoluminousOptions(Options):
     def postOptions(self):
         if self.subCommand is None:
             return self.opt_help()
+        if self["progress"] not in PROGRESS_MODES:
+            raise UsageError("--progress must be one of %s" % (
+                ", ".join(PROGRESS_MODES),))
+        progress = self["progress"]
+        if progress == "auto":
+            progress = "human" if sys.stdout.isatty() else "none"
+        if progress == "none":
+            progress = None
         if self["pool"] is None:
             # TODO untested
             homePath = FilePath("/var/lib/dvol/volumes")
@@ -637,22 +1040,28 @@ class VoluminousOptions(Options):
                 homePath.makedirs()
             self["pool"] = homePath.path
 
-        lockFactory = DockerLock
+        if self["container-concurrency"] < 1:
+            raise UsageError("--container-concurrency must be at least 1")
+        lockFactory = lambda: DockerLock(self["container-concurrency"])
         if self["disable-docker-integration"]:
             # Do not attempt to connect to Docker if we've been asked not to.
             lockFactory = NullLock
 
-        self.voluminous = Voluminous(self["pool"], lockFactory=lockFactory)
+        self.voluminous = Voluminous(self["pool"], lockFactory=lockFactory,
+                                     workers=self["workers"],
+                                     progress=progress,
+                                     lockTimeout=self["lock-timeout"])
         self.subOptions.run(self.voluminous)
 
 
 # TODO untested below
 def _main(reactor, *argv):
+    from twisted.internet import defer
     try:
         base = VoluminousOptions()
         d = defer.maybeDeferred(base.parseOptions, argv)
         def usageError(failure):
-            failure.trap(UsageError)
+            failure.trap(UsageError, LockTimeout)
             print str(failure.value)
             return # skips verbose exception printing
         d.addErrback(usageError)
@@ -674,6 +1083,7 @@ def _main(reactor, *argv):
 
 
 def main():
+    from twisted.internet.task import react
     react(_main, sys.argv[1:])
 
 
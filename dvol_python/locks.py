@@ -0,0 +1,141 @@
+"""
+Locks which stop dvol processes, and the threads of the plugin, from
+changing the same volume at the same time.
+
+Each volume has a lock file in the pool, locked with C{flock}: shared by
+operations which only read the volume's metadata and exclusive for those
+which change it.  C{flock} locks belong to an open file rather than a
+process, so threads which open the file separately exclude each other just
+like separate processes do, and the kernel releases them if a process dies
+while holding one.
+"""
+
+import errno
+import fcntl
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds to wait for a lock before giving up.
+DEFAULT_TIMEOUT = 60
+
+# Seconds between attempts to take a lock which is held elsewhere.
+POLL_INTERVAL = 0.05
+
+
+class LockTimeout(Exception):
+    """
+    A volume's lock couldn't be taken before the timeout.
+    """
+
+
+class UpgradeRefused(Exception):
+    """
+    A thread holding a volume's shared lock asked for its exclusive lock.
+    """
+
+
+class _HeldLock(object):
+    """
+    A volume lock held by the current thread.
+
+    @ivar modes: The lock mode of each nested acquisition, innermost last.
+    """
+    def __init__(self, fd):
+        self.fd = fd
+        self.modes = []
+
+
+class VolumeLocks(object):
+    """
+    The read/write locks of the volumes in a pool.
+
+    Locks are reentrant within a thread: an operation holding a volume's lock
+    can call other operations which take it again, as long as it doesn't ask
+    for the exclusive lock while holding only the shared one.  C{flock}
+    releases a shared lock before it waits for the exclusive one, so another
+    command could change the volume in between; operations which may change
+    a volume take its exclusive lock from the start instead.
+
+    @ivar timeout: The number of seconds to wait for a lock before raising
+        L{LockTimeout}.
+    """
+    def __init__(self, directory, timeout=DEFAULT_TIMEOUT, clock=time.time,
+                 sleep=time.sleep):
+        self._directory = directory
+        self.timeout = timeout
+        self._clock = clock
+        self._sleep = sleep
+        self._held = threading.local()
+
+    def _lockFile(self, volume):
+        # Lock files live beside the volumes rather than in them, so that
+        # they outlast removing a volume which somebody else is waiting for.
+        return self._directory.child(".%s.lock" % (volume,))
+
+    def shared(self, volume):
+        """
+        Hold the shared lock of ``volume`` for the duration of a C{with}
+        block.
+        """
+        return self._locked(volume, fcntl.LOCK_SH)
+
+    def exclusive(self, volume):
+        """
+        Hold the exclusive lock of ``volume`` for the duration of a C{with}
+        block.
+        """
+        return self._locked(volume, fcntl.LOCK_EX)
+
+    @contextmanager
+    def _locked(self, volume, mode):
+        locks = self._held.__dict__.setdefault("locks", {})
+        held = locks.get(volume)
+        if held is None:
+            # the pool is made by the first command that uses it
+            try:
+                self._directory.makedirs()
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+            fd = os.open(self._lockFile(volume).path,
+                         os.O_RDWR | os.O_CREAT, 0644)
+            held = _HeldLock(fd)
+            try:
+                self._flock(volume, fd, mode)
+            except:
+                os.close(fd)
+                raise
+            locks[volume] = held
+        elif mode == fcntl.LOCK_EX and held.modes[0] != fcntl.LOCK_EX:
+            raise UpgradeRefused(
+                "Volume %r is locked for reading and can't be changed until "
+                "the lock is released" % (volume,))
+        else:
+            # Already held at least as strongly.
+            mode = held.modes[0]
+        held.modes.append(mode)
+        try:
+            yield
+        finally:
+            held.modes.pop()
+            if not held.modes:
+                del locks[volume]
+                os.close(held.fd)
+
+    def _flock(self, volume, fd, mode):
+        deadline = self._clock() + self.timeout
+        while True:
+            try:
+                fcntl.flock(fd, mode | fcntl.LOCK_NB)
+                return
+            except IOError, e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+            if self._clock() >= deadline:
+                raise LockTimeout(
+                    "Timed out after %ss waiting for volume %r, which is "
+                    "being changed by another dvol command" % (
+                        self.timeout, volume))
+            self._sleep(POLL_INTERVAL)
@@ -0,0 +1,59 @@
+"""
+A cache of the small JSON files dvol keeps its state in, so that commands
+which look at many volumes, and the plugin which serves every mount, don't
+parse the same unchanged files over and over.
+"""
+
+import errno
+import json
+import os
+
+
+def _key(st):
+    return (st.st_mtime, st.st_size, st.st_ino)
+
+
+class MetadataCache(object):
+    """
+    Parsed JSON files, each kept for as long as its modification time, size
+    and inode stay the same.  Files are replaced by renaming new ones over
+    them (see L{durable.setContent}), which always changes the inode.
+
+    Values are shared between callers, which must not change them.
+
+    @ivar hits: The number of reads answered from the cache.
+    @ivar misses: The number of reads which parsed the file.
+    """
+    def __init__(self):
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def readJSON(self, path):
+        """
+        Return the parsed content of the JSON file at ``path``, or C{None} if
+        there is no such file.
+
+        @type path: L{FilePath}
+        """
+        try:
+            st = os.stat(path.path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            self._entries.pop(path.path, None)
+            return None
+        entry = self._entries.get(path.path)
+        if entry is not None and entry[0] == _key(st):
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        with open(path.path, "rb") as f:
+            # key on the file actually read, in case it was replaced since
+            st = os.fstat(f.fileno())
+            value = json.load(f)
+        self._entries[path.path] = (_key(st), value)
+        return value
+
+    def describe(self):
+        return "%d hits, %d misses" % (self.hits, self.misses)
@@ -0,0 +1,896 @@
+"""
+Content-addressed storage for dvol commits.
+
+Rather than holding a complete copy of the branch it was taken from, each
+commit directory is populated with hard links into an object store which is
+shared by all the commits of a volume.  A file which has not changed since a
+previous commit is therefore stored only once, and making a commit only writes
+the files which are new.
+"""
+
+import ctypes
+import errno
+import hashlib
+import multiprocessing
+import os
+import stat
+import sys
+import uuid
+
+from compression import compressData, compressFile, decompressedBlocks
+from copiers import BUFFER_SIZE, PlainCopier, defaultWorkers, runInThreads
+from durable import _getLibc
+
+OBJECTS_DIRECTORY = ".objects"
+
+# Hashing at least this many files is worth starting a pool of processes
+# for: threads hash large files in parallel, since hashlib doesn't hold the
+# GIL while it digests them, but spend most of their time waiting for it
+# when files are small.
+PROCESS_HASH_THRESHOLD = 1024
+
+
+def _objectHeader(st):
+    """
+    Return the metadata which is hashed along with the contents of a file.
+
+    All hard links to an object share one inode, and so share its mode,
+    ownership and modification time; files which differ in any of these can
+    not be the same object even if their contents are identical.  The
+    modification time is taken to the microsecond, which is as precisely as
+    L{copyMetadata} can restore it, so that a restored file has the key of
+    the object it was restored from.
+    """
+    return "blob %o %d %d %d %d\0" % (
+        stat.S_IMODE(st.st_mode), st.st_uid, st.st_gid, st.st_size,
+        _microseconds(st.st_mtime))
+
+
+def _microseconds(t):
+    """
+    Return a time from a stat result as a whole number of microseconds.
+    """
+    return int(round(t * 1000000))
+
+
+def hashFile(path, st):
+    """
+    Compute the object key of the regular file at ``path``.
+
+    @param path: The path of the file, as L{bytes}.
+    @param st: The result of C{os.lstat(path)}.
+
+    @return: The hex digest of the file's metadata and contents.
+    """
+    digest = hashlib.sha1(_objectHeader(st))
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(BUFFER_SIZE)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def _hashTask(task):
+    path, st = task
+    try:
+        return hashFile(path, st)
+    except (IOError, OSError), e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+
+
+def _hashInProcesses(tasks, workers=None):
+    """
+    Hash regular files with a pool of processes, if there are enough of them
+    to make it worthwhile.
+
+    @param tasks: A L{list} of the path and stat result of each file.
+    @param workers: The number of processes, or C{None} for one per core.
+
+    @return: A L{dict} mapping the path of each file hashed to its key,
+        which leaves out those which disappeared and is empty if the files
+        are better hashed in threads.
+    """
+    if workers is None:
+        workers = defaultWorkers()
+    if workers <= 1 or len(tasks) < PROCESS_HASH_THRESHOLD:
+        return {}
+    pool = multiprocessing.Pool(workers)
+    try:
+        keys = pool.map(_hashTask, tasks,
+                        max(1, min(256, len(tasks) // (workers * 4))))
+    finally:
+        pool.terminate()
+        pool.join()
+    return dict((path, key) for (path, _), key in zip(tasks, keys)
+                if key is not None)
+
+
+def _hashChanged(files, previous, chunks, workers):
+    """
+    Hash the files whose stat result changed since ``previous`` in
+    processes, as for L{_hashInProcesses}.
+
+    @param files: The path, relative path and stat result of each file.
+    """
+    tasks = []
+    for source, relative, st in files:
+        entry = previous.get(relative)
+        if entry is not None and statMatches(entry, st):
+            continue
+        if chunks is not None and chunks.wanted(st):
+            continue
+        tasks.append((source, st))
+    return _hashInProcesses(tasks, workers)
+
+
+class LayeredManifest(object):
+    """
+    Several manifests looked up in turn, such as the files stored ahead of a
+    commit and those of the commit before.
+    """
+    def __init__(self, *manifests):
+        self._manifests = [manifest for manifest in manifests
+                           if manifest is not None]
+
+    def get(self, relative, default=None):
+        for manifest in self._manifests:
+            entry = manifest.get(relative)
+            if entry is not None:
+                return entry
+        return default
+
+
+class SourceChanged(Exception):
+    """
+    A file changed while it was being stored.
+    """
+
+
+class BaseMismatch(Exception):
+    """
+    A tree differs from the earlier snapshot it was being compared with in a
+    path which wasn't reported to have changed.
+    """
+
+
+def copyMetadata(path, st):
+    """
+    Apply the ownership, mode and times described by ``st`` to ``path``, like
+    C{cp -a} does.  Ownership can only be preserved when running as root, so
+    failures to change it are ignored just as C{cp -a} ignores them.
+    """
+    try:
+        os.lchown(path, st.st_uid, st.st_gid)
+    except OSError, e:
+        if e.errno != errno.EPERM:
+            raise
+    if not stat.S_ISLNK(st.st_mode):
+        os.chmod(path, stat.S_IMODE(st.st_mode))
+        _setTimes(path, st.st_atime, st.st_mtime)
+
+
+class _Timeval(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_usec", ctypes.c_long)]
+
+
+def _setTimes(path, atime, mtime):
+    """
+    Set the access and modification times of ``path`` to the microsecond
+    L{_microseconds} rounds them to.  C{os.utime} truncates the fraction of
+    a float instead, so the time it sets can be a microsecond early.
+    """
+    if isinstance(path, unicode):
+        path = path.encode(sys.getfilesystemencoding())
+    times = (_Timeval * 2)(*[_Timeval(*divmod(_microseconds(t), 1000000))
+                             for t in (atime, mtime)])
+    if _getLibc().utimes(path, times) != 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error), path)
+
+
+class ObjectStore(object):
+    """
+    A directory of immutable files named by their L{hashFile} key.
+
+    @ivar path: The L{FilePath} of the store, normally
+        C{<volume>/commits/.objects}.
+    @ivar copier: The L{copiers} implementation used to write objects.
+    @ivar compressed: Whether objects are stored compressed, in which case
+        they must be read with L{read} or L{extract} rather than directly.
+    """
+    def __init__(self, path, copier=None, compressed=False):
+        self.path = path
+        if copier is None:
+            copier = PlainCopier()
+        self.copier = copier
+        self.compressed = compressed
+
+    def objectPath(self, key):
+        return self.path.child(key[:2]).child(key[2:])
+
+    def store(self, source, key, st, verify=False):
+        """
+        Make sure the object ``key`` exists, copying it from ``source`` if it
+        doesn't.
+
+        @param verify: Whether to check that ``source`` still has the stat
+            result ``st`` once it has been copied, raising L{SourceChanged}
+            rather than storing the copy if it doesn't.  Files which may be
+            written to while they are stored must be verified.
+
+        @return: A 2-tuple of the L{FilePath} of the object and whether it had
+            to be written.
+        """
+        objectPath = self.objectPath(key)
+        if objectPath.exists():
+            return objectPath, False
+        temporary = self._temporary(objectPath)
+        if self.compressed:
+            compressFile(source, temporary.path, st.st_size)
+        else:
+            self.copier.copyFile(source, temporary.path)
+        if verify and not _unchangedSince(source, st):
+            temporary.remove()
+            raise SourceChanged(source)
+        copyMetadata(temporary.path, st)
+        os.rename(temporary.path, objectPath.path)
+        return objectPath, True
+
+    def storeData(self, data, key, st=None):
+        """
+        Make sure the object ``key`` exists, writing ``data`` to it if it
+        doesn't, like L{store} does for a file.
+
+        @param st: A stat result whose mode, ownership and times the object
+            is given, or C{None} to leave them as created.
+        """
+        objectPath = self.objectPath(key)
+        if objectPath.exists():
+            return objectPath, False
+        temporary = self._temporary(objectPath)
+        if self.compressed:
+            data = compressData(data)
+        with open(temporary.path, "wb") as f:
+            f.write(data)
+        if st is not None:
+            copyMetadata(temporary.path, st)
+        os.rename(temporary.path, objectPath.path)
+        return objectPath, True
+
+    def read(self, key):
+        """
+        Return the contents of an object.
+        """
+        path = self.objectPath(key).path
+        if self.compressed:
+            return "".join(decompressedBlocks(path))
+        with open(path, "rb") as f:
+            return f.read()
+
+    def extract(self, key, destination, st):
+        """
+        Write the contents of a compressed object to a new file at
+        ``destination``, a block at a time, and give it the metadata in
+        ``st``.
+
+        @return: The number of bytes written.
+        """
+        written = 0
+        with open(destination, "wb") as f:
+            for block in decompressedBlocks(self.objectPath(key).path):
+                f.write(block)
+                written += len(block)
+        copyMetadata(destination, st)
+        return written
+
+    def _temporary(self, objectPath):
+        """
+        Return a temporary name to write an object at before renaming it into
+        place, so that a partially written object is never mistaken for a
+        complete one.
+        """
+        try:
+            objectPath.parent().makedirs()
+        except OSError, e:
+            # Another thread storing a file may have just made it.
+            if e.errno != errno.EEXIST:
+                raise
+        return objectPath.siblingExtension(".%s.tmp" % (uuid.uuid4(),))
+
+    def prune(self, keys=None):
+        """
+        Remove objects which are no longer linked into any commit.
+
+        @param keys: The keys of the objects which may have become
+            unreferenced, or C{None} to check every object in the store.
+
+        @return: The number of objects removed.
+        """
+        if keys is None:
+            if not self.path.exists():
+                return 0
+            candidates = [obj for directory in self.path.children()
+                          for obj in directory.children()]
+        else:
+            candidates = [self.objectPath(key) for key in set(keys)]
+        removed = 0
+        for obj in candidates:
+            try:
+                if os.lstat(obj.path).st_nlink == 1:
+                    obj.remove()
+                    removed += 1
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+        return removed
+
+
+def statEntry(st, key):
+    """
+    Build the manifest entry recording that a file with the given stat result
+    had the object key ``key``.
+    """
+    return [st.st_ino, st.st_size, st.st_mtime, st.st_ctime, key]
+
+
+def statMatches(entry, st):
+    """
+    Determine whether a file still has the stat result recorded in a manifest
+    entry, in which case its contents are assumed to be unchanged.  The change
+    time is compared as well as the size, modification time and inode so that
+    changes to the mode or ownership are noticed too.
+    """
+    return entry[:4] == [st.st_ino, st.st_size, st.st_mtime, st.st_ctime]
+
+
+def _walk(root, live=False, start=""):
+    """
+    Yield the relative path and stat result of ``root`` and everything below
+    it, each directory before its contents.
+
+    @param root: A path as L{bytes}.
+    @param live: Whether the tree may be changing, in which case entries
+        which disappear before they are reached are skipped.
+    @param start: The relative path of the part of ``root`` to walk.
+    """
+    pending = [start]
+    while pending:
+        relative = pending.pop()
+        try:
+            st = os.lstat(_join(root, relative))
+            if stat.S_ISDIR(st.st_mode):
+                names = sorted(os.listdir(_join(root, relative)),
+                               reverse=True)
+        except OSError, e:
+            if not (live and relative and e.errno == errno.ENOENT):
+                raise
+            continue
+        yield relative, st
+        if stat.S_ISDIR(st.st_mode):
+            pending.extend(os.path.join(relative, name) for name in names)
+
+
+def _join(root, relative):
+    if not relative:
+        return root
+    return os.path.join(root, relative)
+
+
+def _changedRoots(changed):
+    """
+    Return the paths in ``changed`` which aren't below another one.
+    """
+    roots = set()
+    for relative in sorted(changed):
+        parent = relative
+        while parent:
+            parent = os.path.dirname(parent)
+            if parent in roots or "" in roots:
+                break
+        else:
+            roots.add(relative)
+    return roots
+
+
+def _walkChanged(root, base, manifest, changed):
+    """
+    Yield what L{_walk} would for ``root``, given that it only differs from
+    the earlier snapshot ``base`` in the paths in ``changed`` and what is
+    below them, as a 4-tuple of the relative path, the path to copy it from,
+    its stat result and its entry in ``manifest``, the manifest of ``base``.
+
+    Everything else is found in ``base``, and its regular files are yielded
+    with their manifest entry instead of a stat result, so that they are
+    linked to the same objects without being looked at.  Only the changed
+    paths and the directories holding them are looked at in ``root``.
+
+    @raise BaseMismatch: If the directories holding the changed paths aren't
+        directories in both trees.
+    """
+    roots = _changedRoots(changed)
+    if "" in roots:
+        for relative, st in _walk(root):
+            yield relative, _join(root, relative), st, None
+        return
+    parents = set()
+    for relative in roots:
+        while relative:
+            relative = os.path.dirname(relative)
+            parents.add(relative)
+    directories = set()
+    pending = [""]
+    while pending:
+        relative = pending.pop()
+        source = base
+        if relative in parents:
+            source = root
+        st = os.lstat(_join(source, relative))
+        if not stat.S_ISDIR(st.st_mode):
+            raise BaseMismatch(relative)
+        directories.add(relative)
+        yield relative, _join(source, relative), st, None
+        for name in sorted(os.listdir(_join(base, relative)), reverse=True):
+            child = os.path.join(relative, name)
+            if child in roots:
+                continue
+            entry = manifest.get(child)
+            if entry is not None:
+                yield child, _join(base, child), None, entry
+                continue
+            st = os.lstat(_join(base, child))
+            if stat.S_ISDIR(st.st_mode):
+                pending.append(child)
+            else:
+                yield child, _join(base, child), st, None
+    for top in sorted(roots):
+        try:
+            os.lstat(_join(root, top))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            # Removed since the earlier snapshot.
+            continue
+        if os.path.dirname(top) not in directories:
+            raise BaseMismatch(top)
+        for relative, st in _walk(root, start=top):
+            yield relative, _join(root, relative), st, None
+
+
+def _createSpecial(destination, st):
+    """
+    Recreate the FIFO, socket or device node described by ``st``.
+    """
+    os.mknod(destination, st.st_mode, st.st_rdev)
+    copyMetadata(destination, st)
+
+
+def _finishDirectories(directories):
+    """
+    Copy the metadata of directories once everything has been written to
+    them: the modification time of a directory changes as entries are added
+    to it.  Deepest directories go first, since setting metadata on a
+    directory doesn't change its parent.
+    """
+    for destination, st in reversed(directories):
+        copyMetadata(destination, st)
+
+
+def _copyTreeStructure(source, destination, st, directories):
+    """
+    Create a directory, symlink or special file found by L{_walk}, returning
+    whether it was one.  Regular files are left to the caller.
+    """
+    if stat.S_ISDIR(st.st_mode):
+        os.mkdir(destination)
+        directories.append((destination, st))
+    elif stat.S_ISLNK(st.st_mode):
+        os.symlink(os.readlink(source), destination)
+        copyMetadata(destination, st)
+    elif stat.S_ISREG(st.st_mode):
+        return False
+    else:
+        # FIFOs, sockets and device nodes.
+        _createSpecial(destination, st)
+    return True
+
+
+def copyTree(fromPath, toPath, copier=None, workers=None, statistics=None,
+             assemble=None):
+    """
+    Copy ``fromPath`` to ``toPath``, which must not exist, in the same way as
+    C{cp -a --no-preserve=links}: the tree is walked once to recreate its
+    directories, symlinks and special files, and the regular files found are
+    then copied by a pool of threads.
+
+    @type fromPath: L{FilePath}
+    @type toPath: L{FilePath}
+    @param copier: The L{copiers} implementation used to copy files.
+    @param workers: The number of threads copying files, or C{None} for one
+        per core.
+    @param statistics: A L{copiers.CopyStatistics} to count the copied files
+        in, or C{None}.
+    @param assemble: A callable which writes the files stored as chunks, as
+        described by L{restoreTree}, or C{None}.
+    """
+    if toPath.exists():
+        raise Exception(
+            "Cannot copy %(fromPath)s to %(toPath)s because it exists" %
+            dict(toPath=toPath.path, fromPath=fromPath.path))
+    if copier is None:
+        copier = PlainCopier()
+    directories = []
+    files = []
+    for relative, st in _walk(fromPath.path):
+        source = _join(fromPath.path, relative)
+        destination = _join(toPath.path, relative)
+        if not _copyTreeStructure(source, destination, st, directories):
+            files.append((source, destination, relative, None, st))
+
+    copyFile = _fileCopier(copier, assemble)
+
+    _process(copyFile, files, workers, statistics)
+    _finishDirectories(directories)
+
+
+def _process(function, tasks, workers, statistics):
+    """
+    Run ``function`` on the files described by ``tasks`` in threads, counting
+    each in ``statistics`` as it completes.  The last element of each task is
+    the stat result of the file, and ``function`` returns the number of bytes
+    it processed.
+    """
+    if statistics is not None:
+        statistics.expect(len(tasks), sum(task[-1].st_size for task in tasks))
+    for size in runInThreads(function, tasks, workers):
+        if statistics is not None:
+            statistics.add(size)
+
+
+def _fileCopier(copier, assemble):
+    """
+    Return a function copying a file described by a task of
+    L{copyTree} or L{restoreTree}, assembling it from chunks or
+    decompressing it if ``assemble`` writes it.
+    """
+    def copyFile(task):
+        source, destination, relative, existing, st = task
+        if assemble is not None:
+            written = assemble(relative, destination, st, existing)
+            if written is not None:
+                return written
+        if existing is not None:
+            os.remove(destination)
+        copier.copyFile(source, destination)
+        copyMetadata(destination, st)
+        return st.st_size
+    return copyFile
+
+
+def _unchangedSince(path, st):
+    return statMatches(statEntry(st, None), os.lstat(path))
+
+
+def _fileSystemTime(path):
+    """
+    Return the current time as the filesystem holding the directory
+    ``path`` records it, in the same granularity as the times of its files.
+
+    @type path: L{FilePath}
+    """
+    temporary = path.temporarySibling(".now")
+    temporary.open("w").close()
+    try:
+        return os.lstat(temporary.path).st_mtime
+    finally:
+        temporary.remove()
+
+
+def storeTree(fromPath, store, previous=None, workers=None, statistics=None,
+              chunks=None, changed=None):
+    """
+    Store the regular files of ``fromPath`` in ``store`` while it is still
+    being written to, so that a L{snapshotTree} of it made shortly afterwards
+    only has to store the files which changed in between.
+
+    Files which change or disappear while they are read are left out, as are
+    any which appear after they would have been found.  So are files which
+    were last changed after storing started: they may change again within
+    the granularity of their timestamps, leaving a stat result which matches
+    the one recorded here, so they are stored but hashed again by
+    L{snapshotTree}.
+
+    @type fromPath: L{FilePath}
+    @type store: L{ObjectStore}
+    @param previous: The manifest of an earlier snapshot of ``fromPath``, or
+        C{None}, as for L{snapshotTree}.
+    @param workers: The number of threads hashing and storing files, or
+        C{None} for one per core.
+    @param statistics: A L{copiers.CopyStatistics} to count the files in, or
+        C{None}.
+    @param chunks: The L{chunks.ChunkStore} to store large files in, as for
+        L{snapshotTree}, or C{None}.
+    @param changed: The relative paths which may have changed since
+        ``previous`` was taken, as for L{snapshotTree}, in which case only
+        the files at or below them are stored, or C{None}.
+
+    @return: A manifest to pass to L{snapshotTree} as ``previous``.
+    """
+    previous = previous or {}
+    manifest = {}
+    files = []
+    started = _fileSystemTime(fromPath)
+    roots = [""] if changed is None else _changedRoots(changed)
+    for top in roots:
+        for relative, st in _walk(fromPath.path, live=True, start=top):
+            if stat.S_ISREG(st.st_mode):
+                files.append((_join(fromPath.path, relative), relative, st))
+    hashed = _hashChanged(files, previous, chunks, workers)
+
+    def storeFile(task):
+        source, relative, st = task
+        entry = previous.get(relative)
+        if (entry is not None and statMatches(entry, st)
+                and store.objectPath(entry[-1]).exists()):
+            manifest[relative] = entry
+            return st.st_size
+        racy = max(st.st_mtime, st.st_ctime) >= started
+        try:
+            if chunks is not None and chunks.wanted(st):
+                key = chunks.store(source, st, verify=True)
+            else:
+                key = hashed.get(source) or hashFile(source, st)
+                if not _unchangedSince(source, st):
+                    return st.st_size
+                store.store(source, key, st, verify=True)
+            if not racy:
+                manifest[relative] = statEntry(st, key)
+        except SourceChanged:
+            pass
+        except (IOError, OSError), e:
+            if e.errno != errno.ENOENT:
+                raise
+        return st.st_size
+
+    _process(storeFile, files, workers, statistics)
+    return manifest
+
+
+def _treeKind(source, st, entry):
+    """
+    Return what a tree hash records about an entry found by L{snapshotTree}
+    besides its name: its kind, and for symlinks and special files what they
+    hold.
+    """
+    if entry is not None or stat.S_ISREG(st.st_mode):
+        return "f", None
+    if stat.S_ISDIR(st.st_mode):
+        return "d", None
+    if stat.S_ISLNK(st.st_mode):
+        return "l", os.readlink(source)
+    return "s", "%o %d" % (st.st_mode, st.st_rdev)
+
+
+def treeHashes(layout, manifest):
+    """
+    Compute the hash of every directory of a tree from the hashes of what it
+    holds, so that two directories with the same hash hold the same files.
+
+    @param layout: The relative path of everything in the tree, each
+        directory before its contents, followed by what L{_treeKind} returns
+        for it.
+    @param manifest: The manifest of the tree, which has the object key of
+        each regular file.
+
+    @return: A L{dict} mapping the relative path of each directory to its
+        hash.
+    """
+    children = {}
+    hashes = {}
+    # Deepest first, so that each directory's contents are hashed before it.
+    for relative, kind, detail in reversed(layout):
+        if kind == "d":
+            detail = hashlib.sha1(
+                "".join(sorted(children.pop(relative, [])))).hexdigest()
+            hashes[relative] = detail
+        elif kind == "f":
+            detail = manifest[relative][-1]
+        if relative:
+            children.setdefault(os.path.dirname(relative), []).append(
+                "%s %s\0%s\0" % (kind, os.path.basename(relative), detail))
+    return hashes
+
+
+def snapshotTree(fromPath, toPath, store, previous=None, workers=None,
+                 statistics=None, chunks=None, base=None, changed=None,
+                 tree=None):
+    """
+    Populate ``toPath``, which must not exist, with the contents of
+    ``fromPath`` in the same way as C{cp -a}, except that regular files are
+    hard links to objects in ``store``.
+
+    @type fromPath: L{FilePath}
+    @type toPath: L{FilePath}
+    @type store: L{ObjectStore}
+
+    @param previous: The manifest returned by an earlier call for the same
+        ``fromPath``, or C{None}.  Files whose stat result has not changed
+        since are linked to their earlier object without being read again.
+    @param workers: The number of threads hashing and storing files, or
+        C{None} for one per core.
+    @param statistics: A L{copiers.CopyStatistics} to count the files in, or
+        C{None}.
+    @param chunks: A L{chunks.ChunkStore} to store large files in as chunks,
+        only writing the chunks which aren't stored yet, or C{None}.  The
+        file in ``toPath`` is then a link to the list of its chunks.
+    @param base: An earlier snapshot of ``fromPath`` to build on, as a
+        2-tuple of its L{FilePath} and its manifest, or C{None}.
+    @param changed: The relative paths which may have changed since
+        ``base`` was taken, or C{None}.  When given, only these paths and
+        what is below them are looked at in ``fromPath``, and everything
+        else is copied from ``base``.
+    @param tree: A L{dict} to fill with the L{treeHashes} of ``toPath``, or
+        C{None}.
+
+    @return: The manifest of ``toPath``, a L{dict} mapping the relative path
+        of each regular file to its L{statEntry}.
+
+    @raise BaseMismatch: If ``fromPath`` turns out to differ from ``base``
+        in a path which isn't in ``changed``, leaving ``toPath`` partly
+        written.
+    """
+    if toPath.exists():
+        raise Exception(
+            "Cannot copy %(fromPath)s to %(toPath)s because it exists" %
+            dict(toPath=toPath.path, fromPath=fromPath.path))
+    previous = previous or {}
+    manifest = {}
+    directories = []
+    files = []
+    layout = []
+    if changed is None:
+        found = ((relative, _join(fromPath.path, relative), st, None)
+                 for relative, st in _walk(fromPath.path))
+    else:
+        found = _walkChanged(fromPath.path, base[0].path, base[1], changed)
+    for relative, source, st, entry in found:
+        destination = _join(toPath.path, relative)
+        if tree is not None:
+            layout.append((relative,) + _treeKind(source, st, entry))
+        if entry is not None:
+            os.link(store.objectPath(entry[-1]).path, destination)
+            manifest[relative] = entry
+        elif not _copyTreeStructure(source, destination, st, directories):
+            files.append((source, destination, relative, st))
+    hashed = _hashChanged([(source, relative, st)
+                           for source, _, relative, st in files],
+                          previous, chunks, workers)
+
+    def snapshotFile(task):
+        source, destination, relative, st = task
+        entry = previous.get(relative)
+        if (entry is not None and statMatches(entry, st)
+                and store.objectPath(entry[-1]).exists()):
+            key = entry[-1]
+        elif chunks is not None and chunks.wanted(st):
+            key = chunks.store(source, st)
+        else:
+            key = hashed.get(source) or hashFile(source, st)
+            store.store(source, key, st)
+        os.link(store.objectPath(key).path, destination)
+        # Each thread sets a different key, which is safe with the GIL.
+        manifest[relative] = statEntry(st, key)
+        return st.st_size
+
+    _process(snapshotFile, files, workers, statistics)
+    _finishDirectories(directories)
+    if tree is not None:
+        tree.update(treeHashes(layout, manifest))
+    return manifest
+
+
+def restoreTree(fromPath, toPath, unchanged, copier=None, workers=None,
+                statistics=None, assemble=None):
+    """
+    Make the existing directory ``toPath`` identical to the commit
+    ``fromPath``, copying only what differs.
+
+    @type fromPath: L{FilePath}
+    @type toPath: L{FilePath}
+
+    @param unchanged: A callable taking the relative path of a regular file
+        and the stat result of the file at that path in ``toPath``, returning
+        whether it already has the same contents as in ``fromPath`` and so can
+        be left alone.
+    @param copier: The L{copiers} implementation used to copy files.
+    @param workers: The number of threads copying files, or C{None} for one
+        per core.
+    @param statistics: A L{copiers.CopyStatistics} to count the copied files
+        in, or C{None}.
+    @param assemble: A callable taking the relative path of a regular file,
+        the path to write it at, its stat result in ``fromPath`` and the stat
+        result of the regular file already at that path or C{None}.  If the
+        file is stored as chunks, it writes it, reusing the existing file if
+        it can, and returns the number of bytes written; otherwise it returns
+        C{None} and the file is copied.  C{None} if nothing is stored as
+        chunks.
+    """
+    if copier is None:
+        copier = PlainCopier()
+    directories = []
+    copies = []
+    _restoreEntry(fromPath.path, toPath.path, "", unchanged, directories,
+                  copies, assemble is not None)
+
+    # Files are copied rather than linked: the branch is written to by
+    # containers and must never share an inode with a stored object.
+    copyFile = _fileCopier(copier, assemble)
+
+    _process(copyFile, copies, workers, statistics)
+    _finishDirectories(directories)
+
+
+def _restoreEntry(source, destination, relative, unchanged, directories,
+                  copies, keep=False):
+    """
+    Bring one entry of the tree being restored up to date, making
+    directories, symlinks and special files immediately and adding the
+    regular files which need copying to ``copies``.
+
+    @param keep: Whether regular files which differ are left for the copy to
+        replace, rather than removed straight away, so that files stored as
+        chunks can be updated in place.
+    """
+    st = os.lstat(source)
+    mode = st.st_mode
+    try:
+        existing = os.lstat(destination)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        existing = None
+    if stat.S_ISDIR(mode):
+        if existing is not None and not stat.S_ISDIR(existing.st_mode):
+            os.remove(destination)
+            existing = None
+        if existing is None:
+            os.mkdir(destination)
+        directories.append((destination, st))
+        names = set(os.listdir(source))
+        for name in os.listdir(destination):
+            if name not in names:
+                _removeEntry(os.path.join(destination, name))
+        for name in sorted(names):
+            _restoreEntry(
+                os.path.join(source, name), os.path.join(destination, name),
+                os.path.join(relative, name), unchanged, directories, copies,
+                keep)
+        return
+    if existing is not None:
+        if stat.S_ISREG(mode) and stat.S_ISREG(existing.st_mode):
+            if unchanged(relative, existing):
+                return
+        else:
+            keep = False
+        if not keep:
+            _removeEntry(destination)
+            existing = None
+    if stat.S_ISREG(mode):
+        copies.append((source, destination, relative, existing, st))
+    elif stat.S_ISLNK(mode):
+        os.symlink(os.readlink(source), destination)
+        copyMetadata(destination, st)
+    else:
+        _createSpecial(destination, st)
+
+
+def _removeEntry(path):
+    if stat.S_ISDIR(os.lstat(path).st_mode):
+        for name in os.listdir(path):
+            _removeEntry(os.path.join(path, name))
+        os.rmdir(path)
+    else:
+        os.remove(path)
@@ -16,11 +16,170 @@ a volume...
 """
 
 from twisted.application import internet
-from twisted.internet import reactor
+from twisted.internet import defer, reactor, task
+from twisted.internet.threads import deferToThreadPool
 from twisted.web import server, resource
+from twisted.python import log
 from twisted.python.filepath import FilePath
 import json
+import threading
+import time
 from dvol import Voluminous, VOLUME_DRIVER_NAME
+from dockercontainers import ContainerIndex, Containers
+
+# Seconds to wait before reconnecting to Docker's event stream.
+EVENTS_RETRY_DELAY = 1
+
+# Seconds between logging how well the metadata cache is doing.
+CACHE_REPORT_INTERVAL = 600
+
+
+def apply_events(containers, index, events, callFromThread):
+    """
+    Update the index of which containers use which volumes from Docker's
+    events as they arrive.  Blocks on ``events``, so it runs in a thread and
+    hands the updates to the reactor with ``callFromThread``.
+    """
+    for event in events:
+        if event.get("Type", "container") != "container":
+            continue
+        action = event.get("Action", event.get("status"))
+        if action == "start":
+            try:
+                container = containers.client.inspect_container(event["id"])
+            except:
+                log.err(None, "while fetching container state %s, "
+                              "maybe it was deleted" % (event["id"],))
+                continue
+            callFromThread(index.container_started, container["Id"],
+                           container["Name"],
+                           containers.related_volumes(container))
+        elif action in ("die", "destroy"):
+            callFromThread(index.container_stopped, event["id"])
+
+
+def follow_events(containers, index, callFromThread):
+    """
+    Keep the index up to date for as long as the plugin runs, rebuilding it
+    from a full scan whenever the event stream is (re)connected, since events
+    may have been missed.
+    """
+    while True:
+        try:
+            events = containers.client.events(decode=True)
+            callFromThread(index.replace, containers.scan(indexed=False))
+            apply_events(containers, index, events, callFromThread)
+        except:
+            log.err(None, "while following docker events")
+        time.sleep(EVENTS_RETRY_DELAY)
+
+
+class VolumeSerializer(object):
+    """
+    Run operations on volumes in threads, one at a time for each volume, so
+    that slow filesystem work doesn't hold up the reactor and operations on
+    different volumes proceed in parallel.
+    """
+    def __init__(self, reactor=reactor):
+        self._reactor = reactor
+        self._locks = dict()
+
+    def run(self, volume, function, *args):
+        """
+        Call ``function`` in a thread once every earlier operation on
+        ``volume`` has finished.
+
+        @return: A L{Deferred} firing with the result of ``function``.
+        """
+        lock = self._locks.setdefault(volume, defer.DeferredLock())
+        d = lock.run(deferToThreadPool, self._reactor,
+                     self._reactor.getThreadPool(), function, *args)
+
+        def forget(result):
+            if not lock.locked and not lock.waiting:
+                self._locks.pop(volume, None)
+            return result
+        d.addBoth(forget)
+        return d
+
+
+class BranchWatchers(object):
+    """
+    The L{dirtypaths.BranchWatcher}s of the branches containers have
+    mounted, so that committing them only looks at the paths which changed.
+
+    Watchers are started from the threads requests run in and stopped from
+    the reactor thread, so C{_watchers} is only used with C{_lock} held.
+    """
+    def __init__(self, voluminous):
+        self.voluminous = voluminous
+        self._watchers = dict()
+        self._lock = threading.Lock()
+
+    def watch(self, volume):
+        """
+        Start watching the active branch of ``volume``, unless it is watched
+        already or its backend doesn't support it.
+        """
+        branch = self.voluminous.getActiveBranch(volume)
+        with self._lock:
+            watcher = self._watchers.get((volume, branch))
+            if watcher is not None and watcher.running:
+                return
+            backend = self.voluminous.backend(volume)
+            if not hasattr(backend, "watcher"):
+                return
+            watcher = backend.watcher(volume, branch)
+            try:
+                started = watcher.start()
+            except:
+                # commits look at every file instead
+                log.err(None, "while watching %s/%s" % (volume, branch))
+                return
+            if started:
+                self._watchers[(volume, branch)] = watcher
+
+    def unwatch(self, volume):
+        """
+        Stop watching the branches of ``volume``.
+        """
+        with self._lock:
+            stopping = [self._watchers.pop(key)
+                        for key in list(self._watchers) if key[0] == volume]
+        for watcher in stopping:
+            watcher.stop()
+
+    def stopAll(self):
+        """
+        Stop every watcher, for when the plugin shuts down.
+        """
+        with self._lock:
+            stopping = self._watchers.values()
+            self._watchers = dict()
+        for watcher in stopping:
+            watcher.stop()
+
+
+def respond(request, d):
+    """
+    Finish ``request`` with the JSON body ``d`` fires with, or with an error
+    Docker can show if it fails.
+    """
+    finished = []
+    request.notifyFinish().addBoth(finished.append)
+
+    def failed(failure):
+        log.err(failure, "while handling %s" % (request.path,))
+        return json.dumps(dict(Err=failure.getErrorMessage()))
+
+    def write(body):
+        if not finished:
+            request.write(body)
+            request.finish()
+    d.addErrback(failed)
+    d.addCallback(write)
+    d.addErrback(log.err)
+
 
 class HandshakeResource(resource.Resource):
     """
@@ -46,13 +205,19 @@ class CreateResource(resource.Resource):
     """
     isLeaf = True
 
-    def __init__(self, voluminous):
+    def __init__(self, voluminous, serializer):
         self.voluminous = voluminous
+        self.serializer = serializer
         resource.Resource.__init__(self)
 
     def render_POST(self, request):
         payload = json.loads(request.content.read())
         print "create:", payload
+        respond(request, self.serializer.run(
+            payload["Name"], self._create, payload))
+        return server.NOT_DONE_YET
+
+    def _create(self, payload):
         try:
             if not self.voluminous.exists(payload["Name"]):
                 self.voluminous.createVolume(payload["Name"])
@@ -61,8 +226,8 @@ class CreateResource(resource.Resource):
             ))
         except Exception, e:
             return json.dumps(dict(
-                err=("voluminous '%(name)s' creation failed: %(err)s" %
-                    dict(name=payload["name"], err=str(e))
+                Err=("voluminous '%(name)s' creation failed: %(err)s" %
+                    dict(name=payload["Name"], err=str(e))
             )))
 
 class RemoveResource(resource.Resource):
@@ -112,8 +277,10 @@ class UnmountResource(resource.Resource):
     """
     isLeaf = True
 
-    def __init__(self, voluminous):
+    def __init__(self, voluminous, index, watchers=None):
         self.voluminous = voluminous
+        self.index = index
+        self.watchers = watchers
         resource.Resource.__init__(self)
 
     def render_POST(self, request):
@@ -121,6 +288,14 @@ class UnmountResource(resource.Resource):
         payload = json.loads(request.content.read())
         print "unmount:", payload
         # XXX actually 'release' the volume in some sense
+        if self.index is not None:
+            self.index.unmounted(payload["Name"], payload.get("ID"))
+        # nothing writes to the volume once its last mount is gone, and a
+        # commit without a watcher looks at every file
+        if self.watchers is not None and (
+                self.index is None or not self.index.mounts.get(
+                    payload["Name"])):
+            self.watchers.unwatch(payload["Name"])
         return json.dumps(dict(
              Err=None,
         ))
@@ -131,26 +306,58 @@ class MountResource(resource.Resource):
     """
     isLeaf = True
 
-    def __init__(self, voluminous):
+    def __init__(self, voluminous, index, serializer, watchers=None):
         self.voluminous = voluminous
+        self.index = index
+        self.serializer = serializer
+        self.watchers = watchers
         resource.Resource.__init__(self)
 
     def render_POST(self, request):
         payload = json.loads(request.content.read())
         print "mount:", payload
-        if self.voluminous.exists(payload["Name"]):
-            # TODO - (asynchronously?) add this container id to the set of
-            # active containers to show up in the dvol list output?
+        d = self.serializer.run(payload["Name"], self._mount, payload)
+
+        def mounted(body):
+            # the id of the container isn't part of the request; it's added
+            # to the index when Docker reports that the container started
+            if self.index is not None and json.loads(body)["Err"] is None:
+                self.index.mounted(payload["Name"], payload.get("ID"))
+            return body
+        d.addCallback(mounted)
+        respond(request, d)
+        return server.NOT_DONE_YET
+
+    def _mount(self, payload):
+        # a volume whose running point is current is mounted without waiting
+        # for its lock, which dvol holds while it restarts the containers
+        # that are mounting it
+        mountpoint = self.voluminous.currentRunningPoint(payload["Name"])
+        if mountpoint is not None:
+            if self.watchers is not None:
+                self.watchers.watch(payload["Name"])
             return json.dumps(dict(
-                Mountpoint=self.voluminous.updateRunningPoint(payload["Name"]),
+                Mountpoint=mountpoint,
                 Err=None,
             ))
-        else:
-            return json.dumps(dict(
-                Mountpoint="",
-                Err=("Voluminous '%(name)s' does not exist, "
-                     "create it with: dvol init %(name)s" % (dict(name=payload["Name"]))),
-            ))
+        # hold the volume's lock so that a dvol command can't remove or
+        # switch the volume between checking it and pointing at it
+        with self.voluminous.locks.exclusive(payload["Name"]):
+            if self.voluminous.exists(payload["Name"]):
+                mountpoint = self.voluminous.updateRunningPoint(
+                    payload["Name"])
+                if self.watchers is not None:
+                    self.watchers.watch(payload["Name"])
+                return json.dumps(dict(
+                    Mountpoint=mountpoint,
+                    Err=None,
+                ))
+            else:
+                return json.dumps(dict(
+                    Mountpoint="",
+                    Err=("Voluminous '%(name)s' does not exist, "
+                         "create it with: dvol init %(name)s" % (dict(name=payload["Name"]))),
+                ))
 
         new_json = {}
         path = None
@@ -164,14 +371,19 @@ class MountResource(resource.Resource):
         return json.dumps(new_json)
 
 
-def getAdapter(voluminous):
+def getAdapter(voluminous, index=None, serializer=None, watchers=None):
+    if serializer is None:
+        serializer = VolumeSerializer()
     root = resource.Resource()
     root.putChild("Plugin.Activate", HandshakeResource(voluminous))
-    root.putChild("VolumeDriver.Create", CreateResource(voluminous))
+    root.putChild("VolumeDriver.Create",
+                  CreateResource(voluminous, serializer))
     root.putChild("VolumeDriver.Remove", RemoveResource(voluminous))
     root.putChild("VolumeDriver.Path", PathResource(voluminous))
-    root.putChild("VolumeDriver.Mount", MountResource(voluminous))
-    root.putChild("VolumeDriver.Unmount", UnmountResource(voluminous))
+    root.putChild("VolumeDriver.Mount",
+                  MountResource(voluminous, index, serializer, watchers))
+    root.putChild("VolumeDriver.Unmount",
+                  UnmountResource(voluminous, index, watchers))
 
     site = server.Site(root)
     return site
@@ -187,11 +399,26 @@ def main():
         dvol_path.makedirs()
     voluminous = Voluminous(dvol_path.path)
 
+    index = ContainerIndex()
+    index.hold()
+    events = threading.Thread(
+        target=follow_events,
+        args=(Containers(VOLUME_DRIVER_NAME), index, reactor.callFromThread))
+    events.daemon = True
+    reactor.callWhenRunning(events.start)
+
+    cacheReport = task.LoopingCall(
+        lambda: log.msg("metadata cache: %s" % (
+            voluminous.metadata.describe(),)))
+    reactor.callWhenRunning(cacheReport.start, CACHE_REPORT_INTERVAL, False)
+
     sock = plugins_dir.child("%s.sock" % (VOLUME_DRIVER_NAME,))
     if sock.exists():
         sock.remove()
 
+    watchers = BranchWatchers(voluminous)
+    reactor.addSystemEventTrigger("before", "shutdown", watchers.stopAll)
     adapterServer = internet.UNIXServer(
-            sock.path, getAdapter(voluminous))
+            sock.path, getAdapter(voluminous, index, watchers=watchers))
     reactor.callWhenRunning(adapterServer.startService)
     reactor.run()
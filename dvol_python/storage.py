@@ -0,0 +1,720 @@
+"""
+Storage backends for dvol volumes.
+
+A backend owns the data of a volume's branches and commits: how a commit is
+taken, how a branch is created from or reset to a commit, and which path is
+handed to Docker to mount.  The metadata saying which commits each branch has
+and which branch is active is kept by L{Voluminous} in the same way whichever
+backend a volume uses.
+
+Each volume records its backend in C{<volume>/storage.json}; volumes without
+that file use L{DirectoryBackend}.
+"""
+
+import json
+import os
+import subprocess
+import uuid
+from contextlib import contextmanager
+
+import durable
+from branchindex import BranchIndex, indexPath, writeIndex
+from chunks import CHUNKS_DIRECTORY, ChunkStore
+from dirtypaths import (
+    DIRTY_EXTENSION, FENCE_EXTENSION, BranchWatcher, changedPaths, recorded,
+)
+from objectstore import (
+    OBJECTS_DIRECTORY, BaseMismatch, LayeredManifest, ObjectStore,
+    _changedRoots, copyTree, hashFile, restoreTree, snapshotTree,
+    statMatches, storeTree,
+)
+from treediff import compareTrees
+
+STORAGE_FILENAME = "storage.json"
+
+
+def copyTo(fromPath, toPath, copier=None, workers=None, statistics=None,
+           assemble=None):
+    """
+    Copy the contents of fromPath to toPath, assuming a quiesced filesystem,
+    and that toPath doesn't exist, in a way that doesn't fail to copy special
+    files like FIFOs, cloning file data if the copier supports it.
+
+    Hard links are not preserved, because identical files in a commit are
+    hard links to the same object and must not stay linked once they are
+    copied somewhere writeable.
+    """
+    copyTree(fromPath, toPath, copier, workers, statistics, assemble)
+    os.chmod(toPath.path, 0777) # TODO add tests
+
+
+def makeWorldWriteable(branchPath):
+    # This branch is the one which will be bind-mounted into running
+    # containers, via a symlink, but with symlinks and docker bind-mounts
+    # it seems that it's the permissions of the target which affects the
+    # (e.g.) writeability of the resulting mount.
+    # Because some containers have processes which run as non-root users,
+    # make the volume world-writeable so that it can still be useful to
+    # those processes. In the future, it might be better to have options
+    # for which uid, gid and perms the volume should have. This is
+    # effectively the same as `chmod a=rwx branchPath.path`.
+    os.chmod(branchPath.path, 0777)
+
+
+class DirectoryBackend(object):
+    """
+    Store each branch as a plain directory, and each commit as a directory of
+    hard links into the volume's L{ObjectStore}.
+
+    @ivar _commitDatabase: Where stat manifests of commits are recorded.
+    @ivar _copier: A callable returning the copier for the pool.
+    @ivar _workers: The number of threads copying files, or C{None} for one
+        per core.
+    @ivar chunked: Whether large files are stored as chunks, in a
+        L{ChunkStore}, so that commits only store the parts of them which
+        changed.
+    @ivar compressed: Whether objects are stored compressed, and decompressed
+        straight into the branch when it is reset or checked out.
+
+    The methods which copy data take an optional L{copiers.CopyStatistics}
+    to count the files they process in.
+    """
+    name = "directory"
+
+    def __init__(self, directory, commitDatabase, copier, workers=None,
+                 chunked=False, compressed=False):
+        self._directory = directory
+        self._commitDatabase = commitDatabase
+        self._copier = copier
+        self._workers = workers
+        self.chunked = chunked
+        self.compressed = compressed
+
+    def _branchPath(self, volume, branch):
+        return self._directory.child(volume).child("branches").child(branch)
+
+    def _commitPath(self, volume, commitId):
+        return self._directory.child(volume).child("commits").child(commitId)
+
+    def _indexPath(self, volume, branch):
+        return indexPath(self._directory.child(volume), branch)
+
+    def _objectStore(self, volume):
+        return ObjectStore(self._directory.child(volume).child(
+            "commits").child(OBJECTS_DIRECTORY), self._copier(),
+            self.compressed)
+
+    def _chunkStore(self, volume):
+        return ChunkStore(self._directory.child(volume).child(
+            "commits").child(CHUNKS_DIRECTORY), self._objectStore(volume))
+
+    def _chunksForCommit(self, volume):
+        """
+        Return the L{ChunkStore} to store large files in when committing, or
+        C{None} if they are stored whole.
+        """
+        if not self.chunked:
+            return None
+        return self._chunkStore(volume)
+
+    def _assembler(self, volume, target, head=None):
+        """
+        Return a function which writes the files of a commit which are stored
+        as chunks or compressed, for L{restoreTree}.
+
+        @param target: The files of the manifest of the commit.
+        @param head: The files of the manifest the files already in place
+            were committed with, or C{None}.
+        """
+        chunks = self._chunkStore(volume)
+        head = head or {}
+
+        def assemble(relative, destination, st, existing):
+            entry = target.get(relative)
+            if entry is None:
+                return None
+            if not chunks.isRecipe(entry[-1]):
+                if not self.compressed:
+                    return None
+                if existing is not None:
+                    os.remove(destination)
+                return chunks.objects.extract(entry[-1], destination, st)
+            base = None
+            if existing is not None:
+                previous = head.get(relative)
+                if (previous is not None and statMatches(previous, existing)
+                        and chunks.isRecipe(previous[-1])):
+                    base = previous[-1]
+                else:
+                    os.remove(destination)
+            return chunks.assemble(entry[-1], destination, st, base)
+        return assemble
+
+    @contextmanager
+    def _head(self, volume, branch):
+        """
+        Open the id and stat manifest of the latest commit on a branch,
+        provided that it was taken from that branch's own files, or C{None},
+        for the duration of a C{with} block.  The files of the manifest come
+        from the branch's L{BranchIndex} when it describes that commit, and
+        it is closed when the block ends.
+        """
+        try:
+            head = self._commitDatabase.commitFromHead(volume, branch, 0)
+        except IndexError:
+            yield None
+            return
+        index = BranchIndex.open(self._indexPath(volume, branch))
+        if index is not None:
+            with index:
+                if index.metadata["commit"] == head["id"]:
+                    yield head["id"], dict(branch=branch, files=index,
+                                           dirty=index.metadata.get("dirty"))
+                    return
+        manifest = self._commitDatabase.readManifest(volume, head["id"])
+        if manifest is None or manifest["branch"] != branch:
+            yield None
+            return
+        yield head["id"], manifest
+
+    def _changes(self, volume, branch, head):
+        """
+        Ask the branch's L{BranchWatcher}, if it has one, which paths changed
+        since the commit L{_head} returned, as for L{changedPaths}.
+        """
+        since = None
+        if head is not None:
+            since = head[1].get("dirty")
+        return changedPaths(self._branchPath(volume, branch), since)
+
+    def watcher(self, volume, branch):
+        """
+        Return a L{BranchWatcher} for a branch, which commits use to only
+        look at what changed while it runs.
+        """
+        return BranchWatcher(self._branchPath(volume, branch))
+
+    def createVolume(self, volume):
+        pass
+
+    def deleteVolume(self, volume):
+        pass
+
+    def createBranch(self, volume, branch):
+        branchPath = self._branchPath(volume, branch)
+        branchPath.makedirs()
+        makeWorldWriteable(branchPath)
+
+    def deleteBranch(self, volume, branch):
+        branchPath = self._branchPath(volume, branch)
+        branchPath.remove()
+        for path in (branchPath.siblingExtension(DIRTY_EXTENSION),
+                     branchPath.siblingExtension(FENCE_EXTENSION),
+                     self._indexPath(volume, branch)):
+            if path.exists():
+                path.remove()
+
+    def pathForMount(self, volume, branch):
+        return self._branchPath(volume, branch)
+
+    def mountedPath(self, volume, branch):
+        """
+        Return what L{pathForMount} would if it doesn't need to change
+        anything to return it, or C{None}.
+        """
+        branchPath = self._branchPath(volume, branch)
+        if not branchPath.isdir():
+            return None
+        return branchPath
+
+    def commitExists(self, volume, commitId):
+        return self._commitPath(volume, commitId).exists()
+
+    def listCommits(self, volume):
+        commits = self._directory.child(volume).child("commits")
+        if not commits.exists():
+            return []
+        return [path.basename() for path in commits.children()
+                if path.basename() not in (OBJECTS_DIRECTORY,
+                                           CHUNKS_DIRECTORY)]
+
+    def precopy(self, volume, branch, statistics=None):
+        """
+        Store the data of a branch ahead of a commit, while it may still be
+        written to.
+
+        @return: A value to pass to L{commit} as C{precopied}.
+        """
+        with self._head(volume, branch) as head:
+            _, changed = self._changes(volume, branch, head)
+            return storeTree(self._branchPath(volume, branch),
+                             self._objectStore(volume),
+                             head and head[1]["files"], self._workers,
+                             statistics, self._chunksForCommit(volume),
+                             changed)
+
+    def commit(self, volume, branch, commitId, statistics=None,
+               precopied=None):
+        commitPath = self._commitPath(volume, commitId)
+        # Make the commits directory if necessary
+        if not commitPath.parent().exists():
+            commitPath.parent().makedirs()
+        # files which haven't changed since the branch's last commit, or
+        # since they were precopied, can be linked to their objects without
+        # being read again
+        with self._head(volume, branch) as head:
+            mark, changed = self._changes(volume, branch, head)
+            previous = LayeredManifest(precopied, head and head[1]["files"])
+            files = None
+            if changed is not None:
+                # only the paths the branch's watcher saw change need looking
+                # at; everything else is as it was in the last commit
+                tree = {}
+                try:
+                    files = snapshotTree(self._branchPath(volume, branch),
+                            commitPath, self._objectStore(volume), previous,
+                            self._workers, statistics,
+                            self._chunksForCommit(volume),
+                            (self._commitPath(volume, head[0]),
+                             head[1]["files"]), changed, tree)
+                except BaseMismatch:
+                    commitPath.remove()
+            if files is None:
+                tree = {}
+                files = snapshotTree(self._branchPath(volume, branch),
+                        commitPath, self._objectStore(volume), previous,
+                        self._workers, statistics,
+                        self._chunksForCommit(volume), tree=tree)
+        os.chmod(commitPath.path, 0777)
+        manifest = dict(branch=branch, files=files)
+        if mark is not None:
+            manifest["dirty"] = mark
+        self._commitDatabase.writeManifest(volume, commitId, manifest)
+        self._commitDatabase.writeTree(volume, commitId, tree)
+        writeIndex(self._indexPath(volume, branch), files,
+                   dict(commit=commitId, dirty=mark))
+        recorded(self._branchPath(volume, branch), mark)
+
+    def diff(self, volume, oldCommitId, newCommitId):
+        """
+        Yield the differences between two commits, as for
+        L{treediff.compareTrees}.  Directories whose tree hash is the same
+        in both commits are skipped.
+        """
+        return compareTrees(
+            self._commitPath(volume, oldCommitId).path,
+            self._commitPath(volume, newCommitId).path,
+            oldTree=self._commitDatabase.readTree(volume, oldCommitId),
+            newTree=self._commitDatabase.readTree(volume, newCommitId))
+
+    def status(self, volume, branch):
+        """
+        Yield the differences between a branch's latest commit and its
+        files, as for L{treediff.compareTrees}.
+
+        Files whose stat result is the one recorded when they were committed
+        are unchanged, and only the others are hashed.  When the branch's
+        L{BranchWatcher} is running, only the paths it saw change since the
+        commit are looked at.
+        """
+        branchPath = self._branchPath(volume, branch)
+        try:
+            headId = self._commitDatabase.commitFromHead(
+                volume, branch, 0)["id"]
+        except IndexError:
+            for difference in compareTrees(None, branchPath.path):
+                yield difference
+            return
+        chunks = self._chunkStore(volume)
+        with self._head(volume, branch) as head:
+            changed = None
+            if head is not None:
+                files = head[1]["files"]
+                _, changed = self._changes(volume, branch, head)
+            else:
+                # The branch was made from another branch's commit.
+                files = self._commitDatabase.readManifest(volume, headId)
+                files = files and files["files"]
+
+            def sameFile(relative, oldPath, oldSt, newPath, newSt):
+                entry = files and files.get(relative)
+                if entry is None:
+                    # A commit made before manifests were recorded, of which
+                    # the file is a plain copy.
+                    return hashFile(oldPath, oldSt) == hashFile(newPath, newSt)
+                if statMatches(entry, newSt):
+                    return True
+                if chunks.isRecipe(entry[-1]):
+                    chunkSize = chunks.readRecipe(entry[-1])[0]
+                    return (chunks.hashFile(newPath, newSt, chunkSize)
+                            == entry[-1])
+                return hashFile(newPath, newSt) == entry[-1]
+
+            commitPath = self._commitPath(volume, headId).path
+            tops = [""] if changed is None else sorted(_changedRoots(changed))
+            # the index is only closed once the comparison is finished with
+            for top in tops:
+                for difference in compareTrees(
+                        commitPath, branchPath.path, sameFile, start=top):
+                    yield difference
+
+    def createBranchFromCommit(self, volume, branch, commitId,
+                               statistics=None):
+        manifest = self._commitDatabase.readManifest(volume, commitId)
+        assemble = None
+        if manifest is not None:
+            assemble = self._assembler(volume, manifest["files"])
+        copyTo(self._commitPath(volume, commitId),
+               self._branchPath(volume, branch), self._copier(),
+               self._workers, statistics, assemble)
+
+    def reset(self, volume, branch, commitId, statistics=None):
+        """
+        Make the data of a branch identical to a commit.  When both the
+        commit and the branch's latest commit have stat manifests, only the
+        files which differ from the commit are copied.
+        """
+        branchPath = self._branchPath(volume, branch)
+        commitPath = self._commitPath(volume, commitId)
+        target = self._commitDatabase.readManifest(volume, commitId)
+        with self._head(volume, branch) as head:
+            if head is None or target is None:
+                assemble = None
+                if target is not None:
+                    assemble = self._assembler(volume, target["files"])
+                branchPath.remove()
+                copyTo(commitPath, branchPath, self._copier(), self._workers,
+                       statistics, assemble)
+                return
+            head = head[1]["files"]
+            target = target["files"]
+
+            def unchanged(path, st):
+                entry = head.get(path)
+                return (entry is not None and path in target
+                        and entry[-1] == target[path][-1]
+                        and statMatches(entry, st))
+            restoreTree(commitPath, branchPath, unchanged, self._copier(),
+                        self._workers, statistics,
+                        self._assembler(volume, target, head))
+        os.chmod(branchPath.path, 0777)
+
+    def deleteCommits(self, volume, commitIds):
+        unlinked = []
+        for commitId in commitIds:
+            self._commitPath(volume, commitId).remove()
+            manifest = self._commitDatabase.readManifest(volume, commitId)
+            if manifest is None:
+                unlinked = None
+            elif unlinked is not None:
+                unlinked.extend(entry[-1] for entry
+                                in manifest["files"].itervalues())
+            self._commitDatabase.removeManifest(volume, commitId)
+        self._objectStore(volume).prune(unlinked)
+        self._chunkStore(volume).prune(unlinked)
+
+
+def mountOverlay(lower, upper, work, merged):
+    """
+    Mount an overlay of the writeable directory ``upper`` on the read-only
+    directory ``lower`` at ``merged``.
+    """
+    subprocess.check_call(
+        ["mount", "-t", "overlay", "overlay", "-o",
+         "lowerdir=%s,upperdir=%s,workdir=%s" % (
+             lower.path, upper.path, work.path),
+         merged.path])
+
+
+def unmount(path):
+    subprocess.check_call(["umount", path.path])
+
+
+def isMounted(path):
+    return os.path.ismount(path.path)
+
+
+class OverlayBackend(DirectoryBackend):
+    """
+    Store commits like L{DirectoryBackend}, but make each branch created
+    from a commit an overlay whose read-only lower directory is the commit
+    and whose writeable upper directory holds only what has been written to
+    the branch, so that creating and resetting branches only changes
+    metadata.
+
+    The branch directory is the merged mountpoint, and the upper and work
+    directories of a branch are kept in C{<volume>/overlays/<branch>}, next
+    to a record of which commit is its lower directory.  Branches which have
+    never been based on a commit, like the master branch of a new volume, are
+    plain directories.
+    """
+    name = "overlay"
+
+    def _overlayPath(self, volume, branch):
+        return self._directory.child(volume).child("overlays").child(branch)
+
+    def _lower(self, volume, branch):
+        record = self._overlayPath(volume, branch).siblingExtension(".json")
+        if not record.exists():
+            return None
+        return json.loads(record.getContent())["lower"]
+
+    def _ensureMounted(self, volume, branch):
+        """
+        Mount a branch's overlay if it has one and it isn't mounted, as is the
+        case after a reboot.
+        """
+        branchPath = self._branchPath(volume, branch)
+        lower = self._lower(volume, branch)
+        if lower is None or isMounted(branchPath):
+            return
+        overlay = self._overlayPath(volume, branch)
+        mountOverlay(self._commitPath(volume, lower), overlay.child("upper"),
+                     overlay.child("work"), branchPath)
+        makeWorldWriteable(branchPath)
+
+    def _unmount(self, volume, branch):
+        branchPath = self._branchPath(volume, branch)
+        if isMounted(branchPath):
+            unmount(branchPath)
+
+    def _layer(self, volume, branch, commitId):
+        """
+        Make a branch an empty overlay on a commit, discarding anything
+        written to it before.
+        """
+        branchPath = self._branchPath(volume, branch)
+        overlay = self._overlayPath(volume, branch)
+        self._unmount(volume, branch)
+        for path in (branchPath, overlay):
+            if path.exists():
+                path.remove()
+        for path in (branchPath, overlay.child("upper"), overlay.child("work")):
+            path.makedirs()
+        durable.setContent(overlay.siblingExtension(".json"),
+                           json.dumps(dict(lower=commitId)))
+        self._ensureMounted(volume, branch)
+
+    def deleteVolume(self, volume):
+        for branch in self._directory.child(volume).child(
+                "branches").children():
+            if branch.isdir():
+                self._unmount(volume, branch.basename())
+
+    def deleteBranch(self, volume, branch):
+        self._unmount(volume, branch)
+        DirectoryBackend.deleteBranch(self, volume, branch)
+        overlay = self._overlayPath(volume, branch)
+        for path in (overlay, overlay.siblingExtension(".json")):
+            if path.exists():
+                path.remove()
+
+    def pathForMount(self, volume, branch):
+        self._ensureMounted(volume, branch)
+        return self._branchPath(volume, branch)
+
+    def mountedPath(self, volume, branch):
+        branchPath = self._branchPath(volume, branch)
+        if self._lower(volume, branch) is not None and not isMounted(
+                branchPath):
+            return None
+        return DirectoryBackend.mountedPath(self, volume, branch)
+
+    def precopy(self, volume, branch, statistics=None):
+        self._ensureMounted(volume, branch)
+        return DirectoryBackend.precopy(self, volume, branch, statistics)
+
+    def commit(self, volume, branch, commitId, statistics=None,
+               precopied=None):
+        self._ensureMounted(volume, branch)
+        DirectoryBackend.commit(self, volume, branch, commitId, statistics,
+                                precopied)
+
+    def createBranchFromCommit(self, volume, branch, commitId,
+                               statistics=None):
+        self._layer(volume, branch, commitId)
+
+    def reset(self, volume, branch, commitId, statistics=None):
+        self._layer(volume, branch, commitId)
+
+
+def zfs(*arguments):
+    """
+    Run a 'zfs' command with given arguments, raise on non-0 exit code.
+
+    @return: stdout bytes.
+    """
+    return subprocess.check_output(["zfs"] + list(arguments))
+
+
+class ZFSBackend(object):
+    """
+    Store each branch as a ZFS dataset mounted at the branch directory, and
+    each commit as a snapshot of the dataset of the branch it was made on, so
+    that commits and new branches take constant time.
+
+    Branch datasets are named C{<dataset>/<branch>}.  When a branch is reset
+    to a commit which isn't the latest snapshot of its own dataset, the
+    dataset is renamed out of the way to keep the snapshots which other
+    branches may depend on, and a clone of the commit takes its place.
+    Deleted branches are retired the same way, and retired datasets are
+    destroyed once garbage collection has removed their snapshots.
+
+    @ivar dataset: The name of the dataset holding the volume's datasets.
+    """
+    name = "zfs"
+
+    def __init__(self, directory, dataset):
+        self._directory = directory
+        self.dataset = dataset
+        self._zfs = zfs
+
+    def _branchPath(self, volume, branch):
+        return self._directory.child(volume).child("branches").child(branch)
+
+    def _branchDataset(self, branch):
+        return "%s/%s" % (self.dataset, branch)
+
+    def _snapshots(self, dataset, recursive=False):
+        """
+        Return the names of the snapshots of a dataset, oldest first, and
+        with C{recursive} those of all of its descendants too.
+        """
+        depth = ["-r"] if recursive else ["-d", "1"]
+        return self._zfs(*["list", "-H", "-o", "name", "-t", "snapshot",
+                           "-s", "creation"] + depth + [dataset]).splitlines()
+
+    def _snapshot(self, commitId):
+        for snapshot in self._snapshots(self.dataset, recursive=True):
+            if snapshot.split("@", 1)[1] == commitId:
+                return snapshot
+        return None
+
+    def createVolume(self, volume):
+        self._zfs("create", "-p", "-o", "canmount=off", self.dataset)
+
+    def deleteVolume(self, volume):
+        # -R also destroys the clones of snapshots of retired datasets
+        self._zfs("destroy", "-R", self.dataset)
+
+    def createBranch(self, volume, branch):
+        branchPath = self._branchPath(volume, branch)
+        self._zfs("create", "-o", "mountpoint=%s" % (branchPath.path,),
+                  self._branchDataset(branch))
+        makeWorldWriteable(branchPath)
+
+    def deleteBranch(self, volume, branch):
+        # other branches may have been cloned from the branch's snapshots
+        self._retire(self._branchDataset(branch))
+
+    def _retire(self, dataset):
+        """
+        Unmount a branch's dataset and rename it out of the way, keeping its
+        snapshots until they are no longer needed.
+        """
+        self._zfs("set", "mountpoint=none", dataset)
+        self._zfs("rename", dataset,
+                  "%s/.retired-%s" % (self.dataset, uuid.uuid4().hex))
+
+    def pathForMount(self, volume, branch):
+        return self._branchPath(volume, branch)
+
+    def mountedPath(self, volume, branch):
+        # The dataset is mounted for as long as it exists.
+        branchPath = self._branchPath(volume, branch)
+        if not branchPath.isdir():
+            return None
+        return branchPath
+
+    def commitExists(self, volume, commitId):
+        return self._snapshot(commitId) is not None
+
+    def listCommits(self, volume):
+        return [snapshot.split("@", 1)[1] for snapshot
+                in self._snapshots(self.dataset, recursive=True)]
+
+    def precopy(self, volume, branch, statistics=None):
+        # Snapshots take constant time, so there is nothing to do ahead.
+        return None
+
+    def commit(self, volume, branch, commitId, statistics=None,
+               precopied=None):
+        self._zfs("snapshot", "%s@%s" % (self._branchDataset(branch),
+                                         commitId))
+
+    def createBranchFromCommit(self, volume, branch, commitId,
+                               statistics=None):
+        self._zfs("clone", "-o", "mountpoint=%s" % (
+            self._branchPath(volume, branch).path,),
+            self._snapshot(commitId), self._branchDataset(branch))
+
+    def reset(self, volume, branch, commitId, statistics=None):
+        snapshot = self._snapshot(commitId)
+        dataset = self._branchDataset(branch)
+        snapshots = self._snapshots(dataset)
+        if snapshots and snapshots[-1] == snapshot:
+            self._zfs("rollback", snapshot)
+            return
+        self._retire(dataset)
+        # renaming the dataset renames its snapshots, which may include the
+        # one being reset to
+        self._zfs("clone", "-o", "mountpoint=%s" % (
+            self._branchPath(volume, branch).path,),
+            self._snapshot(commitId), dataset)
+
+    def deleteCommits(self, volume, commitIds):
+        snapshots = set(filter(None, map(self._snapshot, commitIds)))
+        # A snapshot can't be destroyed while a clone depends on it, and
+        # retired datasets are only kept for their snapshots, so destroying
+        # either may free the other; repeat until neither can go.
+        while True:
+            origins = {}
+            for line in self._zfs("list", "-H", "-o", "name,origin", "-t",
+                                  "filesystem", "-d", "1",
+                                  self.dataset).splitlines():
+                dataset, origin = line.split("\t")
+                origins[dataset] = origin
+            destroyed = False
+            for snapshot in sorted(snapshots - set(origins.values())):
+                self._zfs("destroy", snapshot)
+                snapshots.remove(snapshot)
+                destroyed = True
+            for dataset in sorted(origins):
+                if dataset.rsplit("/", 1)[-1].startswith(".retired-") and (
+                        not self._snapshots(dataset)):
+                    self._zfs("destroy", dataset)
+                    destroyed = True
+            if not destroyed:
+                break
+
+
+def backendForVolume(directory, volume, commitDatabase, copier,
+                     workers=None):
+    """
+    Return the backend recorded for a volume.
+
+    @type directory: L{FilePath}
+    """
+    record = directory.child(volume).child(STORAGE_FILENAME)
+    if not record.exists():
+        return DirectoryBackend(directory, commitDatabase, copier, workers)
+    config = json.loads(record.getContent())
+    if config["backend"] == ZFSBackend.name:
+        return ZFSBackend(directory, config["dataset"])
+    if config["backend"] == OverlayBackend.name:
+        return OverlayBackend(directory, commitDatabase, copier, workers)
+    return DirectoryBackend(directory, commitDatabase, copier, workers,
+                            config.get("chunked", False),
+                            config.get("compressed", False))
+
+
+def recordBackend(directory, volume, backend):
+    config = dict(backend=backend.name)
+    if backend.name == ZFSBackend.name:
+        config["dataset"] = backend.dataset
+    if getattr(backend, "chunked", False):
+        config["chunked"] = True
+    if getattr(backend, "compressed", False):
+        config["compressed"] = True
+    durable.setContent(directory.child(volume).child(STORAGE_FILENAME),
+                       json.dumps(config))
@@ -8,19 +8,52 @@ from hypothesis import given
 from hypothesis.strategies import binary, characters, dictionaries, sets, text
 
 from twisted.trial.unittest import TestCase
+from twisted.internet import defer
+from twisted.python import log
 from twisted.python.filepath import FilePath
 from twisted.python.usage import UsageError
+from twisted.web import server
+from twisted.web.test.requesthelper import DummyRequest
+from StringIO import StringIO
 import subprocess
+import sys
 import os
 import json
-
+import fcntl
+import stat
+import threading
+import time
+
+import branchindex
+import chunks
+import commitdb
+import compression
+import copiers
+import dirtypaths
+import durable
+import locks
+import metadatacache
+import objectstore
+import plugin
+import storage
+import treediff
 from testtools import (
-    CalledProcessErrorWithOutput, TEST_GOLANG_VERSION, skip_if_python_version
+    CalledProcessErrorWithOutput, FakeOverlayMounts, FakeZFS,
+    TEST_GOLANG_VERSION,
+    skip_if_go_version, skip_if_python_version
 )
 
 DVOL_BINARY = os.environ.get("DVOL_BINARY", "./dvol")
 ARGS = ["--disable-docker-integration"]
 
+# The directory holding this package, worked out before trial changes into
+# its temporary directory.
+SOURCE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules which are slow to import and not needed by every command.
+HEAVY_MODULES = ["docker", "yaml", "twisted.internet.reactor",
+                 "twisted.internet.task"]
+
 if TEST_GOLANG_VERSION:
     # Test an alternative implementation of dvol, such as one available as a
     # binary rather than an importable Python implementation.
@@ -62,7 +95,7 @@ if TEST_GOLANG_VERSION:
             self.voluminous.report_output(result)
 
 else:
-    from dvol import VoluminousOptions
+    from dvol import NoSuchCommit, VoluminousOptions
 
 
 def items(d):
@@ -245,6 +278,564 @@ class VoluminousTests(TestCase):
         self.assertTrue(commit.child("file.txt").exists())
         self.assertEqual(commit.child("file.txt").getContent(), "hello!")
 
+    @skip_if_go_version
+    def test_commit_shares_unchanged_files(self):
+        """
+        Files which have not changed since a previous commit are stored once
+        and shared between the commits, rather than copied again.
+        """
+        dvol = VoluminousOptions()
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path, "init", "foo"])
+        volume = self.tmpdir.child("foo")
+        master = volume.child("branches").child("master")
+        master.child("same.txt").setContent("unchanged")
+        master.child("different.txt").setContent("before")
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "commit", "-m", "commit 1"])
+        firstCommit = volume.child("commits").child(
+            dvol.voluminous.getOutput()[-1])
+        master.child("different.txt").setContent("after!")
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "commit", "-m", "commit 2"])
+        secondCommit = volume.child("commits").child(
+            dvol.voluminous.getOutput()[-1])
+        self.assertEqual(
+            os.stat(firstCommit.child("same.txt").path).st_ino,
+            os.stat(secondCommit.child("same.txt").path).st_ino)
+        self.assertNotEqual(
+            os.stat(firstCommit.child("different.txt").path).st_ino,
+            os.stat(secondCommit.child("different.txt").path).st_ino)
+        self.assertEqual(
+            firstCommit.child("different.txt").getContent(), "before")
+        self.assertEqual(
+            secondCommit.child("different.txt").getContent(), "after!")
+
+    def test_reset_does_not_link_to_commit(self):
+        """
+        After a reset, writing to the branch does not modify the commit it was
+        reset to, even when the commit holds several identical files.
+        """
+        dvol = VoluminousOptions()
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path, "init", "foo"])
+        volume = self.tmpdir.child("foo")
+        master = volume.child("branches").child("master")
+        master.child("a.txt").setContent("same")
+        master.child("b.txt").setContent("same")
+        os.utime(master.child("b.txt").path,
+                 (0, os.stat(master.child("a.txt").path).st_mtime))
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "commit", "-m", "commit 1"])
+        commit = volume.child("commits").child(dvol.voluminous.getOutput()[-1])
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "reset", "--hard", "HEAD"])
+        master.child("a.txt").setContent("changed")
+        self.assertEqual(master.child("b.txt").getContent(), "same")
+        self.assertEqual(commit.child("a.txt").getContent(), "same")
+        self.assertEqual(commit.child("b.txt").getContent(), "same")
+
+    @skip_if_go_version
+    def test_commit_skips_files_unchanged_since_last_commit(self):
+        """
+        Only the files whose stat result changed since the last commit on the
+        branch are read again when committing.
+        """
+        dvol = VoluminousOptions()
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path, "init", "foo"])
+        master = self.tmpdir.child("foo").child("branches").child("master")
+        master.child("same.txt").setContent("unchanged")
+        master.child("different.txt").setContent("before")
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "commit", "-m", "commit 1"])
+        master.child("different.txt").setContent("after!")
+        hashed = []
+        hashFile = objectstore.hashFile
+        def recordingHashFile(path, st):
+            hashed.append(os.path.basename(path))
+            return hashFile(path, st)
+        self.patch(objectstore, "hashFile", recordingHashFile)
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "commit", "-m", "commit 2"])
+        self.assertEqual(hashed, ["different.txt"])
+
+    @skip_if_go_version
+    def test_reset_copies_only_changed_files(self):
+        """
+        Resetting a branch rewrites the files which differ from the commit and
+        removes the ones it doesn't have, leaving unchanged files in place.
+        """
+        dvol = VoluminousOptions()
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path, "init", "foo"])
+        master = self.tmpdir.child("foo").child("branches").child("master")
+        master.child("same.txt").setContent("unchanged")
+        master.child("different.txt").setContent("before")
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "commit", "-m", "commit 1"])
+        sameInode = os.stat(master.child("same.txt").path).st_ino
+        master.child("different.txt").setContent("after!")
+        master.child("new.txt").setContent("new")
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "reset", "--hard", "HEAD"])
+        self.assertEqual(
+            os.stat(master.child("same.txt").path).st_ino, sameInode)
+        self.assertEqual(master.child("different.txt").getContent(), "before")
+        self.assertFalse(master.child("new.txt").exists())
+
+    @skip_if_go_version
+    def test_reset_prunes_unreferenced_objects(self):
+        """
+        Destroying a commit removes the stored objects which no remaining
+        commit refers to.
+        """
+        dvol = VoluminousOptions()
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path, "init", "foo"])
+        volume = self.tmpdir.child("foo")
+        master = volume.child("branches").child("master")
+        master.child("file.txt").setContent("OLD")
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "commit", "-m", "commit 1"])
+        master.child("file.txt").setContent("NEW")
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "commit", "-m", "commit 2"])
+        objects = volume.child("commits").child(".objects")
+        self.assertEqual(
+            len([p for p in objects.walk() if p.isfile()]), 2)
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "reset", "--hard", "HEAD^"])
+        self.assertEqual(
+            len([p for p in objects.walk() if p.isfile()]), 1)
+
+    @skip_if_go_version
+    def test_info_shows_detected_copy_backend(self):
+        """
+        ``dvol info`` shows which copy backend was detected for the pool, and
+        the detection is recorded in the pool.
+        """
+        dvol = VoluminousOptions()
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path, "info"])
+        recorded = json.loads(
+            self.tmpdir.child("copy_backend.json").getContent())
+        self.assertIn(recorded["copy_backend"], ["copy", "reflink"])
+        self.assertIn(["Copy", "backend:", recorded["copy_backend"]],
+            [line.split() for line in
+             dvol.voluminous.getOutput()[-1].split("\n")])
+
+    @skip_if_go_version
+    def test_copy_backend_detected_once(self):
+        """
+        A copy backend which has already been recorded for the pool is used
+        without detecting it again.
+        """
+        self.tmpdir.child("copy_backend.json").setContent(
+            json.dumps(dict(copy_backend="reflink")))
+        dvol = VoluminousOptions()
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path, "info"])
+        self.assertIn(["Copy", "backend:", "reflink"],
+            [line.split() for line in
+             dvol.voluminous.getOutput()[-1].split("\n")])
+
+    @skip_if_go_version
+    def test_commits_recorded_in_log(self):
+        """
+        Committing appends a line to the branch's commit log rather than
+        rewriting a JSON list of every commit.
+        """
+        dvol = VoluminousOptions()
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path, "init", "foo"])
+        for message in ["commit 1", "commit 2"]:
+            dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+                "commit", "-m", message])
+        branches = self.tmpdir.child("foo").child("branches")
+        self.assertFalse(branches.child("master.json").exists())
+        lines = branches.child("master.log").getContent().splitlines()
+        self.assertEqual([json.loads(line)["message"] for line in lines],
+                         ["commit 1", "commit 2"])
+
+    @skip_if_go_version
+    def test_legacy_commit_list_migrated(self):
+        """
+        A branch whose commits were recorded as a JSON list is converted to a
+        log by the next commit, keeping its history.
+        """
+        dvol = VoluminousOptions()
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path, "init", "foo"])
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "commit", "-m", "commit 1"])
+        branches = self.tmpdir.child("foo").child("branches")
+        commits = [json.loads(line) for line in
+                   branches.child("master.log").getContent().splitlines()]
+        branches.child("master.json").setContent(json.dumps(commits))
+        branches.child("master.log").remove()
+        branches.child("master.idx").remove()
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "commit", "-m", "commit 2"])
+        self.assertFalse(branches.child("master.json").exists())
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path, "log"])
+        output = dvol.voluminous.getOutput()[-1]
+        self.assertIn("commit 1", output)
+        self.assertIn("commit 2", output)
+
+    @skip_if_go_version
+    def test_interrupted_log_append_ignored(self):
+        """
+        A partial line left at the end of the commit log by an interrupted
+        commit is not treated as a commit.
+        """
+        dvol = VoluminousOptions()
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path, "init", "foo"])
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "commit", "-m", "commit 1"])
+        log = self.tmpdir.child("foo").child("branches").child("master.log")
+        with log.open("a") as f:
+            f.write('{"id": "abc')
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path, "log"])
+        self.assertIn("commit 1", dvol.voluminous.getOutput()[-1])
+
+    @skip_if_go_version
+    def test_reset_through_log_index(self):
+        """
+        Commits older than HEAD are found through the commit log's index, and
+        resetting to one truncates both the log and its index.
+        """
+        self.patch(commitdb, "INDEX_INTERVAL", 0)
+        dvol = VoluminousOptions()
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path, "init", "foo"])
+        for message in ["commit 1", "commit 2", "commit 3"]:
+            dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+                "commit", "-m", message])
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "reset", "--hard", "HEAD^^"])
+        branches = self.tmpdir.child("foo").child("branches")
+        self.assertEqual(
+            len(branches.child("master.log").getContent().splitlines()), 1)
+        self.assertEqual(branches.child("master.idx").getsize(), 8)
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path, "log"])
+        output = dvol.voluminous.getOutput()[-1]
+        self.assertIn("    commit 1\n", output)
+        self.assertNotIn("    commit 2\n", output)
+
+    @skip_if_go_version
+    def test_migrate_to_sqlite(self):
+        """
+        ``dvol migrate`` moves the commits of every branch into a SQLite
+        database which later commands use instead of the commit files.
+        """
+        dvol = VoluminousOptions()
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path, "init", "foo"])
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "commit", "-m", "commit 1"])
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "checkout", "-b", "alpha"])
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path, "migrate"])
+        self.assertEqual(dvol.voluminous.getOutput()[-1],
+                         "Migrated 2 branches to a SQLite database")
+        branches = self.tmpdir.child("foo").child("branches")
+        self.assertEqual(
+            [p for p in branches.children() if not p.isdir()], [])
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "commit", "-m", "commit 2"])
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path, "log"])
+        output = dvol.voluminous.getOutput()[-1]
+        self.assertIn("commit 1", output)
+        self.assertIn("commit 2", output)
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path, "info"])
+        self.assertIn("sqlite", dvol.voluminous.getOutput()[-1])
+
+    @skip_if_go_version
+    def test_sqlite_keeps_creation_times(self):
+        """
+        The SQLite database records the time each commit was made, carried
+        over from the commit files by a migration and kept when a branch is
+        rewritten.
+        """
+        dvol = VoluminousOptions()
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path, "init", "foo"])
+        self.patch(time, "time", lambda: 1000.5)
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "commit", "-m", "commit 1"])
+        self.patch(time, "time", lambda: 2000.5)
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path, "migrate"])
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "commit", "-m", "commit 2"])
+        self.patch(time, "time", lambda: 3000.5)
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "checkout", "-b", "alpha"])
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "reset", "--hard", "HEAD^"])
+        database = commitdb.SQLiteCommitDatabase(self.tmpdir)
+        self.assertEqual(
+            database._execute(
+                "SELECT branch, created FROM commits ORDER BY branch, "
+                "position"),
+            [("alpha", 1000.5), ("master", 1000.5), ("master", 2000.5)])
+
+    @skip_if_go_version
+    def test_migrate_locks_volumes(self):
+        """
+        ``dvol migrate`` waits for commands changing any volume to finish,
+        and a command which was waiting for it records its commit in the
+        database rather than in the files it replaced.
+        """
+        from dvol import NullLock, Voluminous
+        dvol = VoluminousOptions()
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path, "init", "foo"])
+        waiting = Voluminous(self.tmpdir.path, lockFactory=NullLock)
+        migrating = Voluminous(self.tmpdir.path, lockFactory=NullLock,
+                               lockTimeout=0)
+        with waiting.locks.exclusive("foo"):
+            self.assertRaises(locks.LockTimeout,
+                              migrating.migrateCommitDatabase)
+        migrating.migrateCommitDatabase()
+        waiting.commitVolume("after migrating")
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path, "log"])
+        self.assertIn("after migrating", dvol.voluminous.getOutput()[-1])
+        self.assertEqual(
+            [p for p in self.tmpdir.descendant(["foo", "branches"]).children()
+             if not p.isdir()], [])
+
+    @skip_if_go_version
+    def test_migrate_interrupted(self):
+        """
+        A migration which fails before the database is complete leaves the
+        pool using its commit files, and can be run again.
+        """
+        dvol = VoluminousOptions()
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path, "init", "foo"])
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "commit", "-m", "commit 1"])
+
+        def crash(source, destination):
+            raise OSError("crashed")
+        restore = self.patch(commitdb.os, "rename", crash)
+        self.assertRaises(OSError, dvol.parseOptions,
+                          ARGS + ["-p", self.tmpdir.path, "migrate"])
+        self.assertIsInstance(commitdb.commitDatabaseForPool(self.tmpdir),
+                              commitdb.LogCommitDatabase)
+        restore.restore()
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path, "migrate"])
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path, "log"])
+        self.assertIn("commit 1", dvol.voluminous.getOutput()[-1])
+
+    @skip_if_go_version
+    def test_sqlite_branches_referencing_commit(self):
+        """
+        The SQLite database finds the branches whose history includes a
+        commit, and forgets the commits of deleted volumes.
+        """
+        database = commitdb.SQLiteCommitDatabase(self.tmpdir)
+        database.write("foo", "master", [dict(id="a", message="1")])
+        database.append("foo", "master", dict(id="b", message="2"))
+        database.write("foo", "alpha", [dict(id="a", message="1")])
+        database.write("bar", "master", [dict(id="a", message="1")])
+        self.assertEqual(database.branchesReferencing("foo", "a"),
+                         ["alpha", "master"])
+        self.assertEqual(database.branchesReferencing("foo", "b"),
+                         ["master"])
+        self.assertEqual(database.commitFromHead("foo", "master", 1)["id"],
+                         "a")
+        self.assertEqual(database.discard("foo", "master", 1),
+                         [dict(id="b", message="2")])
+        self.assertEqual(database.read("foo", "master"),
+                         [dict(id="a", message="1")])
+        self.assertEqual(database.referenceCount("foo", "b"), 0)
+        database.deleteVolume("foo")
+        self.assertEqual(database.read("foo", "alpha"), [])
+        self.assertEqual(database.branchesReferencing("bar", "a"),
+                         ["master"])
+
+    @skip_if_go_version
+    def test_copy_tree_like_cp(self):
+        """
+        The threaded tree copier preserves modes, times, symlinks and FIFOs
+        like ``cp -a`` and counts what it copied.
+        """
+        source = self.tmpdir.child("source")
+        source.child("dir").makedirs()
+        for i in range(20):
+            source.child("dir").child("file%d" % (i,)).setContent("x" * i)
+        source.child("dir").child("file3").chmod(0640)
+        os.utime(source.child("dir").child("file3").path, (1000, 2000))
+        os.symlink("dir/file3", source.child("link").path)
+        os.mkfifo(source.child("fifo").path)
+        os.utime(source.child("dir").path, (3000, 4000))
+        statistics = copiers.CopyStatistics()
+        destination = self.tmpdir.child("destination")
+        objectstore.copyTree(source, destination, workers=4,
+                             statistics=statistics)
+        copied = destination.child("dir").child("file3")
+        self.assertEqual(
+            (copied.getContent(), copied.getPermissions().shorthand(),
+             os.stat(copied.path).st_mtime),
+            ("xxx", "rw-r-----", 2000))
+        self.assertEqual(os.stat(destination.child("dir").path).st_mtime,
+                         4000)
+        self.assertEqual(os.readlink(destination.child("link").path),
+                         "dir/file3")
+        self.assertTrue(stat.S_ISFIFO(
+            os.lstat(destination.child("fifo").path).st_mode))
+        self.assertEqual((statistics.files, statistics.bytes),
+                         (20, sum(range(20))))
+
+    def test_init_creates_pool(self):
+        """
+        A pool directory which doesn't exist yet is created by the first
+        command which uses it.
+        """
+        pool = self.tmpdir.descendant(["new", "pool"])
+        dvol = VoluminousOptions()
+        dvol.parseOptions(ARGS + ["-p", pool.path, "init", "foo"])
+        self.assertTrue(pool.descendant(["foo", "branches", "master"]).isdir())
+
+    @skip_if_go_version
+    def test_workers_option(self):
+        """
+        ``--workers`` sets the number of threads used by the volume's storage
+        backend, and commits and resets made with several threads keep the
+        data intact.
+        """
+        dvol = VoluminousOptions()
+        args = ARGS + ["-p", self.tmpdir.path, "--workers", "3"]
+        dvol.parseOptions(args + ["init", "foo"])
+        self.assertEqual(dvol.voluminous.backend("foo")._workers, 3)
+        master = self.tmpdir.child("foo").child("branches").child("master")
+        for i in range(10):
+            master.child("file%d" % (i,)).setContent("OLD %d" % (i,))
+        dvol.parseOptions(args + ["commit", "-m", "commit 1"])
+        for i in range(10):
+            master.child("file%d" % (i,)).setContent("NEW %d" % (i,))
+        dvol.parseOptions(args + ["reset", "--hard", "HEAD"])
+        self.assertEqual(
+            [master.child("file%d" % (i,)).getContent() for i in range(10)],
+            ["OLD %d" % (i,) for i in range(10)])
+
+    @skip_if_go_version
+    def test_json_progress(self):
+        """
+        ``--progress=json`` reports the progress of a commit as JSON lines,
+        ending with an event for its completion.
+        """
+        self.patch(copiers, "PROGRESS_INTERVAL", 0)
+        dvol = VoluminousOptions()
+        args = ARGS + ["-p", self.tmpdir.path, "--progress=json"]
+        dvol.parseOptions(args + ["init", "foo"])
+        master = self.tmpdir.child("foo").child("branches").child("master")
+        for i in range(3):
+            master.child("file%d" % (i,)).setContent("x" * 10)
+        dvol.voluminous.getOutput()
+        dvol.parseOptions(args + ["commit", "-m", "commit 1"])
+        events = [json.loads(line) for line
+                  in dvol.voluminous.getOutput()[-1].split("\n")[1:]]
+        downtime = [e for e in events if e["event"] == "downtime"]
+        self.assertEqual(len(downtime), 1)
+        self.assertTrue(downtime[0]["stopping"] <= downtime[0]["started"])
+        events = [e for e in events if e["event"] != "downtime"]
+        self.assertEqual(
+            [(e["event"], e["operation"], e["files"]) for e in events],
+            [("progress", "commit", 1), ("progress", "commit", 2),
+             ("progress", "commit", 3), ("finished", "commit", 3)])
+        self.assertEqual((events[-1]["total_files"], events[-1]["bytes"],
+                          events[-1]["total_bytes"]), (3, 30, 30))
+
+    @skip_if_go_version
+    def test_human_progress(self):
+        """
+        ``--progress=human`` reports files and bytes done, the rate and an
+        estimate of the time left.
+        """
+        self.patch(copiers, "PROGRESS_INTERVAL", 0)
+        dvol = VoluminousOptions()
+        args = ARGS + ["-p", self.tmpdir.path, "--progress=human"]
+        dvol.parseOptions(args + ["init", "foo"])
+        master = self.tmpdir.child("foo").child("branches").child("master")
+        master.child("file").setContent("x" * 10)
+        dvol.voluminous.getOutput()
+        dvol.parseOptions(args + ["commit", "-m", "commit 1"])
+        lines = dvol.voluminous.getOutput()[-1].split("\n")
+        self.assertTrue(lines[1].startswith("commit: 1/1 files, 10 B of 10 B, "))
+        self.assertIn("ETA", lines[1])
+        self.assertTrue(lines[2].startswith("commit: done, 1 files, 10 B in "))
+
+    @skip_if_go_version
+    def test_invalid_progress(self):
+        dvol = VoluminousOptions()
+        self.assertRaises(UsageError, dvol.parseOptions,
+            ARGS + ["-p", self.tmpdir.path, "--progress=loud", "list"])
+
+    @skip_if_go_version
+    def test_pre_copy_commit(self):
+        """
+        ``dvol commit --pre-copy`` stores the branch's files before stopping
+        its containers, and only reads the files written in the meantime
+        while they are stopped, reporting when they were stopped and started.
+        """
+        from dvol import NullLock, Voluminous
+        master = self.tmpdir.child("foo").child("branches").child("master")
+        hashed = []
+
+        class WritingLock(NullLock):
+            def acquire(self, volume):
+                # A container writes to the volume before it is stopped.
+                hashed[:] = []
+                master.child("changed").setContent("NEW")
+
+        voluminous = Voluminous(self.tmpdir.path, lockFactory=WritingLock)
+        voluminous.createVolume("foo")
+        master.child("changed").setContent("OLD")
+        master.child("unchanged").setContent("SAME")
+        # files changed in the same tick of the filesystem's clock as the
+        # precopy starts are hashed again
+        ctime = os.lstat(master.child("unchanged").path).st_ctime
+        while objectstore._fileSystemTime(master) <= ctime:
+            time.sleep(0.001)
+        hashFile = objectstore.hashFile
+
+        def recordingHashFile(path, st):
+            hashed.append(os.path.basename(path))
+            return hashFile(path, st)
+        self.patch(objectstore, "hashFile", recordingHashFile)
+        voluminous.getOutput()
+        voluminous.commitVolume("commit 1", precopy=True)
+        commitId, downtime = voluminous.getOutput()[-1].split("\n")
+        self.assertEqual(hashed, ["changed"])
+        commit = self.tmpdir.child("foo").child("commits").child(commitId)
+        self.assertEqual(
+            (commit.child("changed").getContent(),
+             commit.child("unchanged").getContent()), ("NEW", "SAME"))
+        self.assertTrue(downtime.startswith("Containers stopped at "))
+
+    @skip_if_go_version
+    def test_pre_copy_racy_file(self):
+        """
+        A file rewritten after it was precopied, so quickly that its size and
+        times are the same as when it was precopied, is committed as it was
+        rewritten.
+        """
+        class CoarseStat(object):
+            # The stat result of a file on a filesystem which records times
+            # to the nearest million seconds.
+            def __init__(self, st):
+                self._st = st
+
+            def __getattr__(self, name):
+                value = getattr(self._st, name)
+                if name in ("st_mtime", "st_ctime"):
+                    value -= value % 1000000
+                return value
+        lstat = os.lstat
+        self.patch(os, "lstat", lambda path: CoarseStat(lstat(path)))
+        from dvol import Voluminous
+        voluminous = Voluminous(self.tmpdir.path)
+        voluminous.createVolume("foo")
+        racy = self.tmpdir.descendant(["foo", "branches", "master", "racy"])
+        racy.setContent("before")
+        backend = voluminous.backend("foo")
+        precopied = backend.precopy("foo", "master")
+        # rewritten in place, so that its inode stays the same too
+        with racy.open("r+") as f:
+            f.write("after!")
+        backend.commit("foo", "master", "a" * 40, precopied=precopied)
+        self.assertEqual(self.tmpdir.descendant(
+            ["foo", "commits", "a" * 40, "racy"]).getContent(), "after!")
+
     def test_list_empty_volumes(self):
         dvol = VoluminousOptions()
         dvol.parseOptions(ARGS + ["-p", self.tmpdir.path, "list"])
@@ -579,6 +1170,133 @@ class VoluminousTests(TestCase):
         self.assertTrue(volume.child("commits").child(oldCommit).exists())
         self.assertTrue(volume.child("commits").child(newCommit).exists())
 
+    @skip_if_go_version
+    def test_rollback_branch_deletes_commits_unreferenced_by_other_branches(self):
+        """
+        Resetting a branch destroys the discarded commits which no other
+        branch refers to, even when the volume has other branches.
+        """
+        dvol = VoluminousOptions()
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path, "init", "foo"])
+        commits = self.tmpdir.child("foo").child("commits")
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "commit", "-m", "commit 1"])
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "commit", "-m", "commit 2"])
+        sharedCommit = dvol.voluminous.getOutput()[-1]
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "checkout", "-b", "newbranch"])
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "checkout", "master"])
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "commit", "-m", "commit 3"])
+        masterCommit = dvol.voluminous.getOutput()[-1]
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "reset", "--hard", "HEAD^^"])
+        self.assertTrue(commits.child(sharedCommit).exists())
+        self.assertFalse(commits.child(masterCommit).exists())
+
+    @skip_if_go_version
+    def test_reference_counts_maintained(self):
+        """
+        The number of branches referring to each commit is kept as commits
+        are made, branched and discarded.
+        """
+        dvol = VoluminousOptions()
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path, "init", "foo"])
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "commit", "-m", "commit 1"])
+        first = dvol.voluminous.getOutput()[-1]
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "checkout", "-b", "newbranch"])
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "commit", "-m", "commit 2"])
+        second = dvol.voluminous.getOutput()[-1]
+        database = dvol.voluminous.commitDatabase
+        self.assertEqual(
+            (database.referenceCount("foo", first),
+             database.referenceCount("foo", second)), (2, 1))
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "reset", "--hard", "HEAD^"])
+        self.assertEqual(
+            (database.referenceCount("foo", first),
+             database.referenceCount("foo", second)), (2, 0))
+
+    @skip_if_go_version
+    def test_reference_counts_written_once(self):
+        """
+        Branching from a history of several commits updates all of their
+        reference counts with a single durable write.
+        """
+        dvol = VoluminousOptions()
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path, "init", "foo"])
+        for message in ("commit 1", "commit 2", "commit 3"):
+            dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+                "commit", "-m", message])
+        written = []
+        setContent = durable.setContent
+        def recordingSetContent(path, content):
+            written.append(path.basename())
+            setContent(path, content)
+        self.patch(durable, "setContent", recordingSetContent)
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "checkout", "-b", "newbranch"])
+        self.assertEqual(written.count("references.json"), 1)
+
+    @skip_if_go_version
+    def test_reference_counts_rebuilt_durably(self):
+        """
+        Reference counts missing from a volume, such as one whose counts were
+        kept in a file per commit, are recounted from the branches and
+        written durably.
+        """
+        dvol = VoluminousOptions()
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path, "init", "foo"])
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "commit", "-m", "commit 1"])
+        commitId = dvol.voluminous.getOutput()[-1]
+        volume = self.tmpdir.child("foo")
+        volume.child("references.json").remove()
+        volume.child("references").makedirs()
+        written = []
+        setContent = durable.setContent
+        def recordingSetContent(path, content):
+            written.append(path.basename())
+            setContent(path, content)
+        self.patch(durable, "setContent", recordingSetContent)
+        database = dvol.voluminous.commitDatabase
+        self.assertEqual(database.referenceCount("foo", commitId), 1)
+        self.assertEqual(written, ["references.json"])
+        self.assertFalse(volume.child("references").exists())
+
+    @skip_if_go_version
+    def test_gc_removes_commits_of_deleted_branch(self):
+        """
+        ``dvol gc`` removes the commits which were only part of branches that
+        have since been deleted.
+        """
+        dvol = VoluminousOptions()
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path, "init", "foo"])
+        commits = self.tmpdir.child("foo").child("commits")
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "commit", "-m", "commit 1"])
+        sharedCommit = dvol.voluminous.getOutput()[-1]
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "checkout", "-b", "newbranch"])
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "commit", "-m", "commit 2"])
+        branchCommit = dvol.voluminous.getOutput()[-1]
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "checkout", "master"])
+        self.patch(dvol.voluminous, "_userIsSure", lambda: True)
+        dvol.voluminous.deleteBranch("newbranch")
+        self.assertTrue(commits.child(branchCommit).exists())
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path, "gc"])
+        self.assertEqual(dvol.voluminous.getOutput()[-1],
+                         "Removed 1 unreferenced commits from foo")
+        self.assertTrue(commits.child(sharedCommit).exists())
+        self.assertFalse(commits.child(branchCommit).exists())
+
     def test_remove_volume(self):
         dvol = VoluminousOptions()
         dvol.parseOptions(ARGS + ["-p", self.tmpdir.path, "init", "foo"])
@@ -621,3 +1339,1550 @@ class VoluminousTests(TestCase):
         dvol.parseOptions(ARGS + ["-p", self.tmpdir.path, "config", "user.name"])
         self.assertEqual(dvol.voluminous.getOutput()[-1],
             "alice")
+
+
+class FakeDockerClient(object):
+    """
+    Enough of a docker client for L{Containers}, whose containers all use
+    one dvol volume and which records how many are stopped or started at
+    once.
+    """
+    def __init__(self, volume, count, unrelated=0, listMounts=False):
+        self._lock = threading.Lock()
+        self._containers = dict(
+            ("c%d" % (i,), dict(
+                Id="c%d" % (i,), Name="/c%d" % (i,),
+                State=dict(Running=True),
+                Config=dict(VolumeDriver="dvol"), HostConfig=dict(),
+                Mounts=[dict(Driver="dvol",
+                             Source="/var/lib/dvol/volumes/%s/running_point"
+                             % (volume,))]))
+            for i in range(count))
+        self._containers.update(
+            ("u%d" % (i,), dict(
+                Id="u%d" % (i,), Name="/u%d" % (i,),
+                State=dict(Running=True), Config=dict(), HostConfig=dict(),
+                Mounts=[dict(Driver="local", Source="/var/lib/docker/x")]))
+            for i in range(unrelated))
+        self._listMounts = listMounts
+        self.inspected = []
+        self.inFlight = 0
+        self.maximumInFlight = 0
+        self.started = []
+
+    def containers(self, all=False):
+        result = []
+        for cid, container in sorted(self._containers.items()):
+            summary = dict(Id=cid)
+            if self._listMounts:
+                summary["Mounts"] = container["Mounts"]
+            result.append(summary)
+        return result
+
+    def inspect_container(self, cid):
+        self.inspected.append(cid)
+        return self._containers[cid]
+
+    def _call(self):
+        with self._lock:
+            self.inFlight += 1
+            self.maximumInFlight = max(self.maximumInFlight, self.inFlight)
+        time.sleep(0.05)
+        with self._lock:
+            self.inFlight -= 1
+
+    def stop(self, cid):
+        self._call()
+
+    def start(self, cid):
+        self._call()
+        with self._lock:
+            self.started.append(cid)
+
+
+class ContainersTests(TestCase):
+    def setUp(self):
+        self.index = FilePath(self.mktemp())
+
+    @skip_if_go_version
+    def test_stop_and_start_concurrently(self):
+        """
+        Containers using a volume are stopped and started several at a time,
+        up to the concurrency limit, and the time taken for each is
+        recorded.
+        """
+        from dockercontainers import Containers
+        containers = Containers("dvol", concurrency=3,
+                                index_path=self.index)
+        client = containers.client = FakeDockerClient("foo", 6)
+        containers.stop("foo")
+        self.assertEqual(client.maximumInFlight, 3)
+        containers.start("foo")
+        self.assertEqual(sorted(client.started),
+                         ["c%d" % (i,) for i in range(6)])
+        self.assertEqual(client.maximumInFlight, 3)
+        timing = containers.timings["foo"]["c0"]
+        self.assertEqual(timing["attempts"], 1)
+        self.assertTrue(timing["stop"] > 0 and timing["start"] > 0)
+
+    @skip_if_go_version
+    def test_concurrency_option(self):
+        """
+        ``--container-concurrency`` sets how many containers are stopped or
+        started at once.
+        """
+        pool = FilePath(self.mktemp())
+        pool.makedirs()
+        dvol = VoluminousOptions()
+        dvol.parseOptions(["-p", pool.path, "--container-concurrency", "3",
+                           "init", "foo"])
+        self.assertEqual(dvol.voluminous.lock.containers.concurrency, 3)
+        self.assertRaises(
+            UsageError, dvol.parseOptions,
+            ["-p", pool.path, "--container-concurrency", "0", "init", "bar"])
+
+    @skip_if_go_version
+    def test_scan_inspects_each_container_once(self):
+        """
+        A scan inspects every container once and maps each volume to the
+        containers using it.
+        """
+        from dockercontainers import Containers
+        containers = Containers("dvol", index_path=self.index)
+        client = containers.client = FakeDockerClient("foo", 2, unrelated=3)
+        scan = containers.scan()
+        self.assertEqual(sorted(client.inspected),
+                         ["c0", "c1", "u0", "u1", "u2"])
+        self.assertEqual(
+            [c["Id"] for c in containers.get_related_containers("foo", scan)],
+            ["c0", "c1"])
+        self.assertEqual(containers.get_related_containers("bar", scan), [])
+
+    @skip_if_go_version
+    def test_scan_skips_listed_unrelated_containers(self):
+        """
+        When the container listing includes mounts, containers which don't
+        mount a dvol volume aren't inspected.
+        """
+        from dockercontainers import Containers
+        containers = Containers("dvol", index_path=self.index)
+        client = containers.client = FakeDockerClient(
+            "foo", 2, unrelated=3, listMounts=True)
+        self.assertEqual(sorted(containers.scan()), ["foo"])
+        self.assertEqual(sorted(client.inspected), ["c0", "c1"])
+
+    @skip_if_go_version
+    def test_list_scans_once(self):
+        """
+        ``dvol list`` scans the containers once however many volumes there
+        are.
+        """
+        from dockercontainers import Containers
+        from dvol import NullLock, Voluminous
+        tmpdir = FilePath(self.mktemp())
+        tmpdir.makedirs()
+        lock = NullLock()
+        lock.containers = Containers("dvol", index_path=self.index)
+        client = lock.containers.client = FakeDockerClient(
+            "foo", 1, unrelated=2)
+        voluminous = Voluminous(tmpdir.path, lockFactory=lambda: lock)
+        for name in ("foo", "bar", "baz"):
+            voluminous.createVolume(name)
+        voluminous.listVolumes()
+        self.assertEqual(len(client.inspected), 3)
+        self.assertIn("/c0", voluminous.getOutput()[-1])
+
+
+    @skip_if_go_version
+    def test_scan_uses_plugin_index(self):
+        """
+        While the plugin is running, running containers are looked up in its
+        index rather than by asking Docker.
+        """
+        from dockercontainers import ContainerIndex, Containers
+        index = ContainerIndex(self.index)
+        index.container_started("c9", "/c9", ["foo"])
+        containers = Containers("dvol", index_path=self.index)
+        client = containers.client = FakeDockerClient("foo", 2)
+        self.assertEqual(
+            [c["Name"] for c in containers.get_related_containers("foo")],
+            ["/c9"])
+        self.assertEqual(client.inspected, [])
+
+    @skip_if_go_version
+    def test_client_created_on_first_use(self):
+        """
+        L{Containers} only creates a Docker client once one is needed, and
+        every L{Containers} shares the same one.
+        """
+        from dockercontainers import Containers, shared_client
+        first = Containers("dvol", index_path=self.index)
+        second = Containers("dvol", index_path=self.index)
+        self.assertEqual(first._client, None)
+        self.assertIdentical(first.client, second.client)
+        self.assertIdentical(first.client, shared_client())
+
+    @skip_if_go_version
+    def test_client_pools_connections(self):
+        """
+        Requests about different containers share one pool of connections to
+        the Docker socket.
+        """
+        from dockercontainers import SOCKET_POOL_URL, shared_client
+        client = shared_client()
+        urls = [SOCKET_POOL_URL + "/v1.20/containers/%s/json" % (cid,)
+                for cid in ("c0", "c1")]
+        adapter = client.get_adapter(urls[0])
+        self.assertIdentical(adapter.get_connection(urls[0]),
+                             adapter.get_connection(urls[1]))
+
+    @skip_if_go_version
+    def test_scan_ignores_index_of_exited_plugin(self):
+        """
+        An index left behind by a plugin which is no longer running is not
+        used, even if another process has since been given its pid.
+        """
+        from dockercontainers import Containers
+        self.index.setContent(json.dumps(dict(
+            pid=os.getpid(), volumes=dict(foo=dict(c9="/c9")))))
+        self.index.siblingExtension(".lock").touch()
+        containers = Containers("dvol", index_path=self.index)
+        containers.client = FakeDockerClient("foo", 2)
+        self.assertEqual(
+            [c["Name"] for c in containers.get_related_containers("foo")],
+            ["/c0", "/c1"])
+
+    @skip_if_go_version
+    def test_index_follows_events(self):
+        """
+        The plugin adds containers to the index when Docker reports they
+        started, and removes them when they die, persisting each change.
+        """
+        from dockercontainers import ContainerIndex, Containers, read_index
+        containers = Containers("dvol", index_path=self.index)
+        containers.client = FakeDockerClient("foo", 2, unrelated=1)
+        index = ContainerIndex(self.index)
+        callFromThread = lambda f, *args: f(*args)
+        plugin.apply_events(containers, index, [
+            dict(status="start", id="c0"), dict(status="start", id="u0"),
+            dict(Type="container", Action="start", id="c1")],
+            callFromThread)
+        self.assertEqual(read_index(self.index),
+                         dict(foo=dict(c0="/c0", c1="/c1")))
+        plugin.apply_events(containers, index, [
+            dict(status="die", id="c0"), dict(status="destroy", id="c1")],
+            callFromThread)
+        self.assertEqual(read_index(self.index), dict())
+
+
+
+class PluginTests(TestCase):
+    """
+    Tests for the Docker volume plugin's HTTP API.
+    """
+    @skip_if_go_version
+    def test_different_volumes_in_parallel(self):
+        """
+        Operations on different volumes run at the same time.
+        """
+        serializer = plugin.VolumeSerializer()
+        started = threading.Event()
+        first = serializer.run("foo", started.wait, 10)
+        second = serializer.run("bar", started.set)
+        d = defer.gatherResults([first, second])
+        d.addCallback(lambda results: self.assertEqual(results[0], True))
+        return d
+
+    @skip_if_go_version
+    def test_same_volume_serialized(self):
+        """
+        Operations on the same volume run one at a time, in the order they
+        were requested.
+        """
+        serializer = plugin.VolumeSerializer()
+        running = []
+        order = []
+
+        def operation(n):
+            running.append(n)
+            time.sleep(0.01)
+            order.append((n, list(running)))
+            running.remove(n)
+        d = defer.gatherResults(
+            [serializer.run("foo", operation, n) for n in range(4)])
+        d.addCallback(lambda _: self.assertEqual(
+            order, [(n, [n]) for n in range(4)]))
+        d.addCallback(lambda _: self.assertEqual(serializer._locks, {}))
+        return d
+
+    @skip_if_go_version
+    def test_mount_responds_asynchronously(self):
+        """
+        A mount request is answered once the volume's running point has been
+        updated in a thread.
+        """
+        volumes = FilePath(self.mktemp())
+        volumes.makedirs()
+        dvol = VoluminousOptions()
+        dvol.parseOptions(ARGS + ["-p", volumes.path, "init", "foo"])
+        from dvol import NullLock, Voluminous
+        voluminous = Voluminous(volumes.path, lockFactory=NullLock)
+        root = plugin.getAdapter(voluminous)
+        request = DummyRequest(["VolumeDriver.Mount"])
+        request.method = "POST"
+        request.content = StringIO(json.dumps(dict(Name="foo")))
+        self.assertEqual(
+            root.getChildWithDefault("VolumeDriver.Mount", request)
+            .render(request), server.NOT_DONE_YET)
+        d = request.notifyFinish()
+
+        def finished(_):
+            response = json.loads("".join(request.written))
+            self.assertEqual(response, dict(
+                Err=None,
+                Mountpoint=volumes.descendant(
+                    ["foo", "running_point"]).path))
+        d.addCallback(finished)
+        return d
+
+
+    @skip_if_go_version
+    def test_mount_watches_branch(self):
+        """
+        Mounting a volume starts watching its active branch for changes, and
+        unmounting it stops.
+        """
+        volumes = FilePath(self.mktemp())
+        volumes.makedirs()
+        dvol = VoluminousOptions()
+        dvol.parseOptions(ARGS + ["-p", volumes.path, "init", "foo"])
+        from dvol import NullLock, Voluminous
+        voluminous = Voluminous(volumes.path, lockFactory=NullLock)
+        watchers = plugin.BranchWatchers(voluminous)
+        root = plugin.getAdapter(voluminous, watchers=watchers)
+        request = DummyRequest(["VolumeDriver.Mount"])
+        request.method = "POST"
+        request.content = StringIO(json.dumps(dict(Name="foo")))
+        root.getChildWithDefault("VolumeDriver.Mount", request).render(
+            request)
+        d = request.notifyFinish()
+
+        def finished(_):
+            for watcher in watchers._watchers.values():
+                self.addCleanup(watcher.stop)
+            master = volumes.descendant(["foo", "branches", "master"])
+            self.assertTrue(dirtypaths._watched(master))
+            unmount = DummyRequest(["VolumeDriver.Unmount"])
+            unmount.method = "POST"
+            unmount.content = StringIO(json.dumps(dict(Name="foo")))
+            root.getChildWithDefault("VolumeDriver.Unmount", unmount).render(
+                unmount)
+            self.assertFalse(dirtypaths._watched(master))
+        d.addCallback(finished)
+        return d
+
+    @skip_if_go_version
+    def test_watch_from_threads(self):
+        """
+        Branches can be watched from several threads at once, which start a
+        single watcher for each branch, and the watchers can be stopped from
+        another thread.
+        """
+        volumes = FilePath(self.mktemp())
+        volumes.makedirs()
+        dvol = VoluminousOptions()
+        dvol.parseOptions(ARGS + ["-p", volumes.path, "init", "foo"])
+        from dvol import NullLock, Voluminous
+        watchers = plugin.BranchWatchers(
+            Voluminous(volumes.path, lockFactory=NullLock))
+        threads = [threading.Thread(target=watchers.watch, args=("foo",))
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.addCleanup(watchers.stopAll)
+        self.assertEqual(watchers._watchers.keys(), [("foo", "master")])
+        master = volumes.descendant(["foo", "branches", "master"])
+        self.assertTrue(dirtypaths._watched(master))
+        watchers.stopAll()
+        self.assertFalse(dirtypaths._watched(master))
+
+    @skip_if_go_version
+    def test_mount_while_restarting_containers(self):
+        """
+        Docker can mount a volume while dvol restarts the containers using
+        it after a commit or checkout, with the volume's lock still held.
+        """
+        volumes = FilePath(self.mktemp())
+        volumes.makedirs()
+        dvol = VoluminousOptions()
+        dvol.parseOptions(ARGS + ["-p", volumes.path, "init", "foo"])
+        from dvol import NullLock, Voluminous
+        mount = plugin.MountResource(
+            Voluminous(volumes.path, lockFactory=NullLock, lockTimeout=0),
+            None, plugin.VolumeSerializer())
+        responses = []
+
+        class MountingLock(NullLock):
+            def release(self, volume):
+                responses.append(json.loads(mount._mount(dict(Name=volume))))
+        # the containers mounted the volume when they first started
+        mount._mount(dict(Name="foo"))
+        voluminous = Voluminous(volumes.path, lockFactory=MountingLock)
+        voluminous.commitVolume("commit 1")
+        voluminous.checkoutBranch("other", create=True)
+        runningPoint = volumes.descendant(["foo", "running_point"]).path
+        self.assertEqual(responses, [dict(Err=None, Mountpoint=runningPoint)]
+                         * 2)
+        self.assertEqual(os.readlink(runningPoint), volumes.descendant(
+            ["foo", "branches", "other"]).path)
+
+
+class VolumeLocksTests(TestCase):
+    """
+    Tests for L{locks.VolumeLocks}.
+    """
+    def setUp(self):
+        self.pool = FilePath(self.mktemp())
+        self.pool.makedirs()
+
+    def holdElsewhere(self, volume, mode):
+        """
+        Lock ``volume``'s lock file the way another dvol process would.
+        """
+        f = open(self.pool.child(".%s.lock" % (volume,)).path, "a")
+        self.addCleanup(f.close)
+        fcntl.flock(f.fileno(), mode)
+
+    @skip_if_go_version
+    def test_commit_times_out(self):
+        """
+        A command which needs a volume another command is changing waits for
+        it, and fails once the lock timeout has passed.
+        """
+        dvol = VoluminousOptions()
+        dvol.parseOptions(ARGS + ["-p", self.pool.path, "init", "foo"])
+        self.holdElsewhere("foo", fcntl.LOCK_EX)
+        dvol = VoluminousOptions()
+        error = self.assertRaises(
+            locks.LockTimeout, dvol.parseOptions,
+            ARGS + ["-p", self.pool.path, "--lock-timeout", "0.1",
+                    "commit", "-m", "hello"])
+        self.assertIn("'foo'", str(error))
+        self.assertEqual(commitdb.commitDatabaseForPool(self.pool).read(
+            "foo", "master"), [])
+
+    @skip_if_go_version
+    def test_readers_share(self):
+        """
+        Reading a volume only excludes commands which change it.
+        """
+        dvol = VoluminousOptions()
+        dvol.parseOptions(ARGS + ["-p", self.pool.path, "init", "foo"])
+        self.holdElsewhere("foo", fcntl.LOCK_SH)
+        dvol = VoluminousOptions()
+        dvol.parseOptions(ARGS + ["-p", self.pool.path, "log"])
+        volumeLocks = locks.VolumeLocks(self.pool, timeout=0)
+        self.assertRaises(locks.LockTimeout,
+                          volumeLocks.exclusive("foo").__enter__)
+
+    @skip_if_go_version
+    def test_volumes_independent(self):
+        """
+        Holding the lock of one volume doesn't stop another from being locked
+        in another thread.
+        """
+        volumeLocks = locks.VolumeLocks(self.pool, timeout=0)
+        results = []
+
+        def other():
+            try:
+                with volumeLocks.exclusive("bar"):
+                    results.append("bar")
+                with volumeLocks.exclusive("foo"):
+                    results.append("foo")
+            except locks.LockTimeout:
+                results.append("timeout")
+        with volumeLocks.exclusive("foo"):
+            thread = threading.Thread(target=other)
+            thread.start()
+            thread.join()
+        self.assertEqual(results, ["bar", "timeout"])
+
+    @skip_if_go_version
+    def test_reentrant(self):
+        """
+        A thread can take a volume's lock again while holding it, and
+        releases the lock when the outermost use ends.
+        """
+        volumeLocks = locks.VolumeLocks(self.pool, timeout=0)
+        other = locks.VolumeLocks(self.pool, timeout=0)
+        with volumeLocks.exclusive("foo"):
+            with volumeLocks.shared("foo"):
+                with volumeLocks.exclusive("foo"):
+                    pass
+                self.assertRaises(locks.LockTimeout,
+                                  other.shared("foo").__enter__)
+        with other.exclusive("foo"):
+            pass
+
+    def test_upgrade_refused(self):
+        """
+        A thread holding a volume's shared lock can't take its exclusive
+        lock, which would let another command in while it waited, and still
+        holds the shared lock afterwards.
+        """
+        volumeLocks = locks.VolumeLocks(self.pool, timeout=0)
+        other = locks.VolumeLocks(self.pool, timeout=0)
+        with volumeLocks.shared("foo"):
+            self.assertRaises(locks.UpgradeRefused,
+                              volumeLocks.exclusive("foo").__enter__)
+            self.assertRaises(locks.LockTimeout,
+                              other.exclusive("foo").__enter__)
+        with other.exclusive("foo"):
+            pass
+
+
+class DurableTests(TestCase):
+    """
+    Tests for L{durable}.
+    """
+    def setUp(self):
+        self.directory = FilePath(self.mktemp())
+        self.directory.makedirs()
+        self.fsynced = []
+        self.synced = []
+        fsync = os.fsync
+
+        def recordingFsync(fd):
+            self.fsynced.append(
+                "directory" if stat.S_ISDIR(os.fstat(fd).st_mode) else "file")
+            fsync(fd)
+        self.patch(os, "fsync", recordingFsync)
+        self.patch(durable, "syncFilesystem", self.synced.append)
+
+    def test_set_content(self):
+        """
+        L{durable.setContent} replaces a file's content by renaming a new file
+        over it, syncing the file and its directory.
+        """
+        path = self.directory.child("current_branch.json")
+        path.setContent("old")
+        durable.setContent(path, "new")
+        self.assertEqual(
+            (path.getContent(), self.directory.listdir(),
+             self.fsynced, self.synced),
+            ("new", ["current_branch.json"], ["file", "directory"], []))
+
+    def test_batch(self):
+        """
+        Writes made in a batch are visible straight away, and their
+        directories are made durable together by one sync of the filesystem
+        when it ends.
+        """
+        with durable.batch(self.directory):
+            with durable.batch(self.directory.child("nested")):
+                for name in ("a", "b", "c"):
+                    durable.setContent(self.directory.child(name), name)
+            self.assertEqual(self.directory.child("a").getContent(), "a")
+            self.assertEqual(self.synced, [])
+        self.assertEqual((self.fsynced, self.synced),
+                         (["file"] * 3, [self.directory]))
+
+    def test_failed_batch(self):
+        """
+        A batch which raises isn't synced.
+        """
+        def fail():
+            with durable.batch(self.directory):
+                durable.setContent(self.directory.child("a"), "a")
+                raise ZeroDivisionError()
+        self.assertRaises(ZeroDivisionError, fail)
+        self.assertEqual((self.fsynced, self.synced), (["file"], []))
+        durable.setContent(self.directory.child("b"), "b")
+        self.assertEqual(self.fsynced, ["file", "file", "directory"])
+
+    @skip_if_go_version
+    def test_commit_syncs_twice(self):
+        """
+        A commit syncs the pool once after storing its data and once after
+        recording it, however many metadata files it changes, rather than
+        syncing each of their directories.
+        """
+        dvol = VoluminousOptions()
+        dvol.parseOptions(ARGS + ["-p", self.directory.path, "init", "foo"])
+        self.directory.descendant(
+            ["foo", "branches", "master", "file"]).setContent("hello")
+        del self.synced[:]
+        dvol = VoluminousOptions()
+        dvol.parseOptions(ARGS + ["-p", self.directory.path,
+                                  "commit", "-m", "hello"])
+        self.assertEqual(("directory" in self.fsynced, self.synced),
+                         (False, [self.directory, self.directory]))
+
+    def test_sync_filesystem(self):
+        """
+        L{durable.syncFilesystem} can sync the filesystem holding a
+        directory.
+        """
+        syncFilesystem(self.directory)
+
+
+syncFilesystem = durable.syncFilesystem
+
+
+class MetadataCacheTests(TestCase):
+    """
+    Tests for L{metadatacache.MetadataCache}.
+    """
+    def test_unchanged_file_read_once(self):
+        """
+        A file is parsed again only once it has been replaced.
+        """
+        path = FilePath(self.mktemp())
+        cache = metadatacache.MetadataCache()
+        self.assertEqual(cache.readJSON(path), None)
+        durable.setContent(path, json.dumps(dict(current_branch="master")))
+        values = [cache.readJSON(path), cache.readJSON(path)]
+        durable.setContent(path, json.dumps(dict(current_branch="other")))
+        values.append(cache.readJSON(path))
+        self.assertEqual(
+            (values, cache.hits, cache.misses),
+            ([dict(current_branch="master")] * 2 +
+             [dict(current_branch="other")], 1, 2))
+        path.remove()
+        self.assertEqual(cache.readJSON(path), None)
+
+    @skip_if_go_version
+    def test_list_uses_cache(self):
+        """
+        Listing volumes again reads nothing which hasn't changed, and ``dvol
+        info`` shows how many reads the cache answered.
+        """
+        from dvol import NullLock, Voluminous
+        pool = FilePath(self.mktemp())
+        pool.makedirs()
+        voluminous = Voluminous(pool.path, lockFactory=NullLock)
+        for name in ("foo", "bar", "baz"):
+            voluminous.createVolume(name)
+        voluminous.listVolumes()
+        misses = voluminous.metadata.misses
+        voluminous.listVolumes()
+        self.assertEqual(voluminous.metadata.misses, misses)
+        voluminous.showInfo()
+        self.assertIn(
+            "Metadata cache: %d hits, %d misses" % (
+                voluminous.metadata.hits, misses),
+            [" ".join(line.split())
+             for line in voluminous.getOutput()[-1].split("\n")])
+
+
+class StartupTests(TestCase):
+    """
+    Tests for how much work dvol does before running a command.
+    """
+    @skip_if_go_version
+    def test_log_imports_little(self):
+        """
+        ``dvol log``, run with Docker integration enabled as it normally is,
+        loads none of the slow modules other commands need, and doesn't
+        connect to Docker.  The time taken to import dvol is logged, for
+        keeping track of regressions which this doesn't catch.
+        """
+        pool = FilePath(self.mktemp())
+        pool.makedirs()
+        dvol = VoluminousOptions()
+        dvol.parseOptions(ARGS + ["-p", pool.path, "init", "foo"])
+        script = (
+            "import json, sys, time\n"
+            "started = time.time()\n"
+            "from dvol_python.dvol import VoluminousOptions\n"
+            "imported = time.time() - started\n"
+            "VoluminousOptions().parseOptions(['-p', sys.argv[1], 'log'])\n"
+            "print json.dumps(dict(imported=imported, loaded=[\n"
+            "    m for m in sys.argv[2:] if m in sys.modules]))\n")
+        output = subprocess.check_output(
+            [sys.executable, "-c", script, pool.path] + HEAVY_MODULES,
+            cwd=SOURCE_ROOT)
+        result = json.loads(output.splitlines()[-1])
+        log.msg("importing dvol took %.3fs" % (result["imported"],))
+        self.assertEqual(result["loaded"], [])
+
+
+class ChunkStoreTests(TestCase):
+    """
+    Tests for L{chunks.ChunkStore} and volumes which store large files as
+    chunks.
+    """
+    def setUp(self):
+        self.tmpdir = FilePath(self.mktemp())
+        self.tmpdir.makedirs()
+        self.patch(chunks, "CHUNK_SIZE", 4096)
+        self.patch(chunks, "CHUNKED_THRESHOLD", 4096 * 3)
+
+    def chunkObjects(self, path):
+        return len([p for p in path.walk() if p.isfile()])
+
+    def test_only_changed_chunks_stored(self):
+        """
+        Storing a file again after changing part of it only writes the
+        chunks which changed, and either version can be assembled again,
+        writing only the chunks which differ from a version already in
+        place.
+        """
+        objects = objectstore.ObjectStore(self.tmpdir.child("objects"))
+        store = chunks.ChunkStore(self.tmpdir.child("chunks"), objects)
+        data = self.tmpdir.child("data")
+        original = "".join(chr(i) * 4096 for i in range(5)) + "tail"
+        data.setContent(original)
+        first = store.store(data.path, os.lstat(data.path))
+        with data.open("r+") as f:
+            f.seek(4096 * 2 + 10)
+            f.write("changed")
+        second = store.store(data.path, os.lstat(data.path))
+        self.assertEqual(self.chunkObjects(store.chunks.path), 7)
+        restored = self.tmpdir.child("restored").path
+        st = os.lstat(objects.objectPath(first).path)
+        store.assemble(first, restored, st)
+        self.assertEqual(open(restored).read(), original)
+        written = store.assemble(second, restored, st, base=first)
+        self.assertEqual((open(restored).read(), written),
+                         (data.getContent(), 4096))
+
+    @skip_if_go_version
+    def test_commit_and_reset(self):
+        """
+        A volume created with ``--chunked`` commits large files as chunks,
+        resetting rewrites only the chunks of them which differ, and chunks
+        are removed along with the last commit using them.
+        """
+        dvol = VoluminousOptions()
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+                                  "init", "--chunked", "foo"])
+        data = self.tmpdir.descendant(["foo", "branches", "master", "db"])
+        original = os.urandom(4096 * 5)
+        data.setContent(original)
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+                                  "commit", "-m", "first"])
+        with data.open("r+") as f:
+            f.seek(4096)
+            f.write("changed")
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+                                  "commit", "-m", "second"])
+        stored = self.tmpdir.descendant(
+            ["foo", "commits", chunks.CHUNKS_DIRECTORY, "objects"])
+        self.assertEqual(self.chunkObjects(stored), 6)
+        inode = os.lstat(data.path).st_ino
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+                                  "reset", "--hard", "HEAD^"])
+        self.assertEqual(
+            (data.getContent(), os.lstat(data.path).st_ino,
+             self.chunkObjects(stored)),
+            (original, inode, 5))
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+                                  "checkout", "-b", "other"])
+        self.assertEqual(self.tmpdir.descendant(
+            ["foo", "branches", "other", "db"]).getContent(), original)
+
+    @skip_if_go_version
+    def test_chunked_overlay(self):
+        """
+        Volumes can't be both chunked and overlays, since an overlay shows
+        its commit's files as they are stored.
+        """
+        dvol = VoluminousOptions()
+        self.assertRaises(UsageError, dvol.parseOptions,
+            ARGS + ["-p", self.tmpdir.path, "init", "--chunked", "--overlay",
+                    "foo"])
+
+
+class CompressionTests(TestCase):
+    """
+    Tests for L{compression} and volumes which store commits compressed.
+    """
+    def setUp(self):
+        self.tmpdir = FilePath(self.mktemp())
+        self.tmpdir.makedirs()
+
+    @given(data=binary())
+    def test_data_round_trip(self, data):
+        """
+        Data compressed by L{compression.compressData} decompresses to what
+        it was.
+        """
+        self.patch(compression, "BLOCK_SIZE", 16)
+        path = FilePath(self.mktemp())
+        path.setContent(compression.compressData(data))
+        self.assertEqual(
+            "".join(compression.decompressedBlocks(path.path)), data)
+
+    def test_file_compressed_in_parallel(self):
+        """
+        The blocks of a large file are compressed by several threads, and
+        blocks which don't compress are stored as they are.
+        """
+        self.patch(compression, "BLOCK_SIZE", 1024)
+        self.patch(compression, "PARALLEL_BLOCKS", 2)
+        source = self.tmpdir.child("source")
+        data = "".join(os.urandom(1024) + "x" * 1024 for i in range(10))
+        source.setContent(data + "tail")
+        destination = self.tmpdir.child("destination")
+        compression.compressFile(source.path, destination.path,
+                                 len(data) + 4, workers=3)
+        self.assertEqual(
+            "".join(compression.decompressedBlocks(destination.path)),
+            data + "tail")
+        self.assertTrue(destination.getsize() < len(data))
+
+    def test_corrupt_object(self):
+        """
+        Reading a truncated compressed object raises
+        L{compression.CorruptObject}.
+        """
+        path = self.tmpdir.child("object")
+        path.setContent(compression.compressData("x" * 100)[:-1])
+        self.assertRaises(compression.CorruptObject, list,
+                          compression.decompressedBlocks(path.path))
+
+    @skip_if_go_version
+    def test_commit_reset_and_checkout(self):
+        """
+        A volume created with ``--compressed`` stores its commits
+        compressed, and decompresses them when a branch is reset or checked
+        out.
+        """
+        dvol = VoluminousOptions()
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+                                  "init", "--compressed", "foo"])
+        data = self.tmpdir.descendant(["foo", "branches", "master", "db"])
+        original = "row\n" * 10000
+        data.setContent(original)
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+                                  "commit", "-m", "first"])
+        data.setContent("changed")
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+                                  "commit", "-m", "second"])
+        stored = [p for p in self.tmpdir.descendant(
+            ["foo", "commits", objectstore.OBJECTS_DIRECTORY]).walk()
+            if p.isfile()]
+        self.assertTrue(max(p.getsize() for p in stored) < len(original))
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+                                  "reset", "--hard", "HEAD^"])
+        self.assertEqual(data.getContent(), original)
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+                                  "checkout", "-b", "other"])
+        self.assertEqual(self.tmpdir.descendant(
+            ["foo", "branches", "other", "db"]).getContent(), original)
+
+    @skip_if_go_version
+    def test_compressed_chunks(self):
+        """
+        Volumes can be both chunked and compressed, in which case the chunks
+        are compressed.
+        """
+        self.patch(chunks, "CHUNK_SIZE", 4096)
+        self.patch(chunks, "CHUNKED_THRESHOLD", 4096 * 3)
+        dvol = VoluminousOptions()
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path, "init",
+                                  "--chunked", "--compressed", "foo"])
+        data = self.tmpdir.descendant(["foo", "branches", "master", "db"])
+        original = "".join(chr(i) * 4096 for i in range(5))
+        data.setContent(original)
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+                                  "commit", "-m", "first"])
+        data.setContent("changed")
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+                                  "reset", "--hard", "HEAD"])
+        self.assertEqual(data.getContent(), original)
+
+    @skip_if_go_version
+    def test_compressed_overlay(self):
+        """
+        Volumes can't be both compressed and overlays, since an overlay
+        shows its commit's files as they are stored.
+        """
+        dvol = VoluminousOptions()
+        self.assertRaises(UsageError, dvol.parseOptions,
+            ARGS + ["-p", self.tmpdir.path, "init", "--compressed",
+                    "--overlay", "foo"])
+
+
+class DirtyPathsTests(TestCase):
+    """
+    Tests for L{dirtypaths} and commits which only look at the paths a
+    branch's watcher saw change.
+    """
+    def setUp(self):
+        self.tmpdir = FilePath(self.mktemp())
+        self.tmpdir.makedirs()
+
+    def snapshot(self, source, name, store, **kwargs):
+        destination = self.tmpdir.child(name)
+        manifest = objectstore.snapshotTree(source, destination, store,
+                                            **kwargs)
+        return destination, manifest
+
+    def test_snapshot_of_changed_paths(self):
+        """
+        Given the paths which changed since an earlier snapshot, only those
+        are looked at, and everything else is copied from the snapshot.
+        """
+        store = objectstore.ObjectStore(self.tmpdir.child("objects"))
+        source = self.tmpdir.child("source")
+        source.descendant(["sub", "deep"]).makedirs()
+        source.child("dir").makedirs()
+        source.descendant(["dir", "a"]).setContent("a")
+        source.descendant(["dir", "b"]).setContent("b")
+        source.descendant(["sub", "deep", "c"]).setContent("c")
+        source.child("top").setContent("top")
+        os.symlink("dir/a", source.child("link").path)
+        first, manifest = self.snapshot(source, "first", store)
+        source.descendant(["dir", "a"]).setContent("changed")
+        # not reported, so not noticed
+        source.descendant(["dir", "b"]).setContent("unseen")
+        source.child("top").remove()
+        source.descendant(["sub", "new"]).makedirs()
+        source.descendant(["sub", "new", "x"]).setContent("x")
+        second, files = self.snapshot(
+            source, "second", store, previous=manifest,
+            base=(first, manifest),
+            changed={"dir/a", "top", "sub/new", "sub/new/x"})
+        self.assertEqual(
+            (second.descendant(["dir", "a"]).getContent(),
+             second.descendant(["dir", "b"]).getContent(),
+             second.child("top").exists(),
+             second.descendant(["sub", "new", "x"]).getContent(),
+             second.descendant(["sub", "deep", "c"]).getContent(),
+             os.readlink(second.child("link").path)),
+            ("changed", "b", False, "x", "c", "dir/a"))
+        self.assertEqual(sorted(files),
+                         ["dir/a", "dir/b", "sub/deep/c", "sub/new/x"])
+        self.assertEqual(files["dir/b"], manifest["dir/b"])
+
+    def test_snapshot_base_mismatch(self):
+        """
+        A changed path whose directory isn't in the earlier snapshot means
+        that the changes reported are incomplete.
+        """
+        store = objectstore.ObjectStore(self.tmpdir.child("objects"))
+        source = self.tmpdir.child("source")
+        source.makedirs()
+        first, manifest = self.snapshot(source, "first", store)
+        source.child("new").makedirs()
+        source.descendant(["new", "x"]).setContent("x")
+        self.assertRaises(
+            objectstore.BaseMismatch, self.snapshot, source, "second", store,
+            previous=manifest, base=(first, manifest), changed={"new/x"})
+
+    def test_watcher_logs_changes(self):
+        """
+        A L{dirtypaths.BranchWatcher} logs the paths which change, including
+        those in directories created while it runs, and
+        L{dirtypaths.changedPaths} returns those logged since an earlier
+        mark.
+        """
+        branch = self.tmpdir.child("master")
+        branch.makedirs()
+        branch.child("a").setContent("a")
+        watcher = dirtypaths.BranchWatcher(branch)
+        self.assertTrue(watcher.start())
+        self.addCleanup(watcher.stop)
+        self.assertFalse(dirtypaths.BranchWatcher(branch).start())
+        first, changed = dirtypaths.changedPaths(branch, None)
+        self.assertEqual(changed, None)
+        with branch.child("a").open("w") as f:
+            f.write("changed")
+        branch.descendant(["d", "e"]).makedirs()
+        branch.descendant(["d", "e", "f"]).setContent("f")
+        second, changed = dirtypaths.changedPaths(branch, first)
+        self.assertEqual(objectstore._changedRoots(changed), {"a", "d"})
+        with branch.descendant(["d", "e", "f"]).open("w") as f:
+            f.write("changed")
+        _, changed = dirtypaths.changedPaths(branch, second)
+        self.assertEqual(changed, {"d/e/f"})
+        watcher.stop()
+        self.assertEqual(dirtypaths.changedPaths(branch, second),
+                         (None, None))
+
+    def test_log_compacted_once_recorded(self):
+        """
+        Once a commit has recorded its mark, the watcher's log is replaced by
+        one which starts at the mark's fence, and it carries on watching.
+        """
+        branch = self.tmpdir.child("master")
+        branch.makedirs()
+        watcher = dirtypaths.BranchWatcher(branch)
+        watcher.start()
+        self.addCleanup(watcher.stop)
+        first, _ = dirtypaths.changedPaths(branch, None)
+        with branch.child("a").open("w") as f:
+            f.write("a")
+        second, changed = dirtypaths.changedPaths(branch, first)
+        self.assertEqual(changed, {"a"})
+        dirtypaths.recorded(branch, second)
+        log = dirtypaths.dirtyLogPath(branch)
+        deadline = time.time() + 10
+        while "path a" in log.getContent() and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(
+            log.getContent().splitlines(),
+            ["start " + second["token"], "fence " + second["fence"]])
+        self.assertTrue(dirtypaths._watched(branch))
+        with branch.child("b").open("w") as f:
+            f.write("b")
+        _, changed = dirtypaths.changedPaths(branch, second)
+        self.assertEqual(changed, {"b"})
+
+    def test_watcher_stops_with_branch(self):
+        """
+        A L{dirtypaths.BranchWatcher} stops when its branch is removed.
+        """
+        branch = self.tmpdir.child("master")
+        branch.makedirs()
+        watcher = dirtypaths.BranchWatcher(branch)
+        watcher.start()
+        self.addCleanup(watcher.stop)
+        branch.remove()
+        watcher._thread.join(10)
+        self.assertFalse(watcher.running)
+        self.assertEqual(dirtypaths.changedPaths(branch, None),
+                         (None, None))
+
+    @skip_if_go_version
+    def test_commit_looks_at_changed_paths(self):
+        """
+        Committing a branch which is being watched only looks at the paths
+        which changed since its last commit.
+        """
+        dvol = VoluminousOptions()
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path, "init", "foo"])
+        master = self.tmpdir.descendant(["foo", "branches", "master"])
+        master.child("same.txt").setContent("unchanged")
+        master.child("different.txt").setContent("before")
+        from dvol import Voluminous
+        watcher = Voluminous(self.tmpdir.path).backend("foo").watcher(
+            "foo", "master")
+        watcher.start()
+        self.addCleanup(watcher.stop)
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "commit", "-m", "commit 1"])
+        master.child("different.txt").setContent("after!")
+        walked = []
+        walk = objectstore._walk
+        def recordingWalk(root, live=False, start=""):
+            walked.append(start)
+            return walk(root, live, start)
+        self.patch(objectstore, "_walk", recordingWalk)
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "commit", "-m", "commit 2"])
+        self.assertEqual(walked, ["different.txt"])
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "reset", "--hard", "HEAD^"])
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "reset", "--hard", "HEAD"])
+        self.assertEqual(
+            (master.child("same.txt").getContent(),
+             master.child("different.txt").getContent()),
+            ("unchanged", "before"))
+
+
+class BranchIndexTests(TestCase):
+    """
+    Tests for L{branchindex} and the stat caches it keeps for branches.
+    """
+    def setUp(self):
+        self.tmpdir = FilePath(self.mktemp())
+        self.tmpdir.makedirs()
+
+    def test_round_trip(self):
+        """
+        An index written by L{branchindex.writeIndex} looks up every entry
+        it was given, lists them in the order the tree is walked, and keeps
+        its metadata until it is closed.
+        """
+        files = dict(
+            ("dir%d/file%d" % (i % 7, i),
+             [i, i * 10, 1000.25 + i, 2000.5, "%040x" % (i,)])
+            for i in range(300))
+        files["dir-1"] = [1, 2, 3.0, 4.0, "f" * 40]
+        path = self.tmpdir.child("master.index")
+        branchindex.writeIndex(path, files, dict(commit="abc"))
+        with branchindex.BranchIndex.open(path) as index:
+            self.assertEqual(
+                (len(index), index.metadata, index.get("missing"),
+                 "dir1/file1" in index),
+                (len(files), dict(commit="abc"), None, True))
+            self.assertEqual(dict((relative, index[relative])
+                                  for relative in files), files)
+            self.assertEqual(list(index), sorted(
+                files, key=lambda relative: relative.split("/")))
+        self.assertRaises(ValueError, index.get, "dir1/file1")
+
+    def test_corrupt(self):
+        """
+        A missing, empty or truncated index isn't used.
+        """
+        path = self.tmpdir.child("master.index")
+        self.assertEqual(branchindex.BranchIndex.open(path), None)
+        path.setContent("")
+        self.assertEqual(branchindex.BranchIndex.open(path), None)
+        branchindex.writeIndex(path, {"a": [1, 2, 3.0, 4.0, "f" * 40]}, {})
+        path.setContent(path.getContent()[:-1])
+        self.assertEqual(branchindex.BranchIndex.open(path), None)
+
+    def test_hash_in_processes(self):
+        """
+        Enough files are hashed by a pool of processes, leaving out those
+        which disappeared.
+        """
+        self.patch(objectstore, "PROCESS_HASH_THRESHOLD", 3)
+        tasks = []
+        for i in range(5):
+            path = self.tmpdir.child("file%d" % (i,))
+            path.setContent("x" * i)
+            tasks.append((path.path, os.lstat(path.path)))
+        os.remove(tasks[0][0])
+        self.assertEqual(
+            objectstore._hashInProcesses(tasks, workers=2),
+            dict((path, objectstore.hashFile(path, st))
+                 for path, st in tasks[1:]))
+        self.assertEqual(objectstore._hashInProcesses(tasks[:2], 2), {})
+
+    @skip_if_go_version
+    def test_commit_uses_index(self):
+        """
+        Committing a branch records its files in its index, and the next
+        commit finds what it can skip there rather than in the manifest,
+        unmapping the index once it is done with it.
+        """
+        dvol = VoluminousOptions()
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path, "init", "foo"])
+        master = self.tmpdir.descendant(["foo", "branches", "master"])
+        master.child("same.txt").setContent("unchanged")
+        master.child("different.txt").setContent("before")
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "commit", "-m", "commit 1"])
+        with branchindex.BranchIndex.open(branchindex.indexPath(
+                self.tmpdir.child("foo"), "master")) as index:
+            self.assertEqual(sorted(index), ["different.txt", "same.txt"])
+        for manifest in self.tmpdir.descendant(["foo", "manifests"]).children():
+            manifest.remove()
+        master.child("different.txt").setContent("after!")
+        hashed = []
+        hashFile = objectstore.hashFile
+        def recordingHashFile(path, st):
+            hashed.append(os.path.basename(path))
+            return hashFile(path, st)
+        self.patch(objectstore, "hashFile", recordingHashFile)
+        opened = []
+        openIndex = branchindex.BranchIndex.open
+        def recordingOpen(path):
+            index = openIndex(path)
+            opened.append(index)
+            return index
+        self.patch(branchindex.BranchIndex, "open",
+                   staticmethod(recordingOpen))
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "commit", "-m", "commit 2"])
+        self.assertEqual(hashed, ["different.txt"])
+        dvol.parseOptions(ARGS + ["-p", self.tmpdir.path, "status"])
+        self.assertEqual(len(opened), 2)
+        for index in opened:
+            self.assertRaises(ValueError, index.get, "same.txt")
+
+
+class TreeDiffTests(TestCase):
+    """
+    Tests for C{dvol status}, C{dvol diff} and the L{treediff} module they
+    use.
+    """
+    def setUp(self):
+        self.tmpdir = FilePath(self.mktemp())
+        self.tmpdir.makedirs()
+        self.dvol = VoluminousOptions()
+        self.dvolCommand("init", "foo")
+        self.master = self.tmpdir.descendant(["foo", "branches", "master"])
+
+    def dvolCommand(self, *args):
+        self.dvol.parseOptions(ARGS + ["-p", self.tmpdir.path] + list(args))
+        return self.dvol.voluminous.getOutput()[-1]
+
+    def makeChanges(self):
+        """
+        Commit some files, then change them.
+        """
+        self.master.child("a.txt").setContent("before")
+        self.master.child("dir").makedirs()
+        self.master.descendant(["dir", "b.txt"]).setContent("b")
+        self.master.descendant(["dir", "c.txt"]).setContent("c")
+        self.dvolCommand("commit", "-m", "commit 1")
+        self.master.child("a.txt").setContent("after!")
+        self.master.descendant(["dir", "b.txt"]).remove()
+        self.master.child("new").makedirs()
+        self.master.descendant(["new", "d.txt"]).setContent("d")
+
+    @skip_if_go_version
+    def test_checked_out_files_unchanged(self):
+        """
+        Files copied out of a commit by C{dvol checkout -b} hash to the
+        objects they were copied from, so the new branch has no changes and
+        committing it stores nothing new.
+        """
+        self.makeChanges()
+        self.dvolCommand("commit", "-m", "commit 2")
+        objects = self.tmpdir.descendant(["foo", "commits", ".objects"])
+        stored = len([path for path in objects.walk() if path.isfile()])
+        self.dvolCommand("checkout", "-b", "dev")
+        self.assertEqual(self.dvolCommand("status"), "")
+        self.dvolCommand("commit", "-m", "commit 3")
+        self.assertEqual(self.dvolCommand("diff", "HEAD^", "HEAD"), "")
+        self.assertEqual(
+            len([path for path in objects.walk() if path.isfile()]), stored)
+
+    @skip_if_go_version
+    def test_status(self):
+        """
+        C{dvol status} lists what was added, deleted or modified in the
+        active branch since its latest commit.
+        """
+        self.makeChanges()
+        self.assertEqual(self.dvolCommand("status"), "\n".join([
+            "modified a.txt",
+            "deleted  dir/b.txt",
+            "added    new/",
+            "added    new/d.txt"]))
+
+    @skip_if_go_version
+    def test_status_json(self):
+        """
+        C{dvol status --json} outputs each change as a JSON object.
+        """
+        self.makeChanges()
+        self.assertEqual(
+            [json.loads(line) for line
+             in self.dvolCommand("status", "--json").splitlines()],
+            [dict(change="modified", path="a.txt", kind="file"),
+             dict(change="deleted", path="dir/b.txt", kind="file"),
+             dict(change="added", path="new", kind="directory"),
+             dict(change="added", path="new/d.txt", kind="file")])
+
+    @skip_if_go_version
+    def test_status_only_hashes_changed_files(self):
+        """
+        C{dvol status} only hashes the files whose stat result changed since
+        they were committed, and a file stored as chunks which is still the
+        same isn't reported.
+        """
+        self.patch(chunks, "CHUNK_SIZE", 4096)
+        self.patch(chunks, "CHUNKED_THRESHOLD", 4096 * 3)
+        self.dvolCommand("init", "--chunked", "bar")
+        master = self.tmpdir.descendant(["bar", "branches", "master"])
+        master.child("same.txt").setContent("unchanged")
+        master.child("db").setContent("x" * 4096 * 4)
+        master.child("touched.txt").setContent("touched")
+        self.dvolCommand("commit", "-m", "commit 1")
+        # only the change time changes
+        for name in ["db", "touched.txt"]:
+            path = master.child(name).path
+            os.chmod(path, stat.S_IMODE(os.lstat(path).st_mode))
+        hashed = []
+        hashFile = objectstore.hashFile
+        def recordingHashFile(path, st):
+            hashed.append(os.path.basename(path))
+            return hashFile(path, st)
+        self.patch(storage, "hashFile", recordingHashFile)
+        self.assertEqual(self.dvolCommand("status"), "")
+        self.assertEqual(hashed, ["touched.txt"])
+
+    @skip_if_go_version
+    def test_status_of_watched_branch(self):
+        """
+        C{dvol status} of a branch which is being watched only looks at the
+        paths which changed since its latest commit.
+        """
+        self.makeChanges()
+        self.dvolCommand("commit", "-m", "commit 2")
+        watcher = self.dvol.voluminous.backend("foo").watcher("foo", "master")
+        watcher.start()
+        self.addCleanup(watcher.stop)
+        self.dvolCommand("commit", "-m", "commit 3")
+        with self.master.descendant(["dir", "c.txt"]).open("w") as f:
+            f.write("changed")
+        listed = []
+        listdir = os.listdir
+        def recordingListdir(path):
+            listed.append(path)
+            return listdir(path)
+        self.patch(treediff.os, "listdir", recordingListdir)
+        self.assertEqual(self.dvolCommand("status"), "modified dir/c.txt")
+        self.assertEqual(listed, [])
+
+    @skip_if_go_version
+    def test_diff(self):
+        """
+        C{dvol diff} lists what changed between two commits, given by id or
+        relative to the latest commit.
+        """
+        self.makeChanges()
+        self.dvolCommand("commit", "-m", "commit 2")
+        second = self.dvolCommand("log").split()[1]
+        self.assertEqual(self.dvolCommand("diff", "HEAD^", second), "\n".join([
+            "modified a.txt",
+            "deleted  dir/b.txt",
+            "added    new/",
+            "added    new/d.txt"]))
+        self.assertEqual(
+            [json.loads(line) for line
+             in self.dvolCommand("diff", "--json", "HEAD", "HEAD^").splitlines()],
+            [dict(change="modified", path="a.txt", kind="file"),
+             dict(change="added", path="dir/b.txt", kind="file"),
+             dict(change="deleted", path="new", kind="directory"),
+             dict(change="deleted", path="new/d.txt", kind="file")])
+
+    @skip_if_go_version
+    def test_diff_skips_unchanged_directories(self):
+        """
+        C{dvol diff} doesn't look inside directories which are the same in
+        both commits.
+        """
+        for name in ["one", "two", "three"]:
+            self.master.descendant([name, "inner"]).makedirs()
+            self.master.descendant([name, "inner", "file"]).setContent(name)
+        self.dvolCommand("commit", "-m", "commit 1")
+        self.master.descendant(["two", "inner", "file"]).setContent("2")
+        self.dvolCommand("commit", "-m", "commit 2")
+        commits = self.tmpdir.descendant(["foo", "commits"])
+        listed = []
+        listdir = os.listdir
+        def recordingListdir(path):
+            listed.append(os.path.relpath(path, commits.path).split("/", 1))
+            return listdir(path)
+        self.patch(treediff.os, "listdir", recordingListdir)
+        self.assertEqual(self.dvolCommand("diff", "HEAD^", "HEAD"),
+                         "modified two/inner/file")
+        self.assertEqual(sorted(set(path[1:] and path[1] or ""
+                                    for path in listed)),
+                         ["", "two", "two/inner"])
+
+    @skip_if_go_version
+    def test_diff_unknown_commit(self):
+        """
+        C{dvol diff} refuses to compare a commit which doesn't exist.
+        """
+        self.dvolCommand("commit", "-m", "commit 1")
+        self.assertRaises(NoSuchCommit, self.dvolCommand, "diff", "HEAD", "missing")
+
+
+class ZFSBackendTests(TestCase):
+    """
+    Tests for volumes stored with the ZFS backend, using a stand-in for the
+    'zfs' command.
+    """
+    @skip_if_go_version
+    def setUp(self):
+        self.tmpdir = FilePath(self.mktemp())
+        self.tmpdir.makedirs()
+        fakeRoot = FilePath(self.mktemp())
+        fakeRoot.makedirs()
+        self.zfs = FakeZFS(fakeRoot)
+        self.patch(storage, "zfs", self.zfs)
+        self.dvol = VoluminousOptions()
+        self.dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "init", "--zfs-dataset", "tank/dvol", "foo"])
+        self.master = self.tmpdir.child("foo").child("branches").child(
+            "master")
+
+    def commit(self, content):
+        self.master.child("file.txt").setContent(content)
+        self.dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "commit", "-m", content])
+        return self.dvol.voluminous.getOutput()[-1]
+
+    @skip_if_go_version
+    def test_init_creates_datasets(self):
+        """
+        ``dvol init --zfs-dataset`` creates a dataset for the volume and one
+        mounted at the master branch directory.
+        """
+        self.assertEqual(
+            sorted(self.zfs.datasets), ["tank/dvol/foo", "tank/dvol/foo/master"])
+        self.assertEqual(self.zfs.datasets["tank/dvol/foo/master"],
+                         self.master.path)
+        self.assertTrue(self.master.isdir())
+
+    @skip_if_go_version
+    def test_commit_is_snapshot(self):
+        """
+        A commit is a snapshot of the branch's dataset.
+        """
+        commitId = self.commit("hello")
+        self.assertEqual(self.zfs.snapshots,
+                         ["tank/dvol/foo/master@" + commitId])
+
+    @skip_if_go_version
+    def test_reset_HEAD_rolls_back(self):
+        """
+        Resetting to the latest snapshot of the branch's dataset rolls it
+        back.
+        """
+        commitId = self.commit("alpha")
+        self.master.child("file.txt").setContent("beta")
+        self.dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "reset", "--hard", "HEAD"])
+        self.assertIn(["rollback", "tank/dvol/foo/master@" + commitId],
+                      self.zfs.calls)
+        self.assertEqual(self.master.child("file.txt").getContent(), "alpha")
+
+    @skip_if_go_version
+    def test_reset_older_commit(self):
+        """
+        Resetting to an older commit replaces the branch's dataset with a
+        clone of it and destroys the newer snapshot.
+        """
+        oldCommit = self.commit("OLD")
+        newCommit = self.commit("NEW")
+        self.dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "reset", "--hard", "HEAD^"])
+        self.assertEqual(self.master.child("file.txt").getContent(), "OLD")
+        snapshots = [s.split("@")[1] for s in self.zfs.snapshots]
+        self.assertIn(oldCommit, snapshots)
+        self.assertNotIn(newCommit, snapshots)
+
+    @skip_if_go_version
+    def test_checkout_new_branch_is_clone(self):
+        """
+        ``dvol checkout -b`` clones the HEAD snapshot into a new dataset.
+        """
+        commitId = self.commit("hello")
+        self.dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "checkout", "-b", "other"])
+        self.assertIn(["clone", "-o", "mountpoint=%s" % (
+            self.master.sibling("other").path,),
+            "tank/dvol/foo/master@" + commitId, "tank/dvol/foo/other"],
+            self.zfs.calls)
+        self.assertEqual(
+            self.master.sibling("other").child("file.txt").getContent(),
+            "hello")
+
+    @skip_if_go_version
+    def test_delete_branch_keeps_cloned_snapshots(self):
+        """
+        Deleting a branch keeps the snapshots which other branches were
+        cloned from, and ``dvol gc`` destroys them once no branch refers to
+        them.
+        """
+        sharedCommit = self.commit("shared")
+        self.dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "checkout", "-b", "other"])
+        other = self.master.sibling("other")
+        self.patch(type(self.dvol.voluminous), "_userIsSure",
+                   lambda voluminous: True)
+        self.dvol.voluminous.deleteBranch("master")
+        self.assertNotIn("tank/dvol/foo/master", self.zfs.datasets)
+        other.child("file.txt").setContent("other")
+        self.dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "commit", "-m", "other"])
+        self.dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "reset", "--hard", sharedCommit])
+        self.assertEqual(other.child("file.txt").getContent(), "shared")
+        self.dvol.parseOptions(ARGS + ["-p", self.tmpdir.path, "gc"])
+        self.assertEqual(
+            [s.split("@")[1] for s in self.zfs.snapshots], [sharedCommit])
+        self.dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "checkout", "-b", "third"])
+        self.dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "checkout", "other"])
+        self.dvol.voluminous.deleteBranch("third")
+        self.dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "rm", "-f", "foo"])
+        self.assertEqual(self.zfs.datasets, {})
+
+    @skip_if_go_version
+    def test_remove_volume_destroys_datasets(self):
+        """
+        Removing a volume destroys its datasets.
+        """
+        self.commit("hello")
+        self.dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "rm", "-f", "foo"])
+        self.assertEqual(self.zfs.datasets, {})
+        self.assertFalse(self.tmpdir.child("foo").exists())
+
+
+class OverlayBackendTests(TestCase):
+    """
+    Tests for volumes whose branches are overlays on commits, using a
+    stand-in for overlay mounts.
+    """
+    @skip_if_go_version
+    def setUp(self):
+        self.tmpdir = FilePath(self.mktemp())
+        self.tmpdir.makedirs()
+        self.mounts = FakeOverlayMounts()
+        for name in ("mountOverlay", "unmount", "isMounted"):
+            self.patch(storage, name, getattr(self.mounts, name))
+        self.dvol = VoluminousOptions()
+        self.dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "init", "--overlay", "foo"])
+        self.volume = self.tmpdir.child("foo")
+        self.master = self.volume.child("branches").child("master")
+
+    def commit(self, content):
+        self.master.child("file.txt").setContent(content)
+        self.dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "commit", "-m", content])
+        return self.dvol.voluminous.getOutput()[-1]
+
+    @skip_if_go_version
+    def test_checkout_new_branch_is_overlay(self):
+        """
+        ``dvol checkout -b`` mounts an overlay on the HEAD commit at the new
+        branch's directory rather than copying the commit.
+        """
+        commitId = self.commit("hello")
+        self.dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "checkout", "-b", "other"])
+        other = self.master.sibling("other")
+        lower, upper = self.mounts.mounts[other.path]
+        self.assertEqual(lower, self.volume.child("commits").child(commitId))
+        self.assertEqual(upper, self.volume.child("overlays").child(
+            "other").child("upper"))
+        self.assertEqual(other.child("file.txt").getContent(), "hello")
+
+    @skip_if_go_version
+    def test_reset_replaces_overlay(self):
+        """
+        Resetting a branch discards what was written to it and layers it on
+        the commit being reset to.
+        """
+        oldCommit = self.commit("OLD")
+        self.commit("NEW")
+        self.master.child("extra.txt").setContent("extra")
+        self.dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "reset", "--hard", "HEAD^"])
+        lower, upper = self.mounts.mounts[self.master.path]
+        self.assertEqual(lower, self.volume.child("commits").child(oldCommit))
+        self.assertEqual(upper.children(), [])
+        self.assertEqual(self.master.child("file.txt").getContent(), "OLD")
+        self.assertFalse(self.master.child("extra.txt").exists())
+
+    @skip_if_go_version
+    def test_switching_branch_remounts_overlay(self):
+        """
+        Switching to a branch whose overlay isn't mounted, e.g. after a
+        reboot, mounts it again.
+        """
+        self.commit("hello")
+        self.dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "checkout", "-b", "other"])
+        other = self.master.sibling("other")
+        self.mounts.unmount(other)
+        self.dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "checkout", "master"])
+        self.dvol.parseOptions(ARGS + ["-p", self.tmpdir.path,
+            "checkout", "other"])
+        self.assertIn(other.path, self.mounts.mounts)
+        self.assertEqual(other.child("file.txt").getContent(), "hello")
+        self.assertEqual(
+            self.volume.child("running_point").realpath(), other)
@@ -3,6 +3,7 @@ Common test tools.
 """
 
 from os import environ
+import os
 from semver import compare
 from unittest import skipIf
 import requests
@@ -85,3 +86,192 @@ def run(cmd):
         exc.original = error
         raise exc
     return result
+
+
+class FakeZFS(object):
+    """
+    A stand-in for the 'zfs' command which keeps each dataset and snapshot as
+    a plain directory under ``root``, and "mounts" a dataset by making its
+    mountpoint a symlink to that directory.
+
+    @ivar calls: The argument lists of every command run, in order.
+    """
+    def __init__(self, root):
+        self.root = root
+        self.calls = []
+        # dataset name -> mountpoint, or None if not mounted
+        self.datasets = {}
+        # snapshot names, oldest first
+        self.snapshots = []
+        # clone name -> the snapshot it was cloned from
+        self.origins = {}
+
+    def __call__(self, *arguments):
+        self.calls.append(list(arguments))
+        options = {}
+        positional = []
+        arguments = list(arguments[1:])
+        command = self.calls[-1][0]
+        while arguments:
+            argument = arguments.pop(0)
+            if argument in ("-o", "-t", "-d", "-s"):
+                value = arguments.pop(0)
+                if argument == "-o" and "=" in value:
+                    key, value = value.split("=", 1)
+                    options[key] = value
+                else:
+                    options[argument] = value
+            elif argument.startswith("-"):
+                options[argument] = True
+            else:
+                positional.append(argument)
+        return getattr(self, "_" + command)(options, *positional) or ""
+
+    def _data(self, name):
+        return self.root.child(name.replace("/", "_"))
+
+    def _mount(self, name):
+        mountpoint = self.datasets[name]
+        if mountpoint not in (None, "none"):
+            if not os.path.isdir(os.path.dirname(mountpoint)):
+                os.makedirs(os.path.dirname(mountpoint))
+            os.symlink(self._data(name).path, mountpoint)
+
+    def _unmount(self, name):
+        mountpoint = self.datasets[name]
+        if mountpoint not in (None, "none"):
+            os.remove(mountpoint)
+
+    def _copy(self, source, destination):
+        subprocess.check_call(
+            ["cp", "-a", self._data(source).path, self._data(destination).path])
+
+    def _create(self, options, name):
+        self._data(name).makedirs()
+        self.datasets[name] = options.get("mountpoint")
+        self._mount(name)
+
+    def _snapshot(self, options, name):
+        self._copy(name.split("@")[0], name)
+        self.snapshots.append(name)
+
+    def _clone(self, options, snapshot, name):
+        if snapshot not in self.snapshots:
+            raise subprocess.CalledProcessError(1, ["zfs", "clone", snapshot])
+        self._copy(snapshot, name)
+        self.datasets[name] = options.get("mountpoint")
+        self.origins[name] = snapshot
+        self._mount(name)
+
+    def _rollback(self, options, snapshot):
+        dataset = snapshot.split("@")[0]
+        if self._list(dict(options, **{"-t": "snapshot", "-d": "1"}),
+                      dataset).splitlines()[-1] != snapshot:
+            raise subprocess.CalledProcessError(1, ["zfs", "rollback"])
+        self._data(dataset).remove()
+        self._copy(snapshot, dataset)
+
+    def _set(self, options, assignment, name):
+        self._unmount(name)
+        self.datasets[name] = assignment[len("mountpoint="):]
+        self._mount(name)
+
+    def _rename(self, options, old, new):
+        self._unmount(old)
+        self._data(old).moveTo(self._data(new))
+        self.datasets[new] = self.datasets.pop(old)
+        if old in self.origins:
+            self.origins[new] = self.origins.pop(old)
+        for index, snapshot in enumerate(self.snapshots):
+            if snapshot.startswith(old + "@"):
+                renamed = new + snapshot[len(old):]
+                self._data(snapshot).moveTo(self._data(renamed))
+                self.snapshots[index] = renamed
+                for clone, origin in self.origins.items():
+                    if origin == snapshot:
+                        self.origins[clone] = renamed
+        self._mount(new)
+
+    def _destroy(self, options, name):
+        """
+        Destroy a snapshot or dataset, refusing like ZFS does to destroy a
+        snapshot which a clone outside of what is destroyed depends on.
+        """
+        if "@" in name:
+            destroyed = set()
+            snapshots = [name]
+        else:
+            recursive = options.get("-r") or options.get("-R")
+            destroyed = set(
+                dataset for dataset in self.datasets if dataset == name
+                or (recursive and dataset.startswith(name + "/")))
+            while options.get("-R"):
+                dependents = set(
+                    clone for clone, origin in self.origins.items()
+                    if origin.split("@")[0] in destroyed) - destroyed
+                if not dependents:
+                    break
+                destroyed |= dependents
+            snapshots = [snapshot for snapshot in self.snapshots
+                         if snapshot.split("@")[0] in destroyed]
+        for clone, origin in self.origins.items():
+            if origin in snapshots and clone not in destroyed:
+                raise subprocess.CalledProcessError(
+                    1, ["zfs", "destroy", name])
+        for dataset in destroyed:
+            self._unmount(dataset)
+            del self.datasets[dataset]
+            self.origins.pop(dataset, None)
+            if self._data(dataset).exists():
+                self._data(dataset).remove()
+        for snapshot in snapshots:
+            self.snapshots.remove(snapshot)
+            self._data(snapshot).remove()
+
+    def _list(self, options, name):
+        def within(dataset):
+            if dataset == name:
+                return True
+            if not dataset.startswith(name + "/"):
+                return False
+            return options.get("-r") or "/" not in dataset[len(name) + 1:]
+        if options.get("-t") == "snapshot":
+            result = [s for s in self.snapshots
+                      if s.split("@")[0] == name
+                      or (options.get("-r") and within(s.split("@")[0]))]
+        else:
+            result = [d for d in sorted(self.datasets) if within(d)]
+        columns = {"name": lambda name: name,
+                   "origin": lambda name: self.origins.get(name, "-")}
+        return "".join(
+            "\t".join(columns[column](line)
+                      for column in options.get("-o", "name").split(","))
+            + "\n" for line in result)
+
+
+class FakeOverlayMounts(object):
+    """
+    A stand-in for overlay mounts, which "mounts" an overlay by copying its
+    lower and then its upper directory into the mountpoint, and "unmounts" it
+    by moving what is in the mountpoint to the upper directory.
+
+    @ivar mounts: Mapping from the path of each mountpoint to its lower and
+        upper directories.
+    """
+    def __init__(self):
+        self.mounts = {}
+
+    def mountOverlay(self, lower, upper, work, merged):
+        self.mounts[merged.path] = (lower, upper)
+        for source in (lower, upper):
+            subprocess.check_call(
+                ["cp", "-a", source.path + "/.", merged.path])
+
+    def unmount(self, path):
+        lower, upper = self.mounts.pop(path.path)
+        upper.remove()
+        path.moveTo(upper)
+        path.makedirs()
+
+    def isMounted(self, path):
+        return path.path in self.mounts
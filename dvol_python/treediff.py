@@ -0,0 +1,132 @@
+"""
+Finding what differs between two trees, such as two commits or a branch and
+its latest commit.
+
+Each commit records a hash of every directory in it (see
+L{objectstore.treeHashes}), so a directory whose hash is the same in both
+commits is skipped without being looked inside, and comparing two commits
+only reads the directories on the way to what changed.  Regular files in
+commits are hard links to objects, so two of them are the same exactly when
+they are the same inode.
+"""
+
+import errno
+import os
+import stat
+
+from objectstore import _join, _walk, hashFile
+
+ADDED = "added"
+DELETED = "deleted"
+MODIFIED = "modified"
+
+FILE = "file"
+DIRECTORY = "directory"
+SYMLINK = "symlink"
+SPECIAL = "special"
+
+
+def kindOf(st):
+    if stat.S_ISREG(st.st_mode):
+        return FILE
+    if stat.S_ISDIR(st.st_mode):
+        return DIRECTORY
+    if stat.S_ISLNK(st.st_mode):
+        return SYMLINK
+    return SPECIAL
+
+
+def _lstat(root, relative):
+    if root is None:
+        return None
+    try:
+        return os.lstat(_join(root, relative))
+    except OSError, e:
+        if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+            raise
+        return None
+
+
+def sameObject(relative, oldPath, oldSt, newPath, newSt):
+    """
+    Return whether two regular files in commits have the same contents and
+    metadata.
+
+    Files which are links to objects are the same only if they link to the
+    same one.  Commits made before objects were stored hold plain copies,
+    which are hashed instead.
+    """
+    if (oldSt.st_dev, oldSt.st_ino) == (newSt.st_dev, newSt.st_ino):
+        return True
+    if oldSt.st_nlink > 1 and newSt.st_nlink > 1:
+        return False
+    return hashFile(oldPath, oldSt) == hashFile(newPath, newSt)
+
+
+def _walkAll(root, relative, change):
+    for path, st in _walk(root, start=relative):
+        yield change, path, kindOf(st)
+
+
+def compareTrees(old, new, sameFile=sameObject, oldTree=None, newTree=None,
+                 start=""):
+    """
+    Yield the differences between two trees, in the order L{objectstore._walk}
+    would find them.
+
+    Changes to the metadata of directories aren't reported.  An entry which
+    changed kind is reported as deleted and then added again, and everything
+    in a directory which was added or deleted is reported along with it.
+
+    @param old: The path of the older tree, as L{bytes}, or C{None} for an
+        empty one.
+    @param new: The path of the newer tree.
+    @param sameFile: A callable taking the relative path of a regular file
+        in both trees, and its path and stat result in each, returning
+        whether it is unchanged.
+    @param oldTree: The L{objectstore.treeHashes} of ``old``, or C{None}.
+    @param newTree: The L{objectstore.treeHashes} of ``new``, or C{None}.
+    @param start: The relative path of the part of the trees to compare.
+
+    @return: An iterator of 3-tuples of L{ADDED}, L{DELETED} or
+        L{MODIFIED}, the relative path, and its kind: L{FILE},
+        L{DIRECTORY}, L{SYMLINK} or L{SPECIAL}.
+    """
+    oldTree = oldTree or {}
+    newTree = newTree or {}
+    pending = [start]
+    while pending:
+        relative = pending.pop()
+        oldSt = _lstat(old, relative)
+        newSt = _lstat(new, relative)
+        if oldSt is None and newSt is None:
+            continue
+        oldKind = oldSt and kindOf(oldSt)
+        newKind = newSt and kindOf(newSt)
+        if oldKind != newKind:
+            if oldSt is not None:
+                for change in _walkAll(old, relative, DELETED):
+                    yield change
+            if newSt is not None:
+                for change in _walkAll(new, relative, ADDED):
+                    yield change
+            continue
+        oldPath = _join(old, relative)
+        newPath = _join(new, relative)
+        if newKind == DIRECTORY:
+            digest = oldTree.get(relative)
+            if digest is not None and digest == newTree.get(relative):
+                continue
+            names = set(os.listdir(oldPath)) | set(os.listdir(newPath))
+            pending.extend(os.path.join(relative, name)
+                           for name in sorted(names, reverse=True))
+            continue
+        if newKind == FILE:
+            unchanged = sameFile(relative, oldPath, oldSt, newPath, newSt)
+        elif newKind == SYMLINK:
+            unchanged = os.readlink(oldPath) == os.readlink(newPath)
+        else:
+            unchanged = ((oldSt.st_mode, oldSt.st_rdev)
+                         == (newSt.st_mode, newSt.st_rdev))
+        if not unchanged:
+            yield MODIFIED, relative, newKind
@@ -3,6 +3,8 @@ package datalayer
 // TODO: Rename this & every other reference to 'datalayer' with 'dataplane'
 
 import (
+	"bytes"
+	"encoding/binary"
 	"encoding/json"
 	"errors"
 	"fmt"
@@ -11,6 +13,7 @@ import (
 	"os/exec"
 	"path/filepath"
 	"strings"
+	"time"
 
 	"github.com/nu7hatch/gouuid"
 )
@@ -27,6 +30,9 @@ type CommitMessage string
 type Commit struct {
 	Id      CommitId      `json:"id"`
 	Message CommitMessage `json:"message"`
+	// Seconds since the epoch when the commit was made, or zero for commits
+	// recorded before the time was kept.
+	Created float64 `json:"created,omitempty"`
 }
 
 type Volume struct {
@@ -178,7 +184,11 @@ func (dl *DataLayer) copyFiles(from, to string) error {
 	if err == nil {
 		return fmt.Errorf("%s already exists", to)
 	}
-	cmd := exec.Command("cp", "-a", from, to)
+	// Files in commits made by the Python implementation are hard links to
+	// the same object whenever their contents are the same, and those links
+	// must not be carried over into a branch, where writing to one would
+	// change the others and the commit.
+	cmd := exec.Command("cp", "-a", "--no-preserve=links", from, to)
 	err = cmd.Run()
 	if err != nil {
 		return err
@@ -229,12 +239,52 @@ func (dl *DataLayer) recordCommit(volumeName, variantName, message string, commi
 	if err != nil {
 		return err
 	}
-	commits = append(commits, Commit{Id: commitId, Message: CommitMessage(message)})
+	created := float64(time.Now().UnixNano()) / float64(time.Second)
+	commits = append(commits, Commit{Id: commitId, Message: CommitMessage(message), Created: created})
 	return dl.WriteCommitsForBranch(volumeName, variantName, commits)
 }
 
+// The Python implementation keeps each branch's commits in <branch>.log, one
+// JSON object per line, with <branch>.idx holding the little-endian uint64
+// offset of the end of each line.  Older pools have a single JSON list in
+// <branch>.json instead.
+
+var MigratedToSQLite = errors.New("The commits in this pool have been migrated to a SQLite database, which only the Python implementation of dvol supports")
+
+func (dl *DataLayer) checkNotMigrated() error {
+	if _, err := os.Stat(filepath.Join(dl.basePath, "dvol.sqlite")); err == nil {
+		return MigratedToSQLite
+	}
+	return nil
+}
+
 func (dl *DataLayer) ReadCommitsForBranch(volumeName, variantName string) ([]Commit, error) {
-	branchDB := dl.variantPath(volumeName, variantName) + ".json"
+	if err := dl.checkNotMigrated(); err != nil {
+		return []Commit{}, err
+	}
+	branchPath := dl.variantPath(volumeName, variantName)
+	data, err := ioutil.ReadFile(branchPath + ".log")
+	if os.IsNotExist(err) {
+		return dl.readLegacyCommits(branchPath + ".json")
+	}
+	if err != nil {
+		return []Commit{}, err
+	}
+	lines := strings.Split(string(data), "\n")
+	store := []Commit{}
+	// The last element is either empty or a line left incomplete by an
+	// interrupted append, which isn't part of the log.
+	for _, line := range lines[:len(lines)-1] {
+		var commit Commit
+		if err := json.Unmarshal([]byte(line), &commit); err != nil {
+			return []Commit{}, err
+		}
+		store = append(store, commit)
+	}
+	return store, nil
+}
+
+func (dl *DataLayer) readLegacyCommits(branchDB string) ([]Commit, error) {
 	_, err := os.Stat(branchDB)
 	if err != nil {
 		// File doesn't exist, so it's an empty database.
@@ -257,15 +307,56 @@ func (dl *DataLayer) ReadCommitsForBranch(volumeName, variantName string) ([]Com
 }
 
 func (dl *DataLayer) WriteCommitsForBranch(volumeName, variantName string, commits []Commit) error {
-	branchDB := dl.variantPath(volumeName, variantName) + ".json"
-	file, err := os.Create(branchDB)
+	if err := dl.checkNotMigrated(); err != nil {
+		return err
+	}
+	branchPath := dl.variantPath(volumeName, variantName)
+	var log, index bytes.Buffer
+	for _, commit := range commits {
+		line, err := json.Marshal(commit)
+		if err != nil {
+			return err
+		}
+		log.Write(line)
+		log.WriteByte('\n')
+		binary.Write(&index, binary.LittleEndian, uint64(log.Len()))
+	}
+	// Like the Python implementation, replace the index before the log: an
+	// index covering fewer lines than the log is extended when it's read.
+	if err := writeFileAtomically(branchPath+".idx", index.Bytes()); err != nil {
+		return err
+	}
+	if err := writeFileAtomically(branchPath+".log", log.Bytes()); err != nil {
+		return err
+	}
+	if err := os.Remove(branchPath + ".json"); err != nil && !os.IsNotExist(err) {
+		return err
+	}
+	// The Python implementation counts the branches referring to each commit
+	// in <volume>/references.json, or <volume>/references in older versions;
+	// removing the counts makes it count them again from the logs.
+	for _, name := range []string{"references.json", "references"} {
+		if err := os.RemoveAll(filepath.Join(dl.volumePath(volumeName), name)); err != nil {
+			return err
+		}
+	}
+	return nil
+}
+
+func writeFileAtomically(path string, data []byte) error {
+	temporary := path + ".tmp"
+	file, err := os.Create(temporary)
 	if err != nil {
 		return err
 	}
 	defer file.Close()
-	encoder := json.NewEncoder(file)
-	encoder.Encode(commits)
-	return nil
+	if _, err := file.Write(data); err != nil {
+		return err
+	}
+	if err := file.Sync(); err != nil {
+		return err
+	}
+	return os.Rename(temporary, path)
 }
 
 var NoCommits = errors.New("No commits made on this variant yet")
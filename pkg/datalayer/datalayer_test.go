@@ -1,6 +1,7 @@
 package datalayer
 
 import (
+	"encoding/binary"
 	"io/ioutil"
 	"os"
 	"testing"
@@ -65,3 +66,100 @@ func TestCreateVariantFromVariant(t *testing.T) {
 		t.Errorf("%s != 'alpha'", alphaContents)
 	}
 }
+
+func TestCommitLogFormat(t *testing.T) {
+	tempdir, err := ioutil.TempDir("", "datalayer")
+	if err != nil {
+		t.Fatal("Could not create temp directory")
+	}
+	defer os.RemoveAll(tempdir)
+	dl := NewDataLayer(tempdir)
+	if err := dl.CreateVolume("foo"); err != nil {
+		t.Fatal("Could not create volume foo")
+	}
+	if err := dl.CreateVariant("foo", "master"); err != nil {
+		t.Fatal("Could not create master variant")
+	}
+	masterPath := dl.variantPath("foo", "master")
+	// A branch written by an older version of dvol
+	if err := writeFile(masterPath+".json", `[{"id": "a", "message": "first"}]`); err != nil {
+		t.Fatal(err)
+	}
+	commits := []Commit{{Id: "a", Message: "first"}, {Id: "b", Message: "second"}}
+	if err := dl.WriteCommitsForBranch("foo", "master", commits); err != nil {
+		t.Fatal(err)
+	}
+	if _, err := os.Stat(masterPath + ".json"); !os.IsNotExist(err) {
+		t.Error("The legacy commit database was not removed")
+	}
+	log, err := ioutil.ReadFile(masterPath + ".log")
+	if err != nil {
+		t.Fatal(err)
+	}
+	expected := "{\"id\":\"a\",\"message\":\"first\"}\n{\"id\":\"b\",\"message\":\"second\"}\n"
+	if string(log) != expected {
+		t.Errorf("%q != %q", log, expected)
+	}
+	index, err := ioutil.ReadFile(masterPath + ".idx")
+	if err != nil {
+		t.Fatal(err)
+	}
+	if len(index) != 16 || binary.LittleEndian.Uint64(index[:8]) != 29 || binary.LittleEndian.Uint64(index[8:]) != uint64(len(log)) {
+		t.Errorf("Unexpected index %v", index)
+	}
+	// A line left incomplete by an interrupted append is ignored.
+	if err := writeFile(masterPath+".log", expected+"{\"id\":"); err != nil {
+		t.Fatal(err)
+	}
+	read, err := dl.ReadCommitsForBranch("foo", "master")
+	if err != nil {
+		t.Fatal(err)
+	}
+	if len(read) != 2 || read[0] != commits[0] || read[1] != commits[1] {
+		t.Errorf("%v != %v", read, commits)
+	}
+}
+
+func TestResetDoesNotLinkFiles(t *testing.T) {
+	tempdir, err := ioutil.TempDir("", "datalayer")
+	if err != nil {
+		t.Fatal("Could not create temp directory")
+	}
+	defer os.RemoveAll(tempdir)
+	dl := NewDataLayer(tempdir)
+	if err := dl.CreateVolume("foo"); err != nil {
+		t.Fatal("Could not create volume foo")
+	}
+	if err := dl.CreateVariant("foo", "master"); err != nil {
+		t.Fatal("Could not create master variant")
+	}
+	commitId, err := dl.Snapshot("foo", "master", "message")
+	if err != nil {
+		t.Fatal(err)
+	}
+	// Lay the commit out like the Python implementation does, with files
+	// that have the same contents linked to the same object.
+	commitPath := dl.commitPath("foo", commitId)
+	if err := writeFile(commitPath+"/a.txt", "same"); err != nil {
+		t.Fatal(err)
+	}
+	if err := os.Link(commitPath+"/a.txt", commitPath+"/b.txt"); err != nil {
+		t.Fatal(err)
+	}
+	if err := dl.ResetVolume("HEAD", "foo", "master"); err != nil {
+		t.Fatal(err)
+	}
+	masterPath := dl.variantPath("foo", "master")
+	if err := writeFile(masterPath+"/a.txt", "other"); err != nil {
+		t.Fatal(err)
+	}
+	for _, path := range []string{masterPath + "/b.txt", commitPath + "/a.txt", commitPath + "/b.txt"} {
+		contents, err := readFile(path)
+		if err != nil {
+			t.Fatal(err)
+		}
+		if contents != "same" {
+			t.Errorf("%s contains %q after writing to the branch", path, contents)
+		}
+	}
+}